@@ -3,37 +3,141 @@ import logging
 import sys
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 from dotenv import load_dotenv
 
-load_dotenv()
-
 db = SQLAlchemy()
 
 def create_app():
+    load_dotenv()
     app = Flask(__name__)
     
-    # Configure logging
+    # Configure logging (LOG_LEVEL=DEBUG also logs diagram previews and every GitHub URL)
+    from .utils.tracing import RequestIdFilter
+    handler = logging.StreamHandler(sys.stdout)
+    handler.addFilter(RequestIdFilter())
     logging.basicConfig(
-        level=logging.DEBUG,
-        format='%(asctime)s [%(levelname)s] %(name)s: %(message)s',
-        handlers=[logging.StreamHandler(sys.stdout)]
+        level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+        format='%(asctime)s [%(levelname)s] [%(request_id)s] %(name)s: %(message)s',
+        handlers=[handler]
     )
     logger = logging.getLogger(__name__)
     logger.info("Flask application starting...")
     
-    # Simple SQLite config
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///gitdiagram.db'
+    # SQLite by default; any SQLAlchemy URI works (e.g. postgresql://...)
+    db_uri = os.getenv('DATABASE_URL', 'sqlite:///gitdiagram.db')
+    app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = _engine_options(db_uri)
     
+    # How long a cached diagram is served before its HEAD commit is revalidated
+    app.config['CACHE_REVALIDATE_SECONDS'] = int(os.getenv('CACHE_REVALIDATE_SECONDS', 3600))
+    # Cache-Control max-age for GET /diagram/... (browsers and CDNs)
+    app.config['DIAGRAM_MAX_AGE'] = int(os.getenv('DIAGRAM_MAX_AGE', 300))
+
     # Secret key for sessions (if needed)
     app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-key')
 
     db.init_app(app)
 
-    from .routes import main
+    from .routes import main, prewarmer, warmup
     app.register_blueprint(main)
 
+    from .utils.http_cache import init_http_cache
+    init_http_cache(app)
+
+    from .utils.tracing import init_tracing
+    init_tracing(app)
+
     with app.app_context():
-        db.create_all()
+        if db.engine.dialect.name == 'sqlite':
+            event.listen(db.engine, 'connect', _configure_sqlite)
+        # Boot doesn't touch the database: the schema is brought up to date beforehand by
+        # `python migrate.py` (e.g. a release step). DB_AUTO_MIGRATE=true does it here instead
+        if os.getenv('DB_AUTO_MIGRATE', 'false').lower() == 'true':
+            migrate_schema()
+
+    # Background refresh of watched and popular repos (PREWARM_ENABLED)
+    prewarmer.start(app)
+
+    # Connections, clients and schema check off the request path; GET /ready reports progress
+    warmup.start(app)
 
     return app
+
+def _engine_options(db_uri: str) -> dict:
+    options = {}
+    if db_uri.startswith('sqlite'):
+        # Wait for a competing writer instead of failing with "database is locked"
+        options['connect_args'] = {'timeout': int(os.getenv('DB_BUSY_TIMEOUT_MS', 5000)) / 1000}
+        # In-memory databases use a single static connection
+        if db_uri in ('sqlite://', 'sqlite:///:memory:'):
+            return options
+    else:
+        options['pool_pre_ping'] = True
+    options['pool_size'] = int(os.getenv('DB_POOL_SIZE', 5))
+    options['max_overflow'] = int(os.getenv('DB_MAX_OVERFLOW', 10))
+    options['pool_recycle'] = 3600
+    return options
+
+def _configure_sqlite(dbapi_connection, connection_record):
+    """
+    WAL lets readers run alongside the single writer, so several gunicorn
+    workers can share the file. synchronous=NORMAL is safe with WAL and
+    avoids an fsync per commit.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={int(os.getenv('DB_BUSY_TIMEOUT_MS', 5000))}")
+    cursor.close()
+
+def migrate_schema():
+    """Creates missing tables and upgrades older ones. Must be called inside an application context."""
+    db.create_all()
+    _upgrade_schema()
+
+def pending_schema_changes() -> list:
+    """Tables, columns and indexes migrate_schema() would create; empty when the schema is current."""
+    from .models import DiagramCache
+
+    inspector = db.inspect(db.engine)
+    pending = [f"table {name}" for name in db.metadata.tables if not inspector.has_table(name)]
+    table = DiagramCache.__table__
+    if f"table {table.name}" in pending:
+        return pending
+    existing = {col["name"] for col in inspector.get_columns(table.name)}
+    pending += [f"column {table.name}.{col.name}" for col in table.columns if col.name not in existing]
+    existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+    pending += [f"index {index.name}" for index in table.indexes if index.name not in existing_indexes]
+    return pending
+
+def _upgrade_schema():
+    """
+    Adds columns introduced after the first release to an existing database.
+    `create_all` only creates missing tables, so older gitdiagram.db files
+    would otherwise fail on the new DiagramCache columns.
+    """
+    from .models import DiagramCache
+
+    table = DiagramCache.__table__
+    inspector = db.inspect(db.engine)
+    existing = {col["name"] for col in inspector.get_columns(table.name)}
+    missing = [col for col in table.columns if col.name not in existing]
+    existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+    if not missing and all(index.name in existing_indexes for index in table.indexes):
+        return
+
+    with db.engine.begin() as conn:
+        for col in missing:
+            col_type = col.type.compile(dialect=db.engine.dialect)
+            logging.getLogger(__name__).info(f"Adding column {table.name}.{col.name}")
+            conn.execute(db.text(f"ALTER TABLE {table.name} ADD COLUMN {col.name} {col_type}"))
+        if any(col.name == 'last_accessed_at' for col in missing):
+            # Existing rows count as last used when they were generated
+            conn.execute(db.text(f"UPDATE {table.name} SET last_accessed_at = created_at, "
+                                 f"stored_bytes = length(diagram_content) WHERE last_accessed_at IS NULL"))
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                logging.getLogger(__name__).info(f"Creating index {index.name}")
+                index.create(conn)
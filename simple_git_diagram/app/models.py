@@ -1,22 +1,83 @@
+import os
+import zlib
 from datetime import datetime
 from . import db
 
+# Diagrams at least this large (UTF-8 bytes) are stored zlib-compressed
+COMPRESS_MIN_BYTES = int(os.getenv("CACHE_COMPRESS_MIN_BYTES", 1024))
+
 class DiagramCache(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     repo_url = db.Column(db.String(512), nullable=False)
     diagram_type = db.Column(db.String(50), nullable=False, default='flowchart')
-    diagram_content = db.Column(db.Text, nullable=False)
+    # Plain text for small diagrams; empty when the compressed column is used.
+    # Read and write through the diagram_content property.
+    _diagram_content = db.Column('diagram_content', db.Text, nullable=False, default='')
+    content_compressed = db.Column(db.LargeBinary, nullable=True)
+    # Bytes the row's content takes on disk, summed by cache eviction
+    stored_bytes = db.Column(db.Integer, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # HEAD commit the diagram was generated from, plus the ETag of the GitHub
+    # response so it can be revalidated with a conditional request.
+    commit_sha = db.Column(db.String(64), nullable=True)
+    etag = db.Column(db.String(256), nullable=True)
+    validated_at = db.Column(db.DateTime, nullable=True)
+    # Diagram updates from commit diffs since the last full generation (see INCREMENTAL_MAX_CHAIN)
+    incremental_updates = db.Column(db.Integer, nullable=True, default=0)
+    # Last time the diagram was served (coarse, see CACHE_TOUCH_SECONDS)
+    last_accessed_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
 
     __table_args__ = (
         db.UniqueConstraint('repo_url', 'diagram_type', name='_repo_type_uc'),
+        # Eviction walks rows least recently used first, summing their size
+        db.Index('ix_diagram_cache_lru', 'last_accessed_at', 'stored_bytes'),
     )
-    
+
+    # Pre-rendered SVG/PNG; eviction's bulk deletes clean up orphans explicitly
+    artifacts = db.relationship('DiagramArtifact', backref='diagram', lazy='select',
+                                cascade='all, delete-orphan', passive_deletes=True)
+
+    @property
+    def diagram_content(self) -> str:
+        if self.content_compressed is not None:
+            return zlib.decompress(self.content_compressed).decode("utf-8")
+        return self._diagram_content
+
+    @diagram_content.setter
+    def diagram_content(self, value: str):
+        data = value.encode("utf-8")
+        if len(data) >= COMPRESS_MIN_BYTES:
+            self.content_compressed = zlib.compress(data, 6)
+            self._diagram_content = ''
+            self.stored_bytes = len(self.content_compressed)
+        else:
+            self.content_compressed = None
+            self._diagram_content = value
+            self.stored_bytes = len(data)
+
     def to_dict(self):
         return {
             "id": self.id,
             "repo_url": self.repo_url,
             "diagram_type": self.diagram_type,
             "diagram_content": self.diagram_content,
-            "created_at": self.created_at.isoformat()
+            "created_at": self.created_at.isoformat(),
+            "commit_sha": self.commit_sha,
+            "validated_at": self.validated_at.isoformat() if self.validated_at else None,
+            "last_accessed_at": self.last_accessed_at.isoformat() if self.last_accessed_at else None
         }
+
+
+class DiagramArtifact(db.Model):
+    """A diagram rendered server-side, valid while content_hash matches the diagram."""
+    id = db.Column(db.Integer, primary_key=True)
+    cache_id = db.Column(db.Integer, db.ForeignKey('diagram_cache.id', ondelete='CASCADE'), nullable=False)
+    format = db.Column(db.String(8), nullable=False)
+    # sha256 of the Mermaid source it was rendered from
+    content_hash = db.Column(db.String(64), nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('cache_id', 'format', name='_artifact_format_uc'),
+    )
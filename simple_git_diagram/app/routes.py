@@ -1,19 +1,20 @@
-from flask import Blueprint, render_template, request, jsonify
-from datetime import datetime
-from . import db
-from .models import DiagramCache
-from .services.github_service import GitHubService
-from .services.llm_service import LLMService
-from app.utils.prompts import (
-    SYSTEM_DIAGRAM_PROMPT,
-    SYSTEM_CLASS_DIAGRAM_PROMPT,
-    SYSTEM_STATE_DIAGRAM_PROMPT,
-    SYSTEM_C4_DIAGRAM_PROMPT
-)
-import re
+from flask import Blueprint, Response, render_template, request, jsonify, current_app, url_for, stream_with_context
+import json
+from .services.diagram_service import DIAGRAM_TYPES, DiagramService, DiagramRequest, parse_repo_url
+from .services.job_service import JobQueue, QueueFullError
+from .services.llm_service import LLMError
+from .services.prewarm_service import Prewarmer
+from .services.warmup_service import Warmup
+from .services.token_pool import RateLimitError, get_token_pool
+from .services.render_service import MIMETYPES, RENDER_FORMATS, MermaidRenderError, MermaidSyntaxError
+from .utils.http_cache import content_etag
+from .utils.metrics import REGISTRY
 
 main = Blueprint('main', __name__)
-llm_service = LLMService()
+diagram_service = DiagramService()
+job_queue = JobQueue()
+prewarmer = Prewarmer(diagram_service)
+warmup = Warmup(diagram_service)
 
 import logging
 
@@ -24,130 +25,271 @@ def index():
     logger.info("Serving index page")
     return render_template('index.html')
 
-@main.route('/generate', methods=['POST'])
-def generate():
+def _parse_request():
+    """Builds a DiagramRequest from the JSON body, or returns an error response."""
     data = request.json
     repo_url = data.get('repo_url')
-    # Allow user to pass a PAT specifically for this request
-    pat = data.get('pat') 
-    force_refresh = data.get('force_refresh', False)
     diagram_type = data.get('diagram_type', 'flowchart')
-    
+
     logger.info(f"Received generation request for: {repo_url}, type: {diagram_type}")
-    
+
     if not repo_url:
         logger.warning("Repo URL missing in request")
-        return jsonify({"error": "Repo URL is required"}), 400
+        return None, (jsonify({"error": "Repo URL is required"}), 400)
 
     # Normalize repo_url to "username/repo"
     try:
-        if "github.com/" in repo_url:
-            parts = repo_url.split("github.com/")[-1].split("/")
-            username = parts[0]
-            repo = parts[1].replace(".git", "")
-        else:
-            parts = repo_url.split("/")
-            username = parts[0]
-            repo = parts[1]
+        username, repo = parse_repo_url(repo_url)
         logger.debug(f"Normalized repo: {username}/{repo}")
     except Exception as e:
         logger.error(f"Failed to parse repo URL: {repo_url} - {e}")
-        return jsonify({"error": "Invalid repository format. Use 'username/repo' or full URL."}), 400
-
-    canonical_key = f"{username}/{repo}".lower()
-
-    # Check Cache
-    cached = DiagramCache.query.filter_by(repo_url=canonical_key, diagram_type=diagram_type).first()
-    if cached and not force_refresh:
-        logger.info(f"Cache HIT for {canonical_key} ({diagram_type})")
-        return jsonify({"diagram": cached.diagram_content, "cached": True})
-    
-    if force_refresh:
-        logger.info(f"Force refresh requested for {canonical_key} ({diagram_type})")
-    else:
-        logger.info(f"Cache MISS for {canonical_key} ({diagram_type})")
+        return None, (jsonify({"error": "Invalid repository format. Use 'username/repo' or full URL."}), 400)
+
+    # Optional list of types generated together from a single repo fetch ("all" for every type)
+    diagram_types = data.get('diagram_types') or []
+    if diagram_types == 'all':
+        diagram_types = list(DIAGRAM_TYPES)
+    if not isinstance(diagram_types, list) or any(t not in DIAGRAM_TYPES for t in diagram_types):
+        logger.warning(f"Invalid diagram_types in request: {diagram_types}")
+        return None, (jsonify({"error": f"diagram_types must be a list of: {', '.join(DIAGRAM_TYPES)}"}), 400)
+
+    req = DiagramRequest(
+        username=username,
+        repo=repo,
+        diagram_type=diagram_type,
+        # Allow user to pass a PAT specifically for this request
+        pat=data.get('pat'),
+        force_refresh=data.get('force_refresh', False),
+        ignore_cache=data.get('ignore_cache', False),
+        diagram_types=tuple(diagram_types),
+    )
+    # Popular repos are kept warm in the background
+    prewarmer.record(req)
+    return req, None
+
+@main.route('/generate', methods=['POST'])
+def generate():
+    req, error = _parse_request()
+    if error:
+        return error
 
     try:
-        # Initialize GitHub Service (with optional custom PAT)
-        gh_service = GitHubService(pat=pat)
-        
-        # 1. Fetch Data
-        file_tree, default_branch = gh_service.get_file_tree(username, repo)
-        readme = gh_service.get_readme(username, repo)
-        
-        if not file_tree:
-            logger.warning(f"File tree empty for {canonical_key}")
-            return jsonify({"error": "Could not fetch file tree. Is the repo empty or private?"}), 404
-
-        # 2. Prepare LLM Prompt
-        # Construct base URL for links: https://github.com/user/repo/blob/branch/
-        base_url = f"https://github.com/{username}/{repo}/blob/{default_branch}/"
-        
-        repo_context = f"""<CONTEXT>
-Repo: {username}/{repo}
-Branch: {default_branch}
-Base URL: {base_url}
-</CONTEXT>
-
-<FILE_TREE>
-{file_tree}
-</FILE_TREE>
-
-<README>
-{readme}
-</README>"""
-        
-        # 3. Call LLM
-        # Select prompt based on type
-        if diagram_type == 'class':
-            system_prompt = SYSTEM_CLASS_DIAGRAM_PROMPT
-        elif diagram_type == 'state':
-            system_prompt = SYSTEM_STATE_DIAGRAM_PROMPT
-        elif diagram_type == 'c4':
-            system_prompt = SYSTEM_C4_DIAGRAM_PROMPT
-        else:
-            system_prompt = SYSTEM_DIAGRAM_PROMPT
-            
-        repo_context += f"\nIMPORTANT: Generate a {diagram_type} diagram."
-
-        raw_llm_output = llm_service.generate_diagram(
-            system_prompt=system_prompt,
-            user_content=repo_context
-        )
-        
-        # 4. Clean up Mermaid Code
-        cleaned_diagram = clean_mermaid_code(raw_llm_output, diagram_type)
-        
-        # 5. Cache Result (Only if valid diagram)
-        if "Error generating diagram" in cleaned_diagram or "Connection error" in cleaned_diagram:
-             logger.warning(f"Generated content contains error, NOT caching: {cleaned_diagram[:50]}...")
-        else:
-            if cached:
-                cached.diagram_content = cleaned_diagram
-                cached.created_at = datetime.utcnow()
-                logger.info("Updated cache entry")
-            else:
-                new_entry = DiagramCache(
-                    repo_url=canonical_key, 
-                    diagram_type=diagram_type,
-                    diagram_content=cleaned_diagram
-                )
-                db.session.add(new_entry)
-                logger.info("Created new cache entry")
-            
-            db.session.commit()
-        
-        logger.info("Generation successful")
-        logger.info(f"FINAL diagram being returned (first 300 chars): {cleaned_diagram[:300]}")
-        return jsonify({"diagram": cleaned_diagram, "cached": False})
+        return jsonify(_with_svg_url(req, diagram_service.generate(req)))
+    except ValueError as e:
+        logger.warning(f"ValueError: {e}")
+        return jsonify({"error": str(e)}), 404 # Repo not found
+    except RateLimitError as e:
+        return _rate_limited(e)
+    except LLMError as e:
+        return _llm_failed(req, e)
+    except Exception as e:
+        logger.exception(f"Server Error processing {req.canonical_key}: {e}")
+        return jsonify({"error": f"Internal Error: {str(e)}"}), 500
 
+def _rate_limited(e: RateLimitError):
+    logger.warning(f"Rate limited: {e}")
+    return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
+
+def _llm_failed(req: DiagramRequest, e: LLMError):
+    logger.error(f"LLM failed for {req.canonical_key}: {e}")
+    return jsonify({"error": f"Error generating diagram: {e}"}), e.status_code
+
+def _with_svg_url(req: DiagramRequest, result: dict) -> dict:
+    """Points the client at the server-rendered SVG when one can be served."""
+    if (diagram_service.renderer.enabled and not req.diagram_types and "diagram" in result
+            and not result.get("validation_errors")):
+        result = dict(result, svg_url=url_for('main.diagram', username=req.username, repo=req.repo,
+                                              diagram_type=req.diagram_type, format='svg'))
+    return result
+
+@main.route('/diagram/<username>/<repo>/<diagram_type>', methods=['GET'])
+def diagram(username, repo, diagram_type):
+    """
+    Cacheable GET for one diagram (generated on first request). Sends a strong
+    ETag of the body and answers If-None-Match with 304; ?format=mmd returns
+    the raw Mermaid text instead of JSON, ?format=svg or png the diagram
+    rendered server-side (MERMAID_RENDER_CMD).
+    """
+    if diagram_type not in DIAGRAM_TYPES:
+        return jsonify({"error": f"Unknown diagram type. Use one of: {', '.join(DIAGRAM_TYPES)}"}), 404
+    fmt = request.args.get('format')
+    if fmt in RENDER_FORMATS and not diagram_service.renderer.enabled:
+        return jsonify({"error": "Server-side rendering is not enabled"}), 501
+
+    req = DiagramRequest(username=username, repo=repo, diagram_type=diagram_type)
+    prewarmer.record(req)
+    try:
+        result = diagram_service.generate(req)
     except ValueError as e:
         logger.warning(f"ValueError: {e}")
         return jsonify({"error": str(e)}), 404 # Repo not found
+    except RateLimitError as e:
+        return _rate_limited(e)
+    except LLMError as e:
+        return _llm_failed(req, e)
     except Exception as e:
-        logger.error(f"Server Error processing {canonical_key}: {e}", exc_info=True)
-        print(f"Server Error: {e}")
+        logger.error(f"Server Error processing {req.canonical_key}: {e}", exc_info=True)
         return jsonify({"error": f"Internal Error: {str(e)}"}), 500
 
-from app.utils.mermaid_utils import clean_mermaid_code
+    if result.get("validation_errors"):
+        return jsonify({"error": "Generated diagram has syntax errors",
+                        "validation_errors": result["validation_errors"]}), 502
+
+    if fmt in RENDER_FORMATS:
+        try:
+            data = diagram_service.get_artifact(req, fmt)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 404
+        except MermaidSyntaxError as e:
+            return jsonify({"error": f"Diagram failed to render: {e}"}), 422
+        except MermaidRenderError as e:
+            logger.error(f"Render failed for {req.canonical_key} ({diagram_type}): {e}")
+            return jsonify({"error": str(e)}), 502
+        response = Response(data, mimetype=MIMETYPES[fmt])
+    elif fmt == 'mmd':
+        response = Response(result["diagram"], mimetype="text/vnd.mermaid")
+    else:
+        response = jsonify({"repo": req.canonical_key, "diagram_type": diagram_type, "diagram": result["diagram"]})
+    response.set_etag(content_etag(response.get_data()))
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['DIAGRAM_MAX_AGE']
+    return response.make_conditional(request)
+
+def _sse(event: str, payload: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+@main.route('/generate/stream', methods=['POST'])
+def generate_stream():
+    """
+    Server-Sent Events version of /generate: "status" events per stage,
+    "token" events as the LLM writes, then "done" with the cleaned diagram
+    (or "error").
+    """
+    req, error = _parse_request()
+    if error:
+        return error
+    if req.diagram_types:
+        return jsonify({"error": "diagram_types is not supported for streaming; use /generate or /jobs"}), 400
+
+    def events():
+        try:
+            for event, payload in diagram_service.generate_stream(req):
+                if event == "done":
+                    payload = _with_svg_url(req, payload)
+                yield _sse(event, payload)
+        except ValueError as e:
+            logger.warning(f"ValueError: {e}")
+            yield _sse("error", {"error": str(e), "status_code": 404})
+        except RateLimitError as e:
+            logger.warning(f"Rate limited: {e}")
+            yield _sse("error", {"error": str(e), "status_code": 429, "retry_after": e.retry_after})
+        except LLMError as e:
+            logger.error(f"LLM failed for {req.canonical_key}: {e}")
+            yield _sse("error", {"error": f"Error generating diagram: {e}", "status_code": e.status_code})
+        except Exception as e:
+            logger.error(f"Server Error processing {req.canonical_key}: {e}", exc_info=True)
+            yield _sse("error", {"error": f"Internal Error: {str(e)}", "status_code": 500})
+
+    headers = {
+        "Cache-Control": "no-cache",
+        # Stop nginx-style proxies from buffering the stream
+        "X-Accel-Buffering": "no",
+    }
+    return Response(stream_with_context(events()), mimetype="text/event-stream", headers=headers)
+
+def _job_response(job: dict):
+    body = {"job_id": job["id"], "status": job["status"],
+            "status_url": url_for('main.job_status', job_id=job["id"])}
+    if job["status"] == "done":
+        body["result"] = job["result"]
+    elif job["status"] == "failed":
+        body["error"] = job["error"]
+        body["status_code"] = job["status_code"]
+        if "retry_after" in job:
+            body["retry_after"] = job["retry_after"]
+    return body
+
+@main.route('/jobs', methods=['POST'])
+def create_job():
+    """Queues a generation and returns a job id to poll at GET /jobs/<id>."""
+    req, error = _parse_request()
+    if error:
+        return error
+
+    # Fresh cache hits don't need a worker
+    cached = diagram_service.lookup_cache(req)
+    if cached:
+        return jsonify(_job_response(job_queue.complete(cached))), 200
+
+    app = current_app._get_current_object()
+
+    def run():
+        with app.app_context():
+            return diagram_service.generate(req)
+
+    try:
+        job = job_queue.submit(run)
+    except QueueFullError as e:
+        return jsonify({"error": str(e)}), 429, {"Retry-After": "5"}
+    return jsonify(_job_response(job)), 202
+
+@main.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found or expired"}), 404
+    return jsonify(_job_response(job))
+
+@main.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({
+        "singleflight": diagram_service.inflight.stats(),
+        "prompt": diagram_service.prompt_builder.stats(),
+        "repo_context": diagram_service.contexts.stats(),
+        "cache": diagram_service.evictor.stats(),
+        "memory_cache": diagram_service.memory.stats(),
+        "validation": diagram_service.validation_stats(),
+        "incremental": diagram_service.incremental_stats(),
+        "hierarchy": diagram_service.hierarchy_stats(),
+        "github_quota": get_token_pool().stats(),
+        "llm": diagram_service.llm_service.stats(),
+        "prewarm": prewarmer.stats(),
+    })
+
+def _collect_metrics():
+    """Scrape-time values that already live in the services' own stats."""
+    quota = get_token_pool().stats()["tokens"]
+    yield ("gitdiagram_github_quota_remaining", "gauge", "GitHub requests left in the current window",
+           [({"token": t["token"]}, t["remaining"]) for t in quota])
+    yield ("gitdiagram_github_quota_limit", "gauge", "GitHub requests per window",
+           [({"token": t["token"]}, t["limit"]) for t in quota])
+    yield ("gitdiagram_github_throttled_total", "counter", "GitHub responses that were rate limited",
+           [({"token": t["token"]}, t["throttled"]) for t in quota])
+
+    llm = diagram_service.llm_service.stats()
+    yield ("gitdiagram_llm_inflight", "gauge", "LLM calls in progress per backend",
+           [({"backend": b["model"]}, b["inflight"]) for b in llm["backends"]])
+    yield ("gitdiagram_llm_circuit_open", "gauge", "1 while a backend's circuit breaker is open",
+           [({"backend": b["model"]}, int(b["circuit"]["state"] == "open")) for b in llm["backends"]])
+    yield ("gitdiagram_llm_cache_lookups_total", "counter", "LLM response cache lookups",
+           [({"result": "hit"}, llm["cache"]["hits"]), ({"result": "miss"}, llm["cache"]["misses"])])
+
+    memory = diagram_service.memory.stats()
+    yield ("gitdiagram_memory_cache_lookups_total", "counter", "In-process diagram cache lookups",
+           [({"result": "hit"}, memory["hits"]), ({"result": "miss"}, memory["misses"])])
+    singleflight = diagram_service.inflight.stats()
+    yield ("gitdiagram_singleflight_coalesced_total", "counter", "Calls that joined an identical in-flight call",
+           [({}, singleflight["coalesced"])])
+
+REGISTRY.add_collector(_collect_metrics)
+
+@main.route('/ready', methods=['GET'])
+def ready():
+    """Readiness probe: 200 once this worker has warmed up (see Warmup), 503 until then."""
+    status = warmup.status()
+    return jsonify(status), 200 if status["ready"] else 503, {"Cache-Control": "no-store"}
 
+@main.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus text format: request and stage latency histograms, cache hits, tokens, GitHub quota."""
+    return Response(REGISTRY.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,261 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .diagram_service import DiagramRequest, DiagramService
+from .llm_service import LLMError
+from .token_pool import RateLimitError
+from app.utils.prompt_builder import Prompt
+from app.utils.tracing import bind_request_id, new_request_id, timed
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Checkpointed statuses that need no retry on resume
+FINISHED = ("done", "unchanged", "missing")
+
+
+@dataclass
+class _Entry:
+    """A repository on its way through the batch."""
+    username: str
+    repo: str
+    # "done", "unchanged", "missing" or "failed" once decided
+    status: str = "pending"
+    head_sha: Optional[str] = None
+    etag: Optional[str] = None
+    prompts: Dict[str, Prompt] = field(default_factory=dict)
+    results: Dict[str, dict] = field(default_factory=dict)
+    updates: Dict[str, int] = field(default_factory=dict)
+    error: Optional[str] = None
+
+    @property
+    def canonical_key(self) -> str:
+        return f"{self.username}/{self.repo}".lower()
+
+
+class Checkpoint:
+    """
+    Progress of a batch as JSON lines, one per repository once its diagrams
+    are committed. Appended and fsynced batch by batch, so an interrupted
+    run loses at most the batch in flight (whose LLM answers are still in
+    the response cache).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> Dict[str, dict]:
+        """Last record per repository; a torn last line is ignored."""
+        records: Dict[str, dict] = {}
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                records[record["repo"]] = record
+        return records
+
+    def append(self, records: List[dict]):
+        if not records:
+            return
+        with open(self.path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def reset(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class BatchRunner:
+    """
+    Generates diagrams for many repositories without going through HTTP.
+
+    Runs the same pipeline as the server in two stages with their own
+    parallelism: `fetch_workers` repositories at a time get their HEAD
+    check, repo fetch and prompts (diagrams already at HEAD are skipped
+    there, with a conditional request that costs no quota), and
+    `llm_workers` LLM calls run at a time. Finished repositories are
+    committed `batch_size` at a time (or every `flush_seconds`) in a single
+    transaction and then recorded in the checkpoint, which a later run
+    with the same checkpoint resumes from. Failed repositories are retried
+    on resume. With `force` every diagram is regenerated.
+    """
+
+    def __init__(self, diagram_service: DiagramService, diagram_types: Tuple[str, ...],
+                 fetch_workers: int = 8, llm_workers: int = 4, batch_size: int = 20,
+                 flush_seconds: float = 30, checkpoint: Optional[Checkpoint] = None,
+                 force: bool = False, pat: Optional[str] = None):
+        self.diagram_service = diagram_service
+        self.diagram_types = tuple(diagram_types)
+        self.fetch_workers = max(1, fetch_workers)
+        self.llm_workers = max(1, llm_workers)
+        self.batch_size = max(1, batch_size)
+        self.flush_seconds = flush_seconds
+        self.checkpoint = checkpoint
+        self.force = force
+        self.pat = pat
+        self._stop = threading.Event()
+        # Stopped before every repository was processed
+        self.interrupted = False
+        self.counts = {status: 0 for status in FINISHED + ("failed", "resumed")}
+        self.stored = 0
+
+    def stop(self):
+        """Lets running work finish and be committed, but starts nothing new."""
+        self.interrupted = True
+        self._stop.set()
+
+    def run(self, app, repos: List[Tuple[str, str]]) -> dict:
+        """Processes (username, repo) pairs; returns counts per status."""
+        previous = self.checkpoint.load() if self.checkpoint else {}
+        # GitHub names are case-insensitive: Octo/A1 and octo/a1 are one repository
+        repos = list({f"{username}/{repo}".lower(): (username, repo) for username, repo in repos}.values())
+        todo = [_Entry(username, repo) for username, repo in repos
+                if not self._finished(previous.get(f"{username}/{repo}".lower()))]
+        self.counts["resumed"] = len(repos) - len(todo)
+        if self.counts["resumed"]:
+            logger.info(f"Resuming: {self.counts['resumed']} repositories already done")
+        logger.info(f"Batch of {len(todo)} repositories ({', '.join(self.diagram_types)}), "
+                    f"{self.fetch_workers} fetching and {self.llm_workers} LLM calls at a time")
+
+        fetch_pool = ThreadPoolExecutor(max_workers=self.fetch_workers, thread_name_prefix="batch-fetch")
+        llm_pool = ThreadPoolExecutor(max_workers=self.llm_workers, thread_name_prefix="batch-llm")
+        pending = iter(todo)
+        fetches: Dict[Future, _Entry] = {}
+        calls: Dict[Future, Tuple[_Entry, str]] = {}
+        waiting: Dict[str, int] = {}
+        finished: List[_Entry] = []
+        # Repositories between fetch and commit; bounds the prompts held in memory
+        window = self.fetch_workers + 2 * self.llm_workers + self.batch_size
+        flushed_at = time.monotonic()
+        started = time.monotonic()
+        try:
+            self._fill(app, fetch_pool, pending, fetches, window)
+            while fetches or calls:
+                done, _ = wait(list(fetches) + list(calls), timeout=self.flush_seconds,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in fetches:
+                        entry = fetches.pop(future)
+                        for diagram_type, prompt in entry.prompts.items():
+                            calls[llm_pool.submit(self._complete, entry, diagram_type, prompt)] = (entry, diagram_type)
+                        if entry.prompts:
+                            waiting[entry.canonical_key] = len(entry.prompts)
+                        else:
+                            finished.append(entry)
+                    else:
+                        entry, diagram_type = calls.pop(future)
+                        entry.results[diagram_type] = future.result()
+                        waiting[entry.canonical_key] -= 1
+                        if not waiting[entry.canonical_key]:
+                            del waiting[entry.canonical_key]
+                            finished.append(entry)
+                if len(finished) >= self.batch_size or (finished and time.monotonic() - flushed_at >= self.flush_seconds):
+                    self._flush(app, finished)
+                    flushed_at = time.monotonic()
+                if not self._stop.is_set():
+                    self._fill(app, fetch_pool, pending, fetches, window - len(fetches) - len(waiting) - len(finished))
+        finally:
+            # Whatever finished is kept, whatever is still running is redone on resume
+            self._stop.set()
+            fetch_pool.shutdown(wait=False, cancel_futures=True)
+            llm_pool.shutdown(wait=False, cancel_futures=True)
+            self._flush(app, finished)
+        elapsed = time.monotonic() - started
+        logger.info(f"Batch finished in {elapsed:.1f}s: " + ", ".join(f"{k} {v}" for k, v in self.counts.items()))
+        return dict(self.counts, repositories=len(repos), stored=self.stored, seconds=round(elapsed, 1))
+
+    def _finished(self, record: Optional[dict]) -> bool:
+        return (record is not None and not self.force and record.get("status") in FINISHED
+                and set(self.diagram_types) <= set(record.get("types", ())))
+
+    def _fill(self, app, pool: ThreadPoolExecutor, pending: Iterator[_Entry], fetches: Dict[Future, _Entry], room: int):
+        for _ in range(room):
+            entry = next(pending, None)
+            if entry is None:
+                return
+            fetches[pool.submit(self._fetch, app, entry)] = entry
+
+    def _fetch(self, app, entry: _Entry):
+        """HEAD check, fetch and prompts for one repository; records the outcome on `entry`."""
+        req = DiagramRequest(username=entry.username, repo=entry.repo, pat=self.pat,
+                             ignore_cache=self.force, diagram_types=self.diagram_types)
+        with app.app_context(), bind_request_id(f"batch-{new_request_id()}"):
+            while not self._stop.is_set():
+                try:
+                    plan = self.diagram_service.plan_refresh(req)
+                except RateLimitError as e:
+                    # Batches aren't in a hurry: wait for the quota instead of failing the repository
+                    logger.warning(f"GitHub quota exhausted, retrying {entry.canonical_key} in {e.retry_after}s")
+                    self._stop.wait(e.retry_after)
+                    continue
+                except ValueError as e:
+                    entry.status, entry.error = "missing", str(e)
+                    logger.warning(f"Skipping {entry.canonical_key}: {e}")
+                except LLMError as e:
+                    # Package summaries of a large repository
+                    entry.status, entry.error = "failed", str(e)
+                    logger.warning(f"Summaries failed for {entry.canonical_key}: {e}")
+                except Exception as e:
+                    entry.status, entry.error = "failed", str(e)
+                    logger.error(f"Preparing {entry.canonical_key} failed: {e}", exc_info=True)
+                else:
+                    if plan is None:
+                        entry.status = "unchanged"
+                        logger.info(f"{entry.canonical_key} unchanged, skipping")
+                    else:
+                        entry.status = "done"
+                        entry.head_sha, entry.etag = plan.head_sha, plan.etag
+                        entry.prompts, entry.results, entry.updates = plan.prompts, plan.generated, plan.updates
+                return
+            entry.status, entry.error = "failed", "interrupted"
+
+    def _complete(self, entry: _Entry, diagram_type: str, prompt: Prompt) -> dict:
+        req = DiagramRequest(username=entry.username, repo=entry.repo, diagram_type=diagram_type,
+                             ignore_cache=self.force)
+        with bind_request_id(f"batch-{new_request_id()}"):
+            try:
+                return self.diagram_service.complete(req, prompt)
+            except LLMError as e:
+                logger.warning(f"LLM failed for {entry.canonical_key} ({diagram_type}): {e}")
+                return {"error": str(e), "status_code": e.status_code, "cached": False}
+            except Exception as e:
+                logger.error(f"LLM call for {entry.canonical_key} ({diagram_type}) failed: {e}", exc_info=True)
+                return {"error": str(e), "cached": False}
+
+    def _flush(self, app, finished: List[_Entry]):
+        """Commits the finished repositories in one transaction, then checkpoints them."""
+        if not finished:
+            return
+        batch = [(e.canonical_key, e.results, e.head_sha, e.etag, e.updates) for e in finished if e.results]
+        if batch:
+            with app.app_context(), timed("db_write"):
+                self.stored += self.diagram_service.store_batch(batch)
+        records = []
+        for entry in finished:
+            failed = [t for t, result in entry.results.items() if "error" in result or result.get("validation_errors")]
+            if entry.status == "done" and failed:
+                entry.status, entry.error = "failed", f"no valid diagram for {', '.join(failed)}"
+            self.counts[entry.status] += 1
+            record = {"repo": entry.canonical_key, "status": entry.status, "types": list(self.diagram_types),
+                      "sha": entry.head_sha, "at": int(time.time())}
+            if entry.error:
+                record["error"] = entry.error
+            records.append(record)
+        if self.checkpoint:
+            self.checkpoint.append(records)
+        logger.info(f"Committed {len(batch)} of {len(finished)} repositories "
+                    f"({sum(self.counts.values()) - self.counts['resumed']} finished so far)")
+        finished.clear()
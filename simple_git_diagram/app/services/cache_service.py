@@ -0,0 +1,120 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Iterable
+
+from sqlalchemy import func
+from sqlalchemy.orm.attributes import set_committed_value
+from .. import db
+from ..models import DiagramArtifact, DiagramCache
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Rows deleted per statement while evicting
+DELETE_BATCH = 500
+
+
+class CacheEvictor:
+    """
+    Keeps DiagramCache bounded. Rows are dropped least recently used first
+    once the table exceeds CACHE_MAX_ROWS rows or CACHE_MAX_BYTES of stored
+    content. Rows nobody asked for in CACHE_IDLE_TTL seconds are dropped too.
+    Limits of 0 are disabled.
+
+    Access times are only written when older than CACHE_TOUCH_SECONDS, so a
+    popular diagram costs one UPDATE per interval rather than one per hit.
+    Must be called inside an application context.
+    """
+
+    def __init__(self):
+        self.max_rows = int(os.getenv("CACHE_MAX_ROWS", 10000))
+        self.max_bytes = int(os.getenv("CACHE_MAX_BYTES", 256 * 1024 * 1024))
+        self.idle_ttl = int(os.getenv("CACHE_IDLE_TTL", 30 * 24 * 3600))
+        self.touch_seconds = int(os.getenv("CACHE_TOUCH_SECONDS", 300))
+        # Eviction runs after writes, at most once per interval per process
+        self.interval = int(os.getenv("CACHE_EVICT_INTERVAL", 60))
+        self._lock = threading.Lock()
+        self._last_run = 0.0
+        self.evicted = 0
+
+    def touch(self, rows: Iterable[DiagramCache]):
+        """Records an access to `rows`, committing only if a timestamp actually changed."""
+        now = datetime.utcnow()
+        threshold = now - timedelta(seconds=self.touch_seconds)
+        stale = [row for row in rows if row.last_accessed_at is None or row.last_accessed_at < threshold]
+        if not stale:
+            return
+        # A bulk UPDATE, so a row evicted meanwhile by another process is simply skipped
+        DiagramCache.query.filter(DiagramCache.id.in_([row.id for row in stale])).update(
+            {DiagramCache.last_accessed_at: now}, synchronize_session=False)
+        db.session.commit()
+        for row in stale:
+            set_committed_value(row, "last_accessed_at", now)
+
+    def touch_key(self, canonical_key: str, diagram_type: str):
+        """touch() for a diagram served from memory, without loading its row."""
+        DiagramCache.query.filter_by(repo_url=canonical_key, diagram_type=diagram_type).update(
+            {DiagramCache.last_accessed_at: datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+
+    def maybe_evict(self):
+        with self._lock:
+            if time.monotonic() - self._last_run < self.interval:
+                return
+            self._last_run = time.monotonic()
+        try:
+            self.evict()
+        except Exception as e:
+            # A busy database must not fail the request that triggered eviction
+            db.session.rollback()
+            logger.warning(f"Cache eviction failed: {e}")
+
+    def evict(self) -> int:
+        deleted = 0
+        if self.idle_ttl > 0:
+            cutoff = datetime.utcnow() - timedelta(seconds=self.idle_ttl)
+            deleted += DiagramCache.query.filter(DiagramCache.last_accessed_at < cutoff).delete(
+                synchronize_session=False)
+
+        size = func.coalesce(DiagramCache.stored_bytes, 0)
+        rows, total_bytes = db.session.query(func.count(DiagramCache.id), func.sum(size)).one()
+        total_bytes = total_bytes or 0
+        excess_rows = rows - self.max_rows if self.max_rows > 0 else 0
+        excess_bytes = total_bytes - self.max_bytes if self.max_bytes > 0 else 0
+
+        # Walks ix_diagram_cache_lru oldest first until both limits hold again
+        while excess_rows > 0 or excess_bytes > 0:
+            page = db.session.query(DiagramCache.id, size).order_by(
+                DiagramCache.last_accessed_at.asc()).limit(DELETE_BATCH).all()
+            if not page:
+                break
+            victims = []
+            for row_id, row_bytes in page:
+                if excess_rows <= 0 and excess_bytes <= 0:
+                    break
+                victims.append(row_id)
+                excess_rows -= 1
+                excess_bytes -= row_bytes
+            deleted += DiagramCache.query.filter(DiagramCache.id.in_(victims)).delete(synchronize_session=False)
+
+        if deleted:
+            # Bulk deletes bypass the ORM cascade (and SQLite ignores foreign keys by default)
+            DiagramArtifact.query.filter(~DiagramArtifact.cache_id.in_(
+                db.session.query(DiagramCache.id))).delete(synchronize_session=False)
+        db.session.commit()
+        if deleted:
+            self.evicted += deleted
+            logger.info(f"Evicted {deleted} cached diagrams ({rows} rows, {total_bytes} bytes before size limits)")
+        return deleted
+
+    def stats(self) -> dict:
+        rows, total_bytes = db.session.query(
+            func.count(DiagramCache.id), func.sum(func.coalesce(DiagramCache.stored_bytes, 0))).one()
+        artifacts, artifact_bytes = db.session.query(
+            func.count(DiagramArtifact.id), func.sum(func.length(DiagramArtifact.data))).one()
+        return {"rows": rows, "bytes": total_bytes or 0, "evicted": self.evicted,
+                "max_rows": self.max_rows, "max_bytes": self.max_bytes,
+                "artifacts": artifacts, "artifact_bytes": artifact_bytes or 0}
@@ -0,0 +1,970 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from .. import db
+from ..models import DiagramArtifact, DiagramCache
+from .cache_service import CacheEvictor
+from .git_service import GitMirrorService
+from .github_service import FileChange, GitHubService, RepoSnapshot
+from .llm_service import LLMError, LLMService
+from .render_service import MermaidRenderer, MermaidRenderError, MermaidSyntaxError, content_hash
+from app.utils.file_tree import Package, should_include
+from app.utils.lru_cache import LRUCache
+from app.utils.metrics import DIAGRAM_REQUESTS
+from app.utils.mermaid_utils import clean_mermaid_code
+from app.utils.mermaid_validator import validate_mermaid
+from app.utils.prompt_builder import Prompt, PromptBuilder
+from app.utils.singleflight import SingleFlight
+from app.utils.tracing import submit_traced, timed
+from app.utils.prompts import (
+    SYSTEM_DIAGRAM_PROMPT,
+    SYSTEM_CLASS_DIAGRAM_PROMPT,
+    SYSTEM_STATE_DIAGRAM_PROMPT,
+    SYSTEM_C4_DIAGRAM_PROMPT,
+    SYSTEM_PACKAGE_SUMMARY_PROMPT,
+    MERMAID_REPAIR_PROMPT
+)
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+DIAGRAM_TYPES = ('flowchart', 'class', 'state', 'c4')
+# Types drawn from package summaries when a repository is too large for one prompt
+HIERARCHICAL_TYPES = ('flowchart', 'c4')
+# FileChange statuses as listed in MERMAID_UPDATE_PROMPT
+_CHANGE_LETTERS = {"added": "A", "removed": "D", "modified": "M", "renamed": "R"}
+
+
+def parse_repo_url(repo_url: str) -> Tuple[str, str]:
+    """Normalizes a GitHub URL or "username/repo" string to (username, repo)."""
+    if "github.com/" in repo_url:
+        parts = repo_url.split("github.com/")[-1].split("/")
+        username = parts[0]
+        repo = parts[1].replace(".git", "")
+    else:
+        parts = repo_url.split("/")
+        username = parts[0]
+        repo = parts[1]
+    return username, repo
+
+
+def select_system_prompt(diagram_type: str) -> str:
+    if diagram_type == 'class':
+        return SYSTEM_CLASS_DIAGRAM_PROMPT
+    elif diagram_type == 'state':
+        return SYSTEM_STATE_DIAGRAM_PROMPT
+    elif diagram_type == 'c4':
+        return SYSTEM_C4_DIAGRAM_PROMPT
+    return SYSTEM_DIAGRAM_PROMPT
+
+
+@dataclass
+class DiagramRequest:
+    username: str
+    repo: str
+    diagram_type: str = 'flowchart'
+    pat: Optional[str] = None
+    force_refresh: bool = False
+    # Regenerate even when the repo is unchanged (e.g. the last diagram failed to render),
+    # bypassing the LLM response cache
+    ignore_cache: bool = False
+    # Several types at once (one GitHub fetch); takes precedence over diagram_type
+    diagram_types: Tuple[str, ...] = ()
+    # Nobody is waiting for the result (pre-warming): left out of the served-diagram metrics
+    background: bool = False
+
+    @property
+    def canonical_key(self) -> str:
+        return f"{self.username}/{self.repo}".lower()
+
+
+@dataclass
+class RefreshPlan:
+    """What DiagramService.plan_refresh() found to do for a repository."""
+    head_sha: Optional[str]
+    etag: Optional[str]
+    # Types the changes since their diagram don't affect, ready to store
+    generated: Dict[str, dict]
+    # Types that need an LLM call
+    prompts: Dict[str, Prompt]
+    # Incremental update count to store per type
+    updates: Dict[str, int]
+
+
+@dataclass
+class _MemoryEntry:
+    diagram: str
+    # Last access written to the database, see CacheEvictor.touch_seconds
+    accessed_at: datetime
+
+
+class DiagramService:
+    """
+    Runs the fetch -> prompt -> LLM -> cleanup -> cache pipeline.
+    Must be called inside an application context. Raises ValueError when the
+    repository cannot be found, LLMError when the LLM call fails and
+    Exception for any other failure.
+    """
+
+    def __init__(self, llm_service: Optional[LLMService] = None):
+        self.llm_service = llm_service or LLMService()
+        self.prompt_builder = PromptBuilder(self.llm_service.model, self.llm_service.max_tokens)
+        self.inflight = SingleFlight()
+        self.evictor = CacheEvictor()
+        # Hot diagrams by (repo, type) so cache hits skip the database. Entries
+        # expire by MEMORY_CACHE_TTL, which bounds how long another process's
+        # write can go unnoticed, and never outlive their revalidation time.
+        self.memory = LRUCache(int(os.getenv("MEMORY_CACHE_ENTRIES", 2048)),
+                               ttl=int(os.getenv("MEMORY_CACHE_TTL", 60)),
+                               max_bytes=int(os.getenv("MEMORY_CACHE_BYTES", 32 * 1024 * 1024)),
+                               sizeof=lambda entry: len(entry.diagram))
+        # Repo snapshots by (repo, commit), so switching diagram type doesn't re-fetch from GitHub
+        self.contexts = LRUCache(int(os.getenv("REPO_CONTEXT_CACHE_SIZE", 64)),
+                                 ttl=int(os.getenv("REPO_CONTEXT_TTL", 600)))
+        # Runs the LLM calls of generate_many() in parallel
+        self.llm_pool = ThreadPoolExecutor(max_workers=int(os.getenv("LLM_PARALLEL_CALLS", len(DIAGRAM_TYPES))),
+                                           thread_name_prefix="llm")
+        # Diagrams failing validation go back to the LLM with the errors this many times
+        self.repair_attempts = int(os.getenv("MERMAID_REPAIR_ATTEMPTS", 1))
+        self.renderer = MermaidRenderer()
+        # "github" (REST API) or "git" (local mirrors, see GitMirrorService)
+        self.repo_source = os.getenv("REPO_SOURCE", "github").lower()
+        # A diagram whose repo moved by at most this many relevant files is updated from the diff
+        # instead of regenerated (0 turns it off), at most INCREMENTAL_MAX_CHAIN times in a row
+        self.incremental_max_changes = int(os.getenv("INCREMENTAL_MAX_CHANGES", 40))
+        self.incremental_max_chain = int(os.getenv("INCREMENTAL_MAX_CHAIN", 10))
+        self.updated = 0
+        self.unchanged = 0
+        self.full_fallbacks = 0
+        # Repositories with at least this many files (0 turns it off) are summarized package by
+        # package, HIERARCHY_PARALLEL summaries at a time, and drawn from the summaries
+        self.hierarchy_min_files = int(os.getenv("HIERARCHY_MIN_FILES", 2000))
+        self.hierarchy_max_packages = int(os.getenv("HIERARCHY_MAX_PACKAGES", 24))
+        self.hierarchy_package_tokens = int(os.getenv("HIERARCHY_PACKAGE_TOKENS", 800))
+        self.hierarchy_summary_tokens = int(os.getenv("HIERARCHY_SUMMARY_TOKENS", 300))
+        self.summary_pool = ThreadPoolExecutor(max_workers=int(os.getenv("HIERARCHY_PARALLEL", 4)),
+                                               thread_name_prefix="summary")
+        self.hierarchical = 0
+        self.summarized = 0
+        self.validated = 0
+        self.repaired = 0
+        self.rejected = 0
+
+    def lookup_cache(self, req: DiagramRequest) -> Optional[dict]:
+        """Returns the cached result if it can be served without contacting GitHub."""
+        if req.force_refresh:
+            return None
+        types = req.diagram_types or (req.diagram_type,)
+        fresh, _ = self._fresh_diagrams(req.canonical_key, types)
+        if len(fresh) < len(types):
+            return None
+        logger.info(f"Cache HIT for {req.canonical_key} ({', '.join(types)})")
+        if not req.background:
+            DIAGRAM_REQUESTS.inc(len(types), result="hit")
+        if not req.diagram_types:
+            return {"diagram": fresh[req.diagram_type], "cached": True}
+        return {"diagrams": {t: {"diagram": fresh[t], "cached": True} for t in types}}
+
+    def generate(self, req: DiagramRequest) -> dict:
+        if req.diagram_types:
+            return self.generate_many(req)
+
+        hit, gh_service, head_sha, etag = self._check_cache(req)
+        if hit:
+            return self._count(req, hit)
+
+        # Identical requests for the same commit share one fetch + LLM call. A
+        # regeneration (ignore_cache) never joins a flight that may read the LLM cache
+        result, shared = self.inflight.do(
+            (req.canonical_key, req.diagram_type, head_sha, req.ignore_cache),
+            lambda: self._generate_at(req, gh_service, head_sha, etag)
+        )
+        if shared:
+            logger.info(f"Shared in-flight generation for {req.canonical_key} ({req.diagram_type})")
+        return self._count(req, result)
+
+    def generate_many(self, req: DiagramRequest) -> dict:
+        """
+        Generates every type in `req.diagram_types` from one HEAD check and one
+        repo fetch, with the LLM calls running in parallel. New diagrams are
+        stored in a single transaction. Returns {"diagrams": {type: result}};
+        a type whose LLM call failed gets {"error": ...} instead.
+        """
+        canonical_key = req.canonical_key
+        types = list(dict.fromkeys(req.diagram_types))
+        if req.force_refresh:
+            for t in types:
+                self.memory.pop((canonical_key, t))
+            rows = self._load_rows(canonical_key, types)
+            results: Dict[str, dict] = {}
+        else:
+            fresh, rows = self._fresh_diagrams(canonical_key, types)
+            results = {t: {"diagram": diagram, "cached": True} for t, diagram in fresh.items()}
+        pending = [t for t in types if t not in results]
+        if not pending:
+            logger.info(f"Cache HIT for {canonical_key} ({', '.join(types)})")
+            if not req.background:
+                DIAGRAM_REQUESTS.inc(len(types), result="hit")
+            return {"diagrams": results}
+
+        gh_service = self._repo_service(req)
+
+        # One HEAD check for all types; conditional when the stale rows agree on the commit
+        stale = [rows[t] for t in pending if t in rows and rows[t].commit_sha and not req.ignore_cache]
+        etags = {row.etag for row in stale}
+        use_etag = stale[0].etag if stale and len(etags) == 1 else None
+        with timed("github_head"):
+            head_sha, etag = gh_service.get_head_commit(req.username, req.repo, etag=use_etag)
+        if head_sha is None:
+            head_sha = stale[0].commit_sha
+
+        revalidated = [t for t in pending
+                       if t in rows and not req.ignore_cache and rows[t].commit_sha == head_sha]
+        if revalidated:
+            now = datetime.utcnow()
+            for t in revalidated:
+                rows[t].etag = etag
+                rows[t].validated_at = now
+                rows[t].last_accessed_at = now
+                results[t] = {"diagram": rows[t].diagram_content, "cached": True}
+            db.session.commit()
+            for t in revalidated:
+                self._remember(rows[t], results[t]["diagram"])
+            logger.info(f"HEAD unchanged for {canonical_key}, reusing cached {', '.join(revalidated)} diagrams")
+        pending = [t for t in pending if t not in results]
+
+        if pending:
+            generated, prompts, updates, head_sha, etag = self._plan(req, gh_service, pending, rows, head_sha, etag)
+            futures = {}
+            for t, prompt in prompts.items():
+                sub_req = replace(req, diagram_type=t, diagram_types=())
+                # Still coalesces with single-type requests for the same commit
+                futures[t] = submit_traced(
+                    self.llm_pool, self.inflight.do, (canonical_key, t, head_sha, req.ignore_cache),
+                    lambda sub_req=sub_req, prompt=prompt: self.complete(sub_req, prompt)
+                )
+            for t, future in futures.items():
+                try:
+                    generated[t] = future.result()[0]
+                except LLMError as e:
+                    # The other types are still worth returning (and caching)
+                    logger.warning(f"LLM failed for {canonical_key} ({t}): {e}")
+                    generated[t] = {"error": str(e), "status_code": e.status_code, "cached": False}
+            if all("error" in result for result in generated.values()):
+                raise next(iter(futures.values())).exception()
+            with timed("db_write"):
+                self._store_many(canonical_key, generated, head_sha, etag, updates)
+            results.update(generated)
+
+        for t in types:
+            self._count(req, results[t])
+        return {"diagrams": {t: results[t] for t in types}}
+
+    def _plan(self, req: DiagramRequest, gh_service: GitHubService, pending: List[str],
+              rows: Dict[str, DiagramCache], head_sha: Optional[str], etag: Optional[str]
+              ) -> Tuple[Dict[str, dict], Dict[str, Prompt], Dict[str, int], Optional[str], Optional[str]]:
+        """
+        How each type in `pending` gets to `head_sha`: (generated, prompts,
+        updates, head_sha, etag). Types whose changes don't affect them are in
+        `generated`, the rest have a prompt (an update from the diff or a full
+        generation); `updates` is the incremental update count to store.
+        Reads the database but doesn't write to it.
+        """
+        generated: Dict[str, dict] = {}
+        prompts: Dict[str, Prompt] = {}
+        updates: Dict[str, int] = {}
+        for t in pending:
+            row = rows.get(t)
+            if not self._can_update(req, row, head_sha):
+                continue
+            sub_req = replace(req, diagram_type=t, diagram_types=())
+            update = self._plan_update(sub_req, gh_service, row, head_sha)
+            if isinstance(update, Prompt):
+                prompts[t] = update
+                updates[t] = (row.incremental_updates or 0) + 1
+            elif update is not None:
+                generated[t] = {"diagram": update, "cached": True}
+                updates[t] = row.incremental_updates or 0
+
+        full = [t for t in pending if t not in prompts and t not in generated]
+        if full:
+            snapshot = self._get_snapshot(req, gh_service, head_sha, etag)
+            if not snapshot.file_tree:
+                logger.warning(f"File tree empty for {req.canonical_key}")
+                raise ValueError("Could not fetch file tree. Is the repo empty or private?")
+            for t in full:
+                prompts[t] = self._build_prompt(replace(req, diagram_type=t, diagram_types=()), snapshot)
+            head_sha, etag = snapshot.head_sha, snapshot.etag
+        return generated, prompts, updates, head_sha, etag
+
+    def plan_refresh(self, req: DiagramRequest) -> Optional[RefreshPlan]:
+        """
+        HEAD check and plan for bringing every type in `req.diagram_types` up
+        to date, for callers that run the LLM calls and store the results
+        themselves (see BatchRunner). Returns None when every type is already
+        at HEAD. Reads the database but doesn't write to it; with ignore_cache
+        every type is planned as a full generation.
+        """
+        types = list(dict.fromkeys(req.diagram_types))
+        gh_service = self._repo_service(req)
+        rows = self._load_rows(req.canonical_key, types)
+        known = [rows[t] for t in types if t in rows and rows[t].commit_sha]
+        etags = {row.etag for row in known}
+        use_etag = known[0].etag if len(known) == len(types) and len(etags) == 1 and not req.ignore_cache else None
+        with timed("github_head"):
+            head_sha, etag = gh_service.get_head_commit(req.username, req.repo, etag=use_etag)
+        if head_sha is None:
+            return None
+        pending = [t for t in types if req.ignore_cache or t not in rows or rows[t].commit_sha != head_sha]
+        if not pending:
+            return None
+        generated, prompts, updates, head_sha, etag = self._plan(req, gh_service, pending, rows, head_sha, etag)
+        return RefreshPlan(head_sha, etag, generated, prompts, updates)
+
+    def generate_stream(self, req: DiagramRequest) -> Iterator[Tuple[str, dict]]:
+        """
+        Same pipeline as generate(), yielding (event, payload) pairs as it goes:
+        "status" for each stage, "token" for every piece of LLM output and a
+        final "done" carrying the cleaned diagram. Streams are not coalesced.
+        """
+        yield "status", {"stage": "cache"}
+        hit, gh_service, head_sha, etag = self._check_cache(req)
+        if hit:
+            yield "done", self._count(req, hit)
+            return
+
+        yield "status", {"stage": "fetch"}
+        context = self._fetch_context(req, gh_service, head_sha, etag)
+        if isinstance(context, dict):
+            yield "done", self._count(req, context)
+            return
+        cached, prompt, head_sha, etag = context
+
+        yield "status", {"stage": "llm"}
+        chunks = []
+        # Includes the time the client takes to read the tokens
+        with timed("llm"):
+            for text in self.llm_service.stream_diagram(
+                system_prompt=select_system_prompt(req.diagram_type),
+                user_content=prompt.text,
+                max_tokens=prompt.max_output_tokens,
+                cache_key=prompt.cache_key,
+                aliases=prompt.aliases,
+                # A regeneration asked for because the last diagram was bad must not get the same answer
+                use_cache=not req.ignore_cache
+            ):
+                chunks.append(text)
+                yield "token", {"text": text}
+
+        yield "status", {"stage": "validate"}
+        yield "done", self._count(req, self._finish(req, cached, head_sha, etag, "".join(chunks), prompt))
+
+    def _repo_service(self, req: DiagramRequest) -> Union[GitHubService, GitMirrorService]:
+        if self.repo_source == "git":
+            return GitMirrorService(pat=req.pat)
+        return GitHubService(pat=req.pat)
+
+    def _check_cache(self, req: DiagramRequest) -> Tuple[Optional[dict], Optional[GitHubService], Optional[str], Optional[str]]:
+        """
+        Returns (cached_result, gh_service, head_sha, etag). `cached_result` is
+        set when the stored diagram can be served and nothing else is needed.
+        """
+        canonical_key, diagram_type = req.canonical_key, req.diagram_type
+
+        # Check Cache (memory first, then the database)
+        if req.force_refresh:
+            self.memory.pop((canonical_key, diagram_type))
+            cached = DiagramCache.query.filter_by(repo_url=canonical_key, diagram_type=diagram_type).first()
+        else:
+            fresh, rows = self._fresh_diagrams(canonical_key, (diagram_type,))
+            if fresh:
+                logger.info(f"Cache HIT for {canonical_key} ({diagram_type})")
+                return {"diagram": fresh[diagram_type], "cached": True}, None, None, None
+            cached = rows.get(diagram_type)
+
+        if req.force_refresh:
+            logger.info(f"Force refresh requested for {canonical_key} ({diagram_type})")
+        elif cached:
+            logger.info(f"Cache STALE for {canonical_key} ({diagram_type}), revalidating")
+        else:
+            logger.info(f"Cache MISS for {canonical_key} ({diagram_type})")
+
+        # Initialize GitHub Service (with optional custom PAT)
+        gh_service = self._repo_service(req)
+
+        # 0. Revalidate against the HEAD commit. A conditional request answered
+        # with 304 costs nothing against the rate limit. This also checks the
+        # caller can see the repo before it joins anyone else's generation.
+        use_etag = cached.etag if cached and cached.commit_sha and not req.ignore_cache else None
+        with timed("github_head"):
+            head_sha, etag = gh_service.get_head_commit(req.username, req.repo, etag=use_etag)
+        if cached and not req.ignore_cache and (head_sha is None or head_sha == cached.commit_sha):
+            logger.info(f"HEAD unchanged for {canonical_key}, reusing cached {diagram_type} diagram")
+            cached.etag = etag
+            cached.validated_at = cached.last_accessed_at = datetime.utcnow()
+            db.session.commit()
+            diagram = cached.diagram_content
+            self._remember(cached, diagram)
+            return {"diagram": diagram, "cached": True}, None, None, None
+
+        return None, gh_service, head_sha, etag
+
+    def _generate_at(self, req: DiagramRequest, gh_service: GitHubService,
+                     head_sha: str, etag: Optional[str]) -> dict:
+        context = self._fetch_context(req, gh_service, head_sha, etag)
+        if isinstance(context, dict):
+            return context
+        cached, prompt, head_sha, etag = context
+
+        # 3. Call LLM
+        with timed("llm"):
+            raw_llm_output = self.llm_service.generate_diagram(
+                system_prompt=select_system_prompt(req.diagram_type),
+                user_content=prompt.text,
+                max_tokens=prompt.max_output_tokens,
+                cache_key=prompt.cache_key,
+                aliases=prompt.aliases,
+                use_cache=not req.ignore_cache
+            )
+        return self._finish(req, cached, head_sha, etag, raw_llm_output, prompt)
+
+    def _fetch_context(self, req: DiagramRequest, gh_service: GitHubService, head_sha: str,
+                       etag: Optional[str]) -> Union[dict, Tuple[Optional[DiagramCache], Prompt, str, Optional[str]]]:
+        """
+        Returns (cached_row, prompt, head_sha, etag), or a result dict if the
+        cache caught up meanwhile or the changes since the cached diagram
+        don't affect it.
+        """
+        canonical_key, diagram_type = req.canonical_key, req.diagram_type
+
+        # A flight that finished just before this one started may already have stored this commit
+        cached = DiagramCache.query.populate_existing().filter_by(
+            repo_url=canonical_key, diagram_type=diagram_type).first()
+        if cached and cached.commit_sha == head_sha and not req.ignore_cache:
+            logger.info(f"Cache already up to date for {canonical_key} ({diagram_type})")
+            self.evictor.touch([cached])
+            diagram = cached.diagram_content
+            self._remember(cached, diagram)
+            return {"diagram": diagram, "cached": True}
+
+        # An older diagram of this repo may only need the changes since its commit
+        if self._can_update(req, cached, head_sha):
+            update = self._plan_update(req, gh_service, cached, head_sha)
+            if isinstance(update, Prompt):
+                return cached, update, head_sha, etag
+            if update is not None:
+                with timed("db_write"):
+                    self._store(cached, req, update, head_sha, etag, updates=cached.incremental_updates or 0)
+                return {"diagram": update, "cached": True}
+
+        # 1. Fetch Data (branch, tree and README concurrently)
+        snapshot = self._get_snapshot(req, gh_service, head_sha, etag)
+        if not snapshot.file_tree:
+            logger.warning(f"File tree empty for {canonical_key}")
+            raise ValueError("Could not fetch file tree. Is the repo empty or private?")
+
+        # 2. Prepare LLM Prompt
+        return cached, self._build_prompt(req, snapshot), snapshot.head_sha, snapshot.etag
+
+    def _can_update(self, req: DiagramRequest, cached: Optional[DiagramCache], head_sha: Optional[str]) -> bool:
+        """Whether `cached` may be updated from a diff instead of being regenerated."""
+        return (self.incremental_max_changes > 0 and cached is not None and not req.ignore_cache
+                and bool(cached.commit_sha) and bool(head_sha) and cached.commit_sha != head_sha
+                and (cached.incremental_updates or 0) < self.incremental_max_chain)
+
+    def _plan_update(self, req: DiagramRequest, gh_service: GitHubService, cached: DiagramCache,
+                     head_sha: str) -> Union[None, str, Prompt]:
+        """
+        How to bring `cached` up to `head_sha`: an update Prompt for the LLM,
+        the cached diagram itself when no file that could appear in it
+        changed, or None to regenerate from scratch.
+        """
+        changes = self._changes(req, gh_service, cached.commit_sha, head_sha)
+        if changes is None:
+            self.full_fallbacks += 1
+            return None
+        if not changes:
+            self.unchanged += 1
+            logger.info(f"No relevant files changed in {req.canonical_key} since {cached.commit_sha[:12]}, "
+                        f"keeping the {req.diagram_type} diagram")
+            return cached.diagram_content
+        with timed("prompt_build"):
+            prompt = self.prompt_builder.build_update(
+                req.username, req.repo, cached.diagram_content, [self._change_line(c) for c in changes],
+                req.diagram_type, select_system_prompt(req.diagram_type)
+            )
+        if prompt is None:
+            self.full_fallbacks += 1
+            return None
+        self.updated += 1
+        logger.info(f"Updating {req.diagram_type} diagram for {req.canonical_key} from {len(changes)} changed "
+                    f"files: {prompt.prompt_tokens} prompt tokens, max output {prompt.max_output_tokens}")
+        return prompt
+
+    def _changes(self, req: DiagramRequest, gh_service: GitHubService, base_sha: str,
+                 head_sha: str) -> Optional[List[FileChange]]:
+        """
+        Files changed since `base_sha` that pass the file tree's exclusion
+        rules, shared across diagram types. None when the diff isn't available
+        or has more than INCREMENTAL_MAX_CHANGES of them.
+        """
+        key = ("changes", req.canonical_key, base_sha, head_sha)
+        entry = self.contexts.get(key)
+        if entry is None:
+            def compare():
+                with timed("github_compare"):
+                    changes = gh_service.compare_commits(req.username, req.repo, base_sha, head_sha)
+                if changes is not None:
+                    changes = [c for c in changes
+                               if should_include(c.path) or (c.previous_path and should_include(c.previous_path))]
+                # Wrapped, since None (no usable diff) is an answer too
+                self.contexts.put(key, (changes,))
+                return (changes,)
+            entry, _ = self.inflight.do(key, compare)
+        changes = entry[0]
+        if changes is not None and len(changes) > self.incremental_max_changes:
+            logger.info(f"{len(changes)} relevant files changed in {req.canonical_key} since {base_sha[:12]}, "
+                        f"regenerating from scratch")
+            return None
+        return changes
+
+    @staticmethod
+    def _change_line(change: FileChange) -> str:
+        if change.status == "renamed" and change.previous_path:
+            return f"R {change.previous_path} -> {change.path}"
+        return f"{_CHANGE_LETTERS.get(change.status, 'M')} {change.path}"
+
+    def _get_snapshot(self, req: DiagramRequest, gh_service: GitHubService, head_sha: Optional[str],
+                      etag: Optional[str]) -> RepoSnapshot:
+        """
+        Repo context for this commit, shared across diagram types and requests.
+        Only reachable after the caller's own HEAD check, so a cached snapshot
+        of a private repo is never served to someone who can't see it.
+        """
+        if not head_sha:
+            with timed("github_fetch"):
+                return gh_service.fetch_repo(req.username, req.repo, head_sha=head_sha, etag=etag)
+
+        key = (req.canonical_key, head_sha)
+        snapshot = self.contexts.get(key)
+        if snapshot:
+            logger.info(f"Repo context cache HIT for {req.canonical_key}@{head_sha[:12]}")
+            return snapshot
+
+        def fetch():
+            with timed("github_fetch"):
+                fetched = gh_service.fetch_repo(req.username, req.repo, head_sha=head_sha, etag=etag)
+            self.contexts.put(key, fetched)
+            return fetched
+
+        # Tabs opened together fetch the repo once
+        snapshot, _ = self.inflight.do(("context",) + key, fetch)
+        return snapshot
+
+    def _build_prompt(self, req: DiagramRequest, snapshot: RepoSnapshot) -> Prompt:
+        if self._is_hierarchical(req, snapshot):
+            return self._build_hierarchical_prompt(req, snapshot)
+        with timed("prompt_build"):
+            prompt = self.prompt_builder.build(
+                req.username, req.repo, snapshot.default_branch, snapshot.file_tree, snapshot.readme,
+                req.diagram_type, select_system_prompt(req.diagram_type)
+            )
+        logger.info(f"Prompt for {req.canonical_key} ({req.diagram_type}): {prompt.prompt_tokens} tokens "
+                    f"(tree {prompt.tree_tokens}, README {prompt.readme_tokens}, budget {prompt.budget}, "
+                    f"max output {prompt.max_output_tokens})")
+        return prompt
+
+    def _is_hierarchical(self, req: DiagramRequest, snapshot: RepoSnapshot) -> bool:
+        packages = snapshot.packages
+        return (req.diagram_type in HIERARCHICAL_TYPES and self.hierarchy_min_files > 0 and packages is not None
+                and packages.files >= self.hierarchy_min_files and len(packages) >= 2)
+
+    def _build_hierarchical_prompt(self, req: DiagramRequest, snapshot: RepoSnapshot) -> Prompt:
+        """
+        Map-reduce for repositories too large for one prompt: the largest
+        packages are summarized in parallel (cached by their git tree SHA, so
+        a new commit only re-summarizes the packages it touched), and the
+        summaries make up the prompt for the diagram.
+        """
+        with timed("summarize"):
+            packages, others = snapshot.packages.packages(self.hierarchy_max_packages, self.hierarchy_package_tokens)
+            max_tokens = self.prompt_builder.summary_tokens(len(packages), self.hierarchy_summary_tokens)
+            system_prompt = SYSTEM_PACKAGE_SUMMARY_PROMPT.format(words=max_tokens * 3 // 4)
+            futures = [(package, submit_traced(self.summary_pool, self._summarize, req, package, system_prompt,
+                                               max_tokens))
+                       for package in packages]
+            summaries, failures = [], []
+            for package, future in futures:
+                try:
+                    summaries.append((package.path, package.files, future.result()))
+                except LLMError as e:
+                    logger.warning(f"Summary of {req.canonical_key}/{package.path} failed: {e}")
+                    failures.append(e)
+                    others.append((package.path, package.files))
+            if not summaries:
+                raise failures[0]
+        self.hierarchical += 1
+        logger.info(f"Summarized {len(summaries)} of {len(packages) + len(others)} packages of {req.canonical_key} "
+                    f"({snapshot.packages.files} files)")
+        with timed("prompt_build"):
+            prompt = self.prompt_builder.build_hierarchical(
+                req.username, req.repo, snapshot.default_branch, snapshot.file_tree, snapshot.readme,
+                summaries, sorted(others, key=lambda item: -item[1]), req.diagram_type,
+                select_system_prompt(req.diagram_type)
+            )
+        logger.info(f"Prompt for {req.canonical_key} ({req.diagram_type}): {prompt.prompt_tokens} tokens "
+                    f"(packages and tree {prompt.tree_tokens}, README {prompt.readme_tokens}, budget {prompt.budget}, "
+                    f"max output {prompt.max_output_tokens})")
+        return prompt
+
+    def _summarize(self, req: DiagramRequest, package: Package, system_prompt: str, max_tokens: int) -> str:
+        content = (f"<PACKAGE>\nPath: {package.path}\nFiles: {package.files}\n</PACKAGE>\n\n"
+                   f"<FILE_TREE>\n{package.listing}\n</FILE_TREE>")
+        # Same tree SHA, same files: the summary is reused across commits, forks and
+        # diagram types, even with ignore_cache (which is about the final diagram)
+        cache_key = f"package:{package.path}@{package.tree_sha}" if package.tree_sha else None
+
+        def summarize():
+            self.summarized += 1
+            return self.llm_service.generate_diagram(system_prompt, content, max_tokens=max_tokens,
+                                                     cache_key=cache_key)
+
+        summary, _ = self.inflight.do(("summary", cache_key or content, max_tokens), summarize)
+        return summary
+
+    def complete(self, req: DiagramRequest, prompt: Prompt) -> dict:
+        """LLM call and cleanup without touching the database (safe off the request thread)."""
+        with timed("llm"):
+            raw_llm_output = self.llm_service.generate_diagram(
+                system_prompt=select_system_prompt(req.diagram_type),
+                user_content=prompt.text,
+                max_tokens=prompt.max_output_tokens,
+                cache_key=prompt.cache_key,
+                aliases=prompt.aliases,
+                use_cache=not req.ignore_cache
+            )
+        with timed("cleanup"):
+            cleaned_diagram = clean_mermaid_code(raw_llm_output, req.diagram_type)
+        with timed("validate"):
+            cleaned_diagram, errors = self._validate(req, cleaned_diagram, prompt.max_output_tokens)
+        if errors:
+            self._forget(req, prompt)
+        logger.info(f"Generated {req.diagram_type} diagram for {req.canonical_key} ({len(cleaned_diagram)} chars)")
+        return self._result(cleaned_diagram, errors)
+
+    def _finish(self, req: DiagramRequest, cached: Optional[DiagramCache], head_sha: Optional[str],
+                etag: Optional[str], raw_llm_output: str, prompt: Prompt) -> dict:
+        # 4. Clean up Mermaid Code
+        with timed("cleanup"):
+            cleaned_diagram = clean_mermaid_code(raw_llm_output, req.diagram_type)
+        with timed("validate"):
+            cleaned_diagram, errors = self._validate(req, cleaned_diagram, prompt.max_output_tokens)
+
+        # 5. Cache Result (Only if valid diagram)
+        if errors:
+            logger.warning(f"Generated diagram is still invalid after repair, NOT caching: {errors[0]}")
+            self._forget(req, prompt)
+        else:
+            updates = (cached.incremental_updates or 0) + 1 if cached and prompt.incremental else 0
+            with timed("db_write"):
+                self._store(cached, req, cleaned_diagram, head_sha, etag, updates=updates)
+
+        logger.info("Generation successful")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"FINAL diagram being returned (first 300 chars): {cleaned_diagram[:300]}")
+        return self._result(cleaned_diagram, errors)
+
+    def _forget(self, req: DiagramRequest, prompt: Prompt):
+        """Keeps a rejected diagram out of the LLM cache, so the next request pays for a fresh attempt."""
+        self.llm_service.forget(select_system_prompt(req.diagram_type), prompt.text, prompt.max_output_tokens,
+                                cache_key=prompt.cache_key)
+
+    @staticmethod
+    def _count(req: DiagramRequest, result: dict) -> dict:
+        """Counts a served diagram as a cache hit or miss for /metrics; returns `result`."""
+        if "diagram" in result and not req.background:
+            DIAGRAM_REQUESTS.inc(result="hit" if result.get("cached") else "miss")
+        return result
+
+    def validation_stats(self) -> dict:
+        return {"validated": self.validated, "repaired": self.repaired, "rejected": self.rejected,
+                "renderer": self.renderer.stats()}
+
+    def hierarchy_stats(self) -> dict:
+        return {"prompts": self.hierarchical, "summaries": self.summarized, "min_files": self.hierarchy_min_files}
+
+    def incremental_stats(self) -> dict:
+        return {"updated": self.updated, "unchanged": self.unchanged, "full_fallbacks": self.full_fallbacks,
+                "max_changes": self.incremental_max_changes, "max_chain": self.incremental_max_chain}
+
+    @staticmethod
+    def _result(diagram: str, errors: List[str]) -> dict:
+        result = {"diagram": diagram, "cached": False}
+        if errors:
+            result["validation_errors"] = errors
+        return result
+
+    def _validate(self, req: DiagramRequest, diagram: str, max_tokens: int) -> Tuple[str, List[str]]:
+        """
+        Checks a cleaned diagram and sends it back to the LLM with the errors,
+        at most MERMAID_REPAIR_ATTEMPTS times. With a renderer configured the
+        check is a real render, whose SVG is then stored with the diagram.
+        Returns the best diagram seen and its remaining errors.
+        """
+        self.validated += 1
+        errors = self._check(diagram, req.diagram_type)
+        attempt = 0
+        while errors and attempt < self.repair_attempts:
+            attempt += 1
+            logger.info(f"{req.diagram_type} diagram for {req.canonical_key} failed validation "
+                        f"({len(errors)} errors, first: {errors[0]}), repair attempt {attempt}")
+            repair_prompt = MERMAID_REPAIR_PROMPT.format(
+                diagram_type=req.diagram_type, errors="\n".join(errors), diagram=diagram)
+            try:
+                raw = self.llm_service.generate_diagram(
+                    system_prompt=select_system_prompt(req.diagram_type),
+                    user_content=repair_prompt,
+                    max_tokens=max_tokens,
+                    use_cache=not req.ignore_cache
+                )
+            except LLMError as e:
+                logger.warning(f"Repair call failed for {req.canonical_key} ({req.diagram_type}): {e}")
+                break
+            candidate = clean_mermaid_code(raw, req.diagram_type)
+            candidate_errors = self._check(candidate, req.diagram_type)
+            if candidate_errors:
+                self.llm_service.forget(select_system_prompt(req.diagram_type), repair_prompt, max_tokens)
+            if len(candidate_errors) <= len(errors):
+                diagram, errors = candidate, candidate_errors
+        if errors:
+            self.rejected += 1
+        elif attempt:
+            self.repaired += 1
+            logger.info(f"Repaired {req.diagram_type} diagram for {req.canonical_key} after {attempt} attempt(s)")
+        return diagram, errors
+
+    def _check(self, diagram: str, diagram_type: str) -> List[str]:
+        errors = validate_mermaid(diagram, diagram_type)
+        if errors or not self.renderer.enabled:
+            return errors
+        try:
+            self.renderer.render(diagram, "svg")
+        except MermaidSyntaxError as e:
+            return [str(e)]
+        except MermaidRenderError as e:
+            # A broken renderer says nothing about the diagram
+            logger.warning(f"Server-side render failed, relying on the built-in check: {e}")
+        return []
+
+    def get_artifact(self, req: DiagramRequest, fmt: str) -> bytes:
+        """
+        The cached diagram rendered as `fmt`, from the database when it was
+        rendered before, otherwise rendered now and stored. Raises ValueError
+        when nothing is cached and MermaidSyntaxError/MermaidRenderError when
+        rendering fails.
+        """
+        row = DiagramCache.query.filter_by(repo_url=req.canonical_key, diagram_type=req.diagram_type).first()
+        if row is None:
+            raise ValueError("Diagram not found. Generate it first.")
+        diagram = row.diagram_content
+        digest = content_hash(diagram)
+        artifact = next((a for a in row.artifacts if a.format == fmt), None)
+        if artifact is not None and artifact.content_hash == digest:
+            return artifact.data
+
+        data, _ = self.inflight.do(("render", digest, fmt), lambda: self.renderer.render(diagram, fmt))
+        self._put_artifact(row, fmt, digest, data)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another process stored the same render first
+            db.session.rollback()
+        return data
+
+    def _stage_artifacts(self, row: DiagramCache, diagram: str):
+        """Stores the SVG rendered while validating `diagram`, if there is one."""
+        if not self.renderer.enabled:
+            return
+        digest = content_hash(diagram)
+        svg = self.renderer.rendered.get((digest, "svg"))
+        if svg is not None:
+            self._put_artifact(row, "svg", digest, svg)
+
+    @staticmethod
+    def _put_artifact(row: DiagramCache, fmt: str, digest: str, data: bytes):
+        artifact = next((a for a in row.artifacts if a.format == fmt), None)
+        if artifact is None:
+            row.artifacts.append(DiagramArtifact(format=fmt, content_hash=digest, data=data))
+        else:
+            artifact.content_hash = digest
+            artifact.data = data
+            artifact.created_at = datetime.utcnow()
+
+    def _fresh_diagrams(self, canonical_key: str, diagram_types) -> Tuple[Dict[str, str], Dict[str, DiagramCache]]:
+        """
+        Diagrams of `diagram_types` that can be served without revalidation,
+        from memory when possible and otherwise from a single query. Also
+        returns the rows that query loaded, stale ones included.
+        """
+        fresh: Dict[str, str] = {}
+        now = datetime.utcnow()
+        for diagram_type in diagram_types:
+            entry = self.memory.get((canonical_key, diagram_type))
+            if entry is None:
+                continue
+            fresh[diagram_type] = entry.diagram
+            if (now - entry.accessed_at).total_seconds() > self.evictor.touch_seconds:
+                entry.accessed_at = now
+                self.evictor.touch_key(canonical_key, diagram_type)
+
+        missing = [t for t in diagram_types if t not in fresh]
+        rows = self._load_rows(canonical_key, missing) if missing else {}
+        hits = [row for row in rows.values() if not self._needs_revalidation(row)]
+        if hits:
+            self.evictor.touch(hits)
+            for row in hits:
+                fresh[row.diagram_type] = row.diagram_content
+                self._remember(row, fresh[row.diagram_type])
+        return fresh, rows
+
+    def _remember(self, row: DiagramCache, diagram: str):
+        """Puts a freshly read or written row into the memory tier."""
+        ttl = self.memory.ttl
+        max_age = current_app.config['CACHE_REVALIDATE_SECONDS']
+        checked_at = row.validated_at or row.created_at
+        if max_age > 0 and checked_at is not None:
+            remaining = max_age - (datetime.utcnow() - checked_at).total_seconds()
+            if remaining <= 0:
+                return
+            ttl = min(ttl, remaining) if ttl else remaining
+        accessed_at = row.last_accessed_at or datetime.utcnow()
+        self.memory.put((row.repo_url, row.diagram_type), _MemoryEntry(diagram, accessed_at), ttl=ttl)
+
+    @staticmethod
+    def _load_rows(canonical_key: str, diagram_types) -> Dict[str, DiagramCache]:
+        rows = DiagramCache.query.filter(DiagramCache.repo_url == canonical_key,
+                                         DiagramCache.diagram_type.in_(list(diagram_types))).populate_existing().all()
+        return {row.diagram_type: row for row in rows}
+
+    def _store(self, cached: Optional[DiagramCache], req: DiagramRequest, diagram: str,
+               head_sha: Optional[str], etag: Optional[str], updates: int = 0):
+        row = self._stage(cached, req.canonical_key, req.diagram_type, diagram, head_sha, etag, updates)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another process inserted the same (repo, type) first; keep the newer diagram
+            db.session.rollback()
+            logger.info(f"Concurrent insert for {req.canonical_key} ({req.diagram_type}), updating instead")
+            existing = DiagramCache.query.filter_by(repo_url=req.canonical_key, diagram_type=req.diagram_type).one()
+            self._store(existing, req, diagram, head_sha, etag, updates)
+            return
+        self._remember(row, diagram)
+        self.evictor.maybe_evict()
+
+    def _store_many(self, canonical_key: str, results: Dict[str, dict],
+                    head_sha: Optional[str], etag: Optional[str], updates: Optional[Dict[str, int]] = None):
+        """Stores every successful result in one transaction. `updates`: incremental update count per type."""
+        updates = updates or {}
+        stored = self._stage_results(canonical_key, results, head_sha, etag, updates)
+        if not stored:
+            return
+        try:
+            db.session.commit()
+            logger.info(f"Stored {', '.join(stored)} diagrams for {canonical_key}")
+        except IntegrityError:
+            # A concurrent insert won one of the rows; fall back to storing them one by one
+            db.session.rollback()
+            logger.info(f"Concurrent insert for {canonical_key}, storing diagrams individually")
+            for diagram_type in stored:
+                existing = DiagramCache.query.filter_by(repo_url=canonical_key, diagram_type=diagram_type).first()
+                stored[diagram_type] = self._stage(existing, canonical_key, diagram_type,
+                                                   results[diagram_type]["diagram"], head_sha, etag,
+                                                   updates.get(diagram_type, 0))
+                db.session.commit()
+        for diagram_type, row in stored.items():
+            self._remember(row, results[diagram_type]["diagram"])
+        self.evictor.maybe_evict()
+
+    def store_batch(self, batch: List[Tuple[str, Dict[str, dict], Optional[str], Optional[str], Dict[str, int]]]) -> int:
+        """
+        Stores the results of many repositories, each given as (canonical_key,
+        results, head_sha, etag, updates) like _store_many(), in a single
+        transaction. Returns the number of diagrams stored.
+        """
+        staged = {}
+        for canonical_key, results, head_sha, etag, updates in batch:
+            staged[canonical_key] = self._stage_results(canonical_key, results, head_sha, etag, updates)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Someone else inserted one of the rows; one transaction per repository sorts that out
+            db.session.rollback()
+            logger.info(f"Concurrent insert in a batch of {len(batch)} repositories, storing them one by one")
+            for canonical_key, results, head_sha, etag, updates in batch:
+                self._store_many(canonical_key, results, head_sha, etag, updates)
+            return sum(len(rows) for rows in staged.values())
+        for (canonical_key, results, _, _, _) in batch:
+            for diagram_type, row in staged[canonical_key].items():
+                self._remember(row, results[diagram_type]["diagram"])
+        self.evictor.maybe_evict()
+        return sum(len(rows) for rows in staged.values())
+
+    def _stage_results(self, canonical_key: str, results: Dict[str, dict], head_sha: Optional[str],
+                       etag: Optional[str], updates: Dict[str, int]) -> Dict[str, DiagramCache]:
+        """Stages every successful, valid result of one repository; returns the rows by type."""
+        # Reloaded: coalesced single-type requests may have inserted rows meanwhile
+        rows = self._load_rows(canonical_key, results)
+        stored = {}
+        for diagram_type, result in results.items():
+            if "error" in result:
+                continue
+            if result.get("validation_errors"):
+                logger.warning(f"Generated {diagram_type} diagram is still invalid after repair, NOT caching")
+                continue
+            stored[diagram_type] = self._stage(rows.get(diagram_type), canonical_key, diagram_type,
+                                               result["diagram"], head_sha, etag, updates.get(diagram_type, 0))
+        return stored
+
+    def _stage(self, cached: Optional[DiagramCache], canonical_key: str, diagram_type: str, diagram: str,
+               head_sha: Optional[str], etag: Optional[str], updates: int = 0) -> DiagramCache:
+        """Adds the write to the session (not committed) and drops the memory copy."""
+        self.memory.pop((canonical_key, diagram_type))
+        now = datetime.utcnow()
+        if cached:
+            cached.diagram_content = diagram
+            cached.created_at = now
+            cached.commit_sha = head_sha
+            cached.etag = etag
+            cached.validated_at = now
+            cached.last_accessed_at = now
+            cached.incremental_updates = updates
+            logger.info("Updated cache entry")
+        else:
+            new_entry = DiagramCache(
+                repo_url=canonical_key,
+                diagram_type=diagram_type,
+                diagram_content=diagram,
+                commit_sha=head_sha,
+                etag=etag,
+                validated_at=now,
+                last_accessed_at=now
+            )
+            db.session.add(new_entry)
+            logger.info("Created new cache entry")
+            cached = new_entry
+        self._stage_artifacts(cached, diagram)
+        return cached
+
+    @staticmethod
+    def _needs_revalidation(cached: DiagramCache) -> bool:
+        """A cached diagram is revalidated against GitHub once it is older than CACHE_REVALIDATE_SECONDS."""
+        max_age = current_app.config['CACHE_REVALIDATE_SECONDS']
+        checked_at = cached.validated_at or cached.created_at
+        if max_age <= 0 or checked_at is None:
+            return False
+        return (datetime.utcnow() - checked_at).total_seconds() > max_age
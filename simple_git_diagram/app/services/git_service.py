@@ -0,0 +1,313 @@
+import base64
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from app.utils.file_tree import PackageIndex, build_file_tree_from_paths
+from .github_service import FileChange, RepoSnapshot
+from .token_pool import get_token_pool
+
+try:
+    import fcntl
+except ImportError:  # Windows: mirrors are only locked within the process
+    fcntl = None
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Next to gitdiagram.db in Flask's instance folder
+DEFAULT_MIRROR_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                  "instance", "mirrors")
+# Owner and repo names end up in paths and URLs
+_NAME = re.compile(r'^[\w.-]+$')
+# git's messages for a repo that doesn't exist or can't be read with the given credentials
+_NOT_FOUND = re.compile(r'not found|does not exist|could not read from remote|authentication failed'
+                        r'|could not read username|not a git repository|access denied|403', re.I)
+# `git diff-tree --name-status` letters in FileChange statuses (renames are off: detecting
+# them needs blob contents, which a blobless mirror would download one by one)
+_CHANGE_STATUS = {"A": "added", "D": "removed", "M": "modified", "T": "modified"}
+# Tried in this order, like GitHub's /readme
+README_NAMES = ("readme.md", "readme", "readme.rst", "readme.txt", "readme.markdown", "readme.adoc")
+README_MAX_BYTES = 512 * 1024
+
+_locks: Dict[str, threading.Lock] = {}
+_locks_guard = threading.Lock()
+# Default branch per remote, learned from ls-remote
+_branches: Dict[str, str] = {}
+
+
+class GitMirrorService:
+    """
+    Reads repositories with git instead of the GitHub REST API: no rate
+    limit, no truncated trees, and any git host (GIT_REMOTE_URL, with
+    {owner} and {repo} placeholders).
+
+    Each repository is kept as a bare, shallow (depth 1), blobless mirror
+    under GIT_MIRROR_DIR. A generation for a commit the mirror already has
+    reads the tree straight from the object store, without network access.
+    A new commit costs one incremental `git fetch` of its trees, and only
+    the README blob is downloaded. When GIT_REMOTE_URL names an existing
+    local directory (a working copy or a bare mirror kept up to date
+    elsewhere), it is read in place.
+
+    Drop-in for GitHubService: get_head_commit() (a `git ls-remote`, with
+    the commit SHA as the "etag") and fetch_repo() return the same values.
+    Raises ValueError when the repository can't be found or read.
+    """
+
+    def __init__(self, pat: Optional[str] = None):
+        self.remote_template = os.getenv("GIT_REMOTE_URL", "https://github.com/{owner}/{repo}.git")
+        self.mirror_dir = os.getenv("GIT_MIRROR_DIR") or DEFAULT_MIRROR_DIR
+        self.max_mirrors = int(os.getenv("GIT_MIRROR_MAX_REPOS", 200))
+        self.timeout = float(os.getenv("GIT_TIMEOUT", 120))
+        self.tree_max_tokens = int(os.getenv("TREE_MAX_TOKENS", 1500))
+        # Request PAT first, then the first configured GitHub token (HTTPS remotes only)
+        self.token = pat or get_token_pool().states[0].token
+
+    def get_head_commit(self, username: str, repo: str, etag: Optional[str] = None) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Returns (commit_sha, etag) for the remote's HEAD, like GitHubService.
+        The etag is the SHA itself, so an unchanged HEAD is returned as (None, etag).
+        """
+        remote = self._remote(username, repo)
+        if os.path.isdir(remote):
+            sha = self._git(["rev-parse", "HEAD"], cwd=remote).strip()
+        else:
+            sha, branch = self._ls_remote(remote)
+            _branches[remote] = branch
+        if etag and sha == etag:
+            logger.info(f"HEAD of {username}/{repo} unchanged")
+            return None, etag
+        logger.info(f"HEAD of {username}/{repo} is {sha[:12]}")
+        return sha, sha
+
+    def fetch_repo(self, username: str, repo: str, head_sha: Optional[str] = None,
+                   etag: Optional[str] = None) -> RepoSnapshot:
+        """File tree, README and default branch at `head_sha` (the remote's HEAD when not given)."""
+        started = time.perf_counter()
+        remote = self._remote(username, repo)
+        if os.path.isdir(remote):
+            head_sha = head_sha or self._git(["rev-parse", "HEAD"], cwd=remote).strip()
+            branch = self._git(["symbolic-ref", "--short", "-q", "HEAD"], cwd=remote, check=False).strip() or "main"
+            return self._snapshot(username, repo, remote, remote, head_sha, branch, False, started)
+
+        if remote not in _branches:
+            _branches[remote] = self._ls_remote(remote)[1]
+        path = self._mirror_path(username, repo)
+        # Held while reading too, so the mirror isn't pruned underneath
+        with self._locked(path):
+            fetched = self._update_mirror(path, remote, head_sha)
+            if not head_sha or not self._has_commit(path, head_sha):
+                # HEAD moved between the ls-remote and the fetch; describe what was fetched
+                head_sha = self._git(["rev-parse", "refs/heads/mirror"], cwd=path).strip()
+            return self._snapshot(username, repo, path, remote, head_sha, _branches[remote], fetched, started)
+
+    def _snapshot(self, username: str, repo: str, path: str, remote: str, head_sha: str, branch: str,
+                  fetched: bool, started: float) -> RepoSnapshot:
+        packages = PackageIndex()
+        paths = self._list_files(path, head_sha, packages)
+        file_tree, included = build_file_tree_from_paths(paths, self.tree_max_tokens, packages)
+        readme = self._readme(path, head_sha, remote)
+        logger.info(f"Read {username}/{repo}@{head_sha[:12]} from git: {included} files, README "
+                    f"{len(readme)} chars, {'fetched' if fetched else 'no fetch'}, "
+                    f"{time.perf_counter() - started:.3f}s")
+        return RepoSnapshot(file_tree, readme, branch, head_sha, head_sha, packages)
+
+    def compare_commits(self, username: str, repo: str, base_sha: str, head_sha: str) -> Optional[List[FileChange]]:
+        """
+        Files changed from `base_sha` to `head_sha`, from a diff of their trees
+        (no blobs needed). Returns None when either commit can't be had.
+        """
+        remote = self._remote(username, repo)
+        if os.path.isdir(remote):
+            return self._diff(username, repo, remote, base_sha, head_sha)
+        path = self._mirror_path(username, repo)
+        with self._locked(path):
+            self._update_mirror(path, remote, head_sha)
+            if not self._has_commit(path, base_sha):
+                # Shallow mirrors only hold the commits they were asked for
+                self._git(["fetch", "-q", "--depth=1", "--filter=blob:none", "--no-tags", "origin", base_sha],
+                          cwd=path, remote=remote, check=False)
+            return self._diff(username, repo, path, base_sha, head_sha)
+
+    def _diff(self, username: str, repo: str, path: str, base_sha: str, head_sha: str) -> Optional[List[FileChange]]:
+        if not self._has_commit(path, base_sha) or not self._has_commit(path, head_sha):
+            logger.info(f"Cannot compare {username}/{repo} {base_sha[:12]}...{head_sha[:12]}: commit not available")
+            return None
+
+        output = self._git(["diff-tree", "-r", "-z", "--no-renames", "--name-status", base_sha, head_sha], cwd=path)
+        fields = output.split("\0")
+        changes = [FileChange(_CHANGE_STATUS[status], name)
+                   for status, name in zip(fields[0::2], fields[1::2]) if status in _CHANGE_STATUS]
+        logger.info(f"{len(changes)} files changed in {username}/{repo} since {base_sha[:12]}")
+        return changes
+
+    def _update_mirror(self, path: str, remote: str, head_sha: Optional[str]) -> bool:
+        """Creates the mirror or fetches the remote's HEAD into it unless `head_sha` is already there."""
+        if not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+            self._git(["init", "--bare", "-q"], cwd=path)
+            self._git(["config", "remote.origin.url", remote], cwd=path)
+            # Missing blobs (the README) are fetched on demand from the promisor remote
+            self._git(["config", "remote.origin.promisor", "true"], cwd=path)
+            self._git(["config", "remote.origin.partialclonefilter", "blob:none"], cwd=path)
+            self._prune_mirrors(keep=path)
+        elif head_sha and self._has_commit(path, head_sha):
+            os.utime(path)
+            return False
+
+        self._git(["fetch", "-q", "--depth=1", "--filter=blob:none", "--no-tags", "origin",
+                   "+HEAD:refs/heads/mirror"], cwd=path, remote=remote)
+        os.utime(path)
+        return True
+
+    def _has_commit(self, path: str, sha: str) -> bool:
+        return self._git(["cat-file", "-e", f"{sha}^{{commit}}"], cwd=path, check=False, status=True) == 0
+
+    def _list_files(self, path: str, sha: str, packages: PackageIndex) -> Iterator[str]:
+        """
+        Blob paths of the commit, streamed from `git ls-tree -r -t -z` (trees
+        only, no blob downloads). Directory SHAs go to `packages`.
+        """
+        proc = subprocess.Popen(["git", "ls-tree", "-r", "-t", "-z", "--full-tree", sha], cwd=path,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=self._env())
+        try:
+            pending = b""
+            for chunk in iter(lambda: proc.stdout.read(65536), b""):
+                entries = (pending + chunk).split(b"\0")
+                pending = entries.pop()
+                for entry in entries:
+                    meta, _, name = entry.partition(b"\t")
+                    # "<mode> <type> <object>"; submodules are "commit" entries
+                    fields = meta.split(b" ")
+                    if fields[1:2] == [b"blob"]:
+                        yield name.decode("utf-8", "replace")
+                    elif fields[1:2] == [b"tree"]:
+                        packages.add_tree(name.decode("utf-8", "replace"), fields[2].decode())
+        finally:
+            proc.stdout.close()
+            proc.wait()
+
+    def _readme(self, path: str, sha: str, remote: str) -> str:
+        listing = self._git(["ls-tree", "-z", "--name-only", sha], cwd=path, check=False)
+        names = {name.lower(): name for name in listing.split("\0") if name}
+        name = next((names[n] for n in README_NAMES if n in names), None)
+        if name is None:
+            name = next((original for lower, original in sorted(names.items()) if lower.startswith("readme")), None)
+        if name is None:
+            logger.warning("README not found in repository")
+            return ""
+        # Downloads just this blob when the mirror is blobless
+        content = self._git(["cat-file", "blob", f"{sha}:{name}"], cwd=path, remote=remote, check=False, raw=True)
+        return content[:README_MAX_BYTES].decode("utf-8", "replace")
+
+    def _ls_remote(self, remote: str) -> Tuple[str, str]:
+        """(HEAD sha, default branch) of a remote in one round-trip."""
+        output = self._git(["ls-remote", "--symref", remote, "HEAD"], remote=remote)
+        sha, branch = None, "main"
+        for line in output.splitlines():
+            if line.startswith("ref:"):
+                branch = line.split()[1].replace("refs/heads/", "", 1)
+            elif line.endswith("\tHEAD"):
+                sha = line.split("\t")[0]
+        if not sha:
+            raise ValueError("Repository not found or empty.")
+        return sha, branch
+
+    def _remote(self, username: str, repo: str) -> str:
+        # A leading "-" would reach git as an option when the template starts with {owner}
+        if (not _NAME.match(username) or not _NAME.match(repo)
+                or username.startswith((".", "-")) or repo.startswith((".", "-"))):
+            raise ValueError("Invalid repository name.")
+        return self.remote_template.format(owner=username, repo=repo)
+
+    def _mirror_path(self, username: str, repo: str) -> str:
+        return os.path.join(self.mirror_dir, username.lower(), f"{repo.lower()}.git")
+
+    def _prune_mirrors(self, keep: str):
+        """Removes the least recently used mirrors beyond GIT_MIRROR_MAX_REPOS."""
+        if self.max_mirrors <= 0:
+            return
+        mirrors: List[Tuple[float, str]] = []
+        for owner in os.listdir(self.mirror_dir):
+            owner_dir = os.path.join(self.mirror_dir, owner)
+            if os.path.isdir(owner_dir):
+                mirrors += [(os.path.getmtime(os.path.join(owner_dir, name)), os.path.join(owner_dir, name))
+                            for name in os.listdir(owner_dir) if name.endswith(".git")]
+        mirrors.sort()
+        for _, victim in mirrors[:max(0, len(mirrors) - self.max_mirrors)]:
+            if victim == keep:
+                continue
+            # Called with `keep` locked: never wait for another mirror, skip it while it's in use
+            with self._locked(victim, blocking=False) as acquired:
+                if not acquired:
+                    logger.info(f"Not removing mirror {victim}: in use")
+                    continue
+                logger.info(f"Removing least recently used mirror {victim}")
+                shutil.rmtree(victim, ignore_errors=True)
+
+    @contextmanager
+    def _locked(self, path: str, blocking: bool = True) -> Iterator[bool]:
+        """
+        One user per mirror, across threads and (with fcntl) processes. Yields
+        whether the lock was taken, which is always the case when `blocking`.
+        """
+        with _locks_guard:
+            lock = _locks.setdefault(path, threading.Lock())
+        if not lock.acquire(blocking=blocking):
+            yield False
+            return
+        try:
+            if fcntl is None:
+                yield True
+                return
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(f"{path}.lock", "w") as handle:
+                try:
+                    fcntl.flock(handle, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    yield False
+                    return
+                try:
+                    yield True
+                finally:
+                    fcntl.flock(handle, fcntl.LOCK_UN)
+        finally:
+            lock.release()
+
+    def _env(self, remote: Optional[str] = None) -> dict:
+        env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+        if remote and self.token and urlparse(remote).scheme == "https":
+            # Via the environment, so the token never shows up in the process list
+            credentials = base64.b64encode(f"x-access-token:{self.token}".encode()).decode()
+            env.update(GIT_CONFIG_COUNT="1", GIT_CONFIG_KEY_0="http.extraHeader",
+                       GIT_CONFIG_VALUE_0=f"Authorization: Basic {credentials}")
+        return env
+
+    def _git(self, args: List[str], cwd: Optional[str] = None, remote: Optional[str] = None,
+             check: bool = True, status: bool = False, raw: bool = False):
+        """Runs git; returns stdout (bytes with raw=True) or, with status=True, the exit code."""
+        env = self._env(remote)
+        try:
+            proc = subprocess.run(["git", *args], cwd=cwd, env=env, capture_output=True, timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            raise Exception(f"git {args[0]} timed out after {self.timeout:.0f}s")
+        if status:
+            return proc.returncode
+        if proc.returncode != 0 and check:
+            error = proc.stderr.decode("utf-8", "replace").strip()
+            if self.token:
+                error = error.replace(self.token, "***")
+            if _NOT_FOUND.search(error):
+                logger.warning(f"git {args[0]} failed: {error[-500:]}")
+                raise ValueError("Repository not found (or private and no valid PAT provided).")
+            logger.error(f"git {args[0]} failed: {error[-500:]}")
+            raise Exception(f"git {args[0]} failed: {error[-200:]}")
+        return proc.stdout if raw else proc.stdout.decode("utf-8", "replace")
@@ -1,30 +1,164 @@
 import requests
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from typing import Optional, List, Tuple
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from app.utils.file_tree import PackageIndex, build_file_tree, should_include
+from app.utils.tracing import submit_traced
+from .token_pool import RateLimitError, TokenPool, get_token_pool
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Overridable so the client can run against GitHub Enterprise or a local fake API
+GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com").rstrip("/")
+
+# One pooled session (keep-alive) and fetch pool shared by every GitHubService
+# instance in the process. Auth headers are passed per request since the PAT
+# can differ between requests.
+_session: Optional[requests.Session] = None
+_executor: Optional[ThreadPoolExecutor] = None
+_init_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    global _session
+    if _session is None:
+        with _init_lock:
+            if _session is None:
+                pool_size = int(os.getenv("GITHUB_POOL_SIZE", 20))
+                retry = Retry(
+                    total=int(os.getenv("GITHUB_MAX_RETRIES", 3)),
+                    backoff_factor=0.5,
+                    status_forcelist=(500, 502, 503, 504),
+                    allowed_methods=frozenset(["GET"]),
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+                logger.info(f"GitHub HTTP session created (pool size: {pool_size})")
+    return _session
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _init_lock:
+            if _executor is None:
+                workers = int(os.getenv("GITHUB_FETCH_WORKERS", 16))
+                _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="github-fetch")
+    return _executor
+
+
+@dataclass
+class RepoSnapshot:
+    file_tree: str
+    readme: str
+    default_branch: str
+    head_sha: Optional[str]
+    etag: Optional[str]
+    # The whole tree split by package, for repositories too large for one prompt
+    packages: Optional[PackageIndex] = None
+
+
+@dataclass
+class FileChange:
+    # "added", "removed", "modified" or "renamed"
+    status: str
+    path: str
+    previous_path: Optional[str] = None
+
+
+# The compare API lists at most this many files; a longer diff comes back cut short
+COMPARE_MAX_FILES = 300
+# GitHub's file statuses in the four FileChange ones
+_CHANGE_STATUS = {"added": "added", "copied": "added", "removed": "removed",
+                  "modified": "modified", "changed": "modified", "renamed": "renamed"}
+
+
 class GitHubService:
-    def __init__(self, pat: Optional[str] = None):
-        # Prioritize passed PAT, then env PAT
-        self.pat = pat or os.getenv("GITHUB_PAT")
+    def __init__(self, pat: Optional[str] = None, token_pool: Optional[TokenPool] = None):
+        # A PAT passed with the request wins over the configured token pool
+        self.pat = pat
+        self.token_pool = token_pool or get_token_pool()
+        self.timeout = float(os.getenv("GITHUB_TIMEOUT", 10))
+        # Rate-limited responses retried on another token (or after a reset)
+        self.rate_limit_retries = int(os.getenv("GITHUB_RATE_LIMIT_RETRIES", 2))
+        # Size of the file listing sent to the LLM
+        self.tree_max_tokens = int(os.getenv("TREE_MAX_TOKENS", 1500))
+        self.session = get_session()
         self.headers = {
             "Accept": "application/vnd.github.v3+json"
         }
         if self.pat:
-            self.headers["Authorization"] = f"token {self.pat}"
             logger.info("GitHubService initialized with PAT")
-        else:
+        elif not self.token_pool.states[0].token:
             logger.warning("GitHubService initialized WITHOUT PAT (Rate limits will be low)")
 
+    def _get(self, url: str, accept: Optional[str] = None, etag: Optional[str] = None,
+             stream: bool = False) -> requests.Response:
+        """
+        GET with a token from the pool. Rate-limited answers are retried on
+        the next usable token; RateLimitError is raised once none is left.
+        """
+        headers = dict(self.headers)
+        if accept:
+            headers["Accept"] = accept
+        if etag:
+            headers["If-None-Match"] = etag
+        for attempt in range(self.rate_limit_retries + 1):
+            state = self.token_pool.acquire(self.pat)
+            if state.token:
+                headers["Authorization"] = f"token {state.token}"
+            else:
+                headers.pop("Authorization", None)
+            try:
+                resp = self.session.get(url, headers=headers, timeout=self.timeout, stream=stream)
+            except Exception:
+                self.token_pool.update(state, 0, {})
+                raise
+            if not self.token_pool.update(state, resp.status_code, resp.headers):
+                return resp
+            resp.close()
+        raise RateLimitError("GitHub rate limit reached. Retry shortly.",
+                             max(1, int(self.token_pool.max_wait)))
+
+    def fetch_repo(self, username: str, repo: str, head_sha: Optional[str] = None,
+                   etag: Optional[str] = None) -> RepoSnapshot:
+        """
+        Fetches everything needed to build a prompt in one concurrent round-trip:
+        default branch, HEAD commit, file tree and README. Pass `head_sha`/`etag`
+        when the HEAD commit is already known to skip that request.
+        """
+        pool = _get_executor()
+        ref = head_sha or "HEAD"
+        branch_future = submit_traced(pool, self.get_default_branch, username, repo)
+        head_future = None if head_sha else submit_traced(pool, self.get_head_commit, username, repo)
+        packages = PackageIndex()
+        tree_future = submit_traced(pool, self.get_file_tree, username, repo, ref, packages)
+        readme_future = submit_traced(pool, self.get_readme, username, repo)
+
+        # Metadata first so a missing repo surfaces as the usual ValueError
+        default_branch = branch_future.result()
+        if head_future:
+            head_sha, etag = head_future.result()
+        file_tree, _ = tree_future.result()
+        readme = readme_future.result()
+        return RepoSnapshot(file_tree, readme, default_branch, head_sha, etag, packages)
+
     def get_default_branch(self, username: str, repo: str) -> str:
-        url = f"https://api.github.com/repos/{username}/{repo}"
+        url = f"{GITHUB_API_URL}/repos/{username}/{repo}"
         logger.debug(f"Fetching default branch from: {url}")
-        resp = requests.get(url, headers=self.headers)
+        resp = self._get(url)
         logger.debug(f"Default branch response status: {resp.status_code}")
-        
+
         if resp.status_code == 200:
             branch = resp.json().get("default_branch", "main")
             logger.info(f"Default branch for {username}/{repo} is '{branch}'")
@@ -32,66 +166,125 @@ class GitHubService:
         if resp.status_code == 404:
             logger.error(f"Repository not found: {username}/{repo}")
             raise ValueError("Repository not found (or private and no valid PAT provided).")
-        
+
         logger.error(f"GitHub API Error for {username}/{repo}: {resp.status_code}")
         raise Exception(f"GitHub API Error: {resp.status_code}")
 
-    def get_file_tree(self, username: str, repo: str) -> Tuple[str, str]:
-        branch = self.get_default_branch(username, repo)
-        url = f"https://api.github.com/repos/{username}/{repo}/git/trees/{branch}?recursive=1"
+    def get_head_commit(self, username: str, repo: str, etag: Optional[str] = None) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Returns (commit_sha, etag) for the HEAD of the default branch.
+        When `etag` is given the request is conditional; a 304 answer (which does
+        not count against the rate limit) is returned as (None, etag).
+        """
+        url = f"{GITHUB_API_URL}/repos/{username}/{repo}/commits/HEAD"
+        logger.debug(f"Fetching HEAD commit from: {url} (conditional: {bool(etag)})")
+        resp = self._get(url, accept="application/vnd.github.sha", etag=etag)
+
+        if resp.status_code == 304:
+            logger.info(f"HEAD of {username}/{repo} unchanged (304 Not Modified)")
+            return None, etag
+        if resp.status_code == 200:
+            sha = resp.text.strip()
+            logger.info(f"HEAD of {username}/{repo} is {sha[:12]}")
+            return sha, resp.headers.get("ETag")
+        if resp.status_code == 404:
+            logger.error(f"Repository not found: {username}/{repo}")
+            raise ValueError("Repository not found (or private and no valid PAT provided).")
+
+        logger.error(f"GitHub API Error fetching HEAD for {username}/{repo}: {resp.status_code}")
+        raise Exception(f"GitHub API Error: {resp.status_code}")
+
+    def list_repos(self, owner: str, include_forks: bool = False, include_archived: bool = False) -> List[str]:
+        """Names of the repositories of an organization (or, failing that, a user) visible to the token."""
+        url = f"{GITHUB_API_URL}/orgs/{owner}/repos?per_page=100&type=all"
+        resp = self._get(url)
+        if resp.status_code == 404:
+            url = f"{GITHUB_API_URL}/users/{owner}/repos?per_page=100&type=owner"
+            resp = self._get(url)
+        names = []
+        while True:
+            if resp.status_code == 404:
+                logger.error(f"Organization or user not found: {owner}")
+                raise ValueError(f"No organization or user named {owner}.")
+            if resp.status_code != 200:
+                logger.error(f"GitHub API Error listing repositories of {owner}: {resp.status_code}")
+                raise Exception(f"GitHub API Error: {resp.status_code}")
+            names += [r["name"] for r in resp.json()
+                      if (include_forks or not r.get("fork")) and (include_archived or not r.get("archived"))]
+            next_url = resp.links.get("next", {}).get("url")
+            if not next_url:
+                break
+            resp = self._get(next_url)
+        logger.info(f"Found {len(names)} repositories of {owner}")
+        return names
+
+    def compare_commits(self, username: str, repo: str, base_sha: str, head_sha: str) -> Optional[List[FileChange]]:
+        """
+        Files changed from `base_sha` to `head_sha`, from one compare API call.
+        Returns None when GitHub can't give a complete answer: `base_sha` is
+        gone or was force-pushed away from, or the diff is too large to list.
+        """
+        url = f"{GITHUB_API_URL}/repos/{username}/{repo}/compare/{base_sha}...{head_sha}"
+        logger.debug(f"Comparing commits: {url}")
+        resp = self._get(url)
+        if resp.status_code != 200:
+            logger.info(f"Compare {base_sha[:12]}...{head_sha[:12]} unavailable for {username}/{repo} "
+                        f"(Status: {resp.status_code})")
+            return None
+
+        data = resp.json()
+        files = data.get("files") or []
+        if data.get("status") not in ("ahead", "identical"):
+            # Diverged history: the diff would start from the merge base, not from base_sha
+            logger.info(f"{username}/{repo} is {data.get('status')} of {base_sha[:12]}, not comparable")
+            return None
+        if len(files) >= COMPARE_MAX_FILES:
+            logger.info(f"Compare {base_sha[:12]}...{head_sha[:12]} for {username}/{repo} lists "
+                        f"{len(files)}+ files, too many")
+            return None
+        changes = [FileChange(_CHANGE_STATUS[f["status"]], f["filename"], f.get("previous_filename"))
+                   for f in files if f.get("status") in _CHANGE_STATUS]
+        logger.info(f"{len(changes)} files changed in {username}/{repo} over "
+                    f"{data.get('total_commits', 0)} commits since {base_sha[:12]}")
+        return changes
+
+    def get_file_tree(self, username: str, repo: str, ref: Optional[str] = None,
+                      packages: Optional[PackageIndex] = None) -> Tuple[str, str]:
+        """
+        Returns (file_tree, ref). Without `ref` the default branch is looked up
+        first; pass a commit SHA or "HEAD" to skip that round-trip. Fills
+        `packages` from the same listing when given.
+        """
+        branch = ref or self.get_default_branch(username, repo)
+        url = f"{GITHUB_API_URL}/repos/{username}/{repo}/git/trees/{branch}?recursive=1"
         logger.debug(f"Fetching file tree from: {url}")
-        resp = requests.get(url, headers=self.headers)
-        
+        resp = self._get(url, stream=True)
+
+        if resp.status_code == 404 and ref:
+            logger.error(f"Repository or ref not found: {username}/{repo}@{ref}")
+            raise ValueError("Repository not found (or private and no valid PAT provided).")
         if resp.status_code != 200:
             logger.error(f"Failed to fetch file tree. Status: {resp.status_code}")
             raise Exception(f"Failed to fetch file tree: {resp.status_code}")
-            
-        data = resp.json()
-        if "tree" not in data:
-            logger.warning("No 'tree' found in response data")
-            return ""
-
-        files = []
-        MAX_FILES = 80 # Limit to prevent context overflow for local LLMs
-        for item in data["tree"]:
-            if len(files) >= MAX_FILES:
-                logger.warning(f"File limit ({MAX_FILES}) reached. Truncating tree.")
-                files.append(f"... (truncated, {len(data['tree']) - MAX_FILES} more files) ...")
-                break
-                
-            path = item["path"]
-            if self._should_include(path):
-                files.append(path)
-        
-        logger.info(f"Found {len(files)} files in repository")
-        return "\n".join(files), branch # Return tuple
+
+        # Parsed as it streams in: huge monorepo listings never sit in memory whole
+        file_tree, included = build_file_tree(resp.iter_content(chunk_size=65536), self.tree_max_tokens, packages)
+        logger.info(f"Found {included} files in repository")
+        return file_tree, branch # Return tuple
 
     def get_readme(self, username: str, repo: str) -> str:
-        url = f"https://api.github.com/repos/{username}/{repo}/readme"
+        url = f"{GITHUB_API_URL}/repos/{username}/{repo}/readme"
         logger.debug(f"Fetching README from: {url}")
-        resp = requests.get(url, headers=self.headers)
+        # The raw media type returns the file content directly, saving the
+        # second request to download_url.
+        resp = self._get(url, accept="application/vnd.github.raw")
         if resp.status_code == 200:
-            download_url = resp.json().get("download_url")
-            if download_url:
-                logger.debug(f"Downloading README content from: {download_url}")
-                content_resp = requests.get(download_url)
-                logger.info("README fetched successfully")
-                content = content_resp.text
-                # Truncate README if too long (e.g. > 15000 chars)
-                if len(content) > 15000:
-                    logger.warning("README too long, truncating to 15000 chars")
-                    content = content[:15000] + "\n... (truncated) ..."
-                return content
-        
+            logger.info("README fetched successfully")
+            # Trimmed to the token budget by PromptBuilder
+            return resp.text
+
         logger.warning(f"README not found or inaccessible (Status: {resp.status_code})")
         return ""
 
     def _should_include(self, path: str) -> bool:
-        excluded = [
-            "node_modules/", "vendor/", "venv/", "__pycache__/", ".git/",
-            ".jpg", ".png", ".gif", ".ico", ".svg", ".lock", ".min.js", ".map",
-            ".css", ".scss", ".less", ".json", ".xml", ".yaml", ".yml", # detailed configs
-            "test/", "tests/", "spec/", "docs/", "examples/" # non-essential folders
-        ]
-        path_lower = path.lower()
-        return not any(ex in path_lower for ex in excluded)
+        return should_include(path)
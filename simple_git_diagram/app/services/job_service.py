@@ -0,0 +1,111 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+from .llm_service import LLMError
+from .token_pool import RateLimitError
+from app.utils.tracing import bind_request_id, current_request_id, stage_summary, submit_traced
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when the job queue has no room for another job."""
+
+
+class JobQueue:
+    """
+    Bounded worker pool for long-running diagram generations.
+
+    Jobs live in process memory, so with several server processes a client has
+    to poll the same process that accepted the job (sticky sessions, or a
+    single process with JOB_WORKERS threads).
+    """
+
+    def __init__(self, workers: Optional[int] = None, max_pending: Optional[int] = None,
+                 result_ttl: Optional[int] = None):
+        self.workers = workers if workers is not None else int(os.getenv("JOB_WORKERS", 4))
+        if self.workers < 1:
+            # Unlike the queue size, at least one worker is needed for jobs to ever run
+            logger.warning(f"JOB_WORKERS={self.workers} is not allowed, using 1 worker")
+            self.workers = 1
+        # Jobs queued or running; submissions beyond this are rejected
+        self.max_pending = max_pending if max_pending is not None else int(os.getenv("JOB_QUEUE_SIZE", 32))
+        # Seconds a finished job's result stays available for polling
+        self.result_ttl = result_ttl if result_ttl is not None else int(os.getenv("JOB_RESULT_TTL", 600))
+
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="diagram-job")
+        self._jobs: Dict[str, dict] = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        logger.info(f"JobQueue initialized with {self.workers} workers, queue size {self.max_pending}")
+
+    def submit(self, fn: Callable[[], dict]) -> dict:
+        """Queues `fn` and returns the job record. Raises QueueFullError when saturated."""
+        with self._lock:
+            self._expire()
+            if self._pending >= self.max_pending:
+                logger.warning(f"Job queue full ({self._pending}/{self.max_pending})")
+                raise QueueFullError("Server is busy, please retry shortly.")
+            self._pending += 1
+            job = {"id": uuid.uuid4().hex, "status": "queued", "created": time.time()}
+            self._jobs[job["id"]] = job
+
+        # The job's log lines keep the id of the request that queued it
+        submit_traced(self._executor, self._run, job, fn)
+        logger.info(f"Job {job['id']} queued")
+        return dict(job)
+
+    def complete(self, result: dict) -> dict:
+        """Records an already-available result (e.g. a cache hit) as a finished job."""
+        job = {"id": uuid.uuid4().hex, "status": "done", "result": result,
+               "created": time.time(), "finished": time.time()}
+        with self._lock:
+            self._expire()
+            self._jobs[job["id"]] = job
+        return dict(job)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def _run(self, job: dict, fn: Callable[[], dict]):
+        # Same request id, but stage timings of its own (the request has already been answered)
+        with bind_request_id(current_request_id()):
+            self._execute(job, fn)
+
+    def _execute(self, job: dict, fn: Callable[[], dict]):
+        job["status"] = "running"
+        try:
+            job["result"] = fn()
+            job["status"] = "done"
+            logger.info(f"Job {job['id']} finished in {time.time() - job['created']:.1f}s{stage_summary()}")
+        except ValueError as e:
+            job.update(status="failed", error=str(e), status_code=404)
+            logger.warning(f"Job {job['id']} failed: {e}")
+        except RateLimitError as e:
+            job.update(status="failed", error=str(e), status_code=429, retry_after=e.retry_after)
+            logger.warning(f"Job {job['id']} failed: {e}")
+        except LLMError as e:
+            job.update(status="failed", error=f"Error generating diagram: {e}", status_code=e.status_code)
+            logger.error(f"Job {job['id']} failed: {e}")
+        except Exception as e:
+            job.update(status="failed", error=f"Internal Error: {str(e)}", status_code=500)
+            logger.error(f"Job {job['id']} failed: {e}", exc_info=True)
+        finally:
+            job["finished"] = time.time()
+            with self._lock:
+                self._pending -= 1
+
+    def _expire(self):
+        cutoff = time.time() - self.result_ttl
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.get("finished") and job["finished"] < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
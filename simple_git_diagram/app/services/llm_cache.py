@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Optional, Sequence, Tuple
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Next to gitdiagram.db in Flask's instance folder
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                            "instance", "llm_cache.db")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS llm_response (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    response BLOB NOT NULL,
+    bytes INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used_at REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS ix_llm_response_lru ON llm_response (last_used_at);
+"""
+
+
+def prompt_key(model: str, system_prompt: str, user_content: str, temperature: float, max_tokens: int) -> str:
+    """Content address of one completion request; any change to the prompt text gives a new key."""
+    payload = json.dumps([model, system_prompt, user_content, temperature, max_tokens], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def generalize(response: str, aliases: Sequence[Tuple[str, str]]) -> str:
+    """A response as stored: the repository's names (first of each pair) replaced by placeholders."""
+    for name, placeholder in aliases:
+        response = response.replace(name, placeholder)
+    return response
+
+
+def specialize(response: str, aliases: Sequence[Tuple[str, str]]) -> str:
+    """A stored response for the repository described by `aliases`."""
+    for name, placeholder in aliases:
+        response = response.replace(placeholder, name)
+    return response
+
+
+class LLMResponseCache:
+    """
+    Completions by prompt_key(), persisted in a SQLite file of their own
+    (LLM_CACHE_PATH) so LLM calls off the request thread can use it without
+    an application context, and shared by every worker process.
+
+    Entries are zlib-compressed. Once they take more than
+    LLM_CACHE_MAX_BYTES the least recently used are dropped, as are entries
+    unused for LLM_CACHE_TTL seconds; edited prompts simply stop being hit
+    and age out. LLM_CACHE_MAX_BYTES=0 disables the cache. Database errors
+    are logged and treated as misses: the cache never fails a call.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.getenv("LLM_CACHE_PATH") or DEFAULT_PATH
+        self.max_bytes = int(os.getenv("LLM_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+        self.ttl = int(os.getenv("LLM_CACHE_TTL", 30 * 24 * 3600))
+        # Eviction runs after writes, at most once per interval per process
+        self.interval = int(os.getenv("LLM_CACHE_EVICT_INTERVAL", 60))
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._last_evict = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evicted = 0
+        self.errors = 0
+        if self.enabled:
+            logger.info(f"LLM response cache at {self.path} (max {self.max_bytes} bytes)")
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, keys: Sequence[str]) -> Optional[str]:
+        """The response stored under the first of `keys` that has one (one lookup for the metrics)."""
+        if not self.enabled or not keys:
+            return None
+        try:
+            conn = self._connect()
+            found = dict(conn.execute(f"SELECT key, response FROM llm_response WHERE key IN "
+                                      f"({', '.join('?' * len(keys))})", list(keys)).fetchall())
+            key = next((k for k in keys if k in found), None)
+            if key:
+                conn.execute("UPDATE llm_response SET last_used_at = ?, hits = hits + 1 WHERE key = ?",
+                             (time.time(), key))
+                conn.commit()
+        except sqlite3.Error as e:
+            self._failed("read", e)
+            return None
+        with self._lock:
+            if key is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return zlib.decompress(found[key]).decode("utf-8")
+
+    def put(self, key: str, model: str, response: str):
+        if not self.enabled or not response:
+            return
+        data = zlib.compress(response.encode("utf-8"), 6)
+        if len(data) > self.max_bytes:
+            return
+        now = time.time()
+        try:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO llm_response (key, model, response, bytes, created_at, last_used_at) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", (key, model, data, len(data), now, now))
+            conn.commit()
+        except sqlite3.Error as e:
+            self._failed("write", e)
+            return
+        with self._lock:
+            self.stores += 1
+        self.maybe_evict()
+
+    def delete(self, keys: Sequence[str]) -> int:
+        """Drops the responses stored under `keys`, e.g. answers that turned out to be unusable."""
+        if not self.enabled or not keys:
+            return 0
+        try:
+            conn = self._connect()
+            deleted = conn.execute(f"DELETE FROM llm_response WHERE key IN ({', '.join('?' * len(keys))})",
+                                   list(keys)).rowcount
+            conn.commit()
+        except sqlite3.Error as e:
+            self._failed("delete", e)
+            return 0
+        return deleted
+
+    def maybe_evict(self):
+        with self._lock:
+            if time.monotonic() - self._last_evict < self.interval:
+                return
+            self._last_evict = time.monotonic()
+        try:
+            self.evict()
+        except sqlite3.Error as e:
+            self._failed("evict", e)
+
+    def evict(self) -> int:
+        conn = self._connect()
+        deleted = 0
+        if self.ttl > 0:
+            deleted += conn.execute("DELETE FROM llm_response WHERE last_used_at < ?",
+                                    (time.time() - self.ttl,)).rowcount
+        total = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM llm_response").fetchone()[0]
+        excess = total - self.max_bytes
+        if excess > 0:
+            # Oldest first until enough bytes are freed; the running sum picks the cut-off row
+            cutoff = conn.execute(
+                "SELECT last_used_at FROM (SELECT last_used_at, SUM(bytes) OVER (ORDER BY last_used_at, key) AS freed "
+                "FROM llm_response) WHERE freed >= ? ORDER BY last_used_at LIMIT 1", (excess,)).fetchone()
+            if cutoff is not None:
+                deleted += conn.execute("DELETE FROM llm_response WHERE last_used_at <= ?", cutoff).rowcount
+        conn.commit()
+        if deleted:
+            with self._lock:
+                self.evicted += deleted
+            logger.info(f"Evicted {deleted} cached LLM responses ({total} bytes before the size limit)")
+        return deleted
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=int(os.getenv("DB_BUSY_TIMEOUT_MS", 5000)) / 1000)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def _failed(self, operation: str, error: Exception):
+        with self._lock:
+            self.errors += 1
+        logger.warning(f"LLM response cache {operation} failed: {error}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {"enabled": self.enabled, "hits": self.hits, "misses": self.misses,
+                     "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                     "stores": self.stores, "evicted": self.evicted, "errors": self.errors,
+                     "max_bytes": self.max_bytes}
+        if self.enabled:
+            try:
+                entries, size = self._connect().execute(
+                    "SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM llm_response").fetchone()
+                stats.update(entries=entries, bytes=size)
+            except sqlite3.Error as e:
+                self._failed("stats", e)
+        return stats
@@ -1,48 +1,403 @@
 import os
-from openai import OpenAI
+import random
+import threading
+import time
+from typing import Any, Callable, Iterator, List, Optional, Sequence, Tuple
+
+from app.utils.circuit_breaker import CircuitBreaker
+from app.utils.file_tree import CHARS_PER_TOKEN
+from app.utils.metrics import LLM_TOKENS
+from .llm_cache import LLMResponseCache, generalize, prompt_key, specialize
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+
+class LLMError(Exception):
+    """An LLM call failed. `retryable` says whether trying again (or on another backend) may help."""
+    status_code = 502
+
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class LLMTimeoutError(LLMError):
+    """The call (or the whole request's deadline) ran out of time."""
+    status_code = 504
+
+
+class LLMUnavailableError(LLMError):
+    """No backend would take the call: circuits open or every slot busy."""
+    status_code = 503
+
+
+class LLMBackend:
+    """One OpenAI-compatible endpoint with its own concurrency limit and circuit breaker."""
+
+    def __init__(self, base_url: str, model: str, api_key: str, timeout: float,
+                 max_concurrency: int, breaker: CircuitBreaker):
+        self.base_url = base_url
+        self.model = model
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.api_key = api_key or "dummy-key"
+        self._client = None
+        self._client_lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.breaker = breaker
+        self._lock = threading.Lock()
+        self.inflight = 0
+        self.calls = 0
+        self.failures = 0
+        self.retries = 0
+
+    @property
+    def name(self) -> str:
+        return f"{self.model}@{self.base_url}"
+
+    @property
+    def client(self):
+        """The SDK client, built on first use: importing openai alone takes about half a second."""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    from openai import OpenAI
+                    # Retries are ours (with backoff and fallback), not the SDK's
+                    self._client = OpenAI(base_url=self.base_url, api_key=self.api_key,
+                                          timeout=self.timeout, max_retries=0)
+        return self._client
+
+    def acquire(self, timeout: float) -> bool:
+        if not self.slots.acquire(timeout=max(0.0, timeout)):
+            return False
+        with self._lock:
+            self.inflight += 1
+            self.calls += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self.inflight -= 1
+        self.slots.release()
+
+    def stats(self) -> dict:
+        return {"base_url": self.base_url, "model": self.model, "inflight": self.inflight,
+                "max_concurrency": self.max_concurrency, "calls": self.calls,
+                "failures": self.failures, "retries": self.retries, "circuit": self.breaker.stats()}
+
+
+def _parse_fallbacks(spec: str, default_key: str) -> List[Tuple[str, str, str]]:
+    """LLM_FALLBACKS: comma-separated "base_url|model" or "base_url|model|api_key" entries."""
+    fallbacks = []
+    for entry in spec.split(","):
+        parts = [p.strip() for p in entry.split("|")]
+        if len(parts) < 2 or not parts[0] or not parts[1]:
+            if entry.strip():
+                logger.warning(f"Ignoring malformed LLM_FALLBACKS entry: {entry.strip()}")
+            continue
+        fallbacks.append((parts[0], parts[1], parts[2] if len(parts) > 2 and parts[2] else default_key))
+    return fallbacks
+
+
 class LLMService:
+    """
+    Chat completions with bounded waiting. Each backend (LLM_BASE_URL /
+    LLM_MODEL_NAME first, then LLM_FALLBACKS in order) allows at most
+    LLM_MAX_CONCURRENCY calls at once and is skipped while its circuit is
+    open. Timeouts, connection errors, 429 and 5xx are retried with
+    exponential backoff before falling back to the next backend, all within
+    LLM_DEADLINE seconds per call. Failures raise LLMError subclasses.
+
+    Completions are cached by a hash of (model, prompts, temperature, max
+    tokens), so an identical prompt is answered without inference (see
+    LLMResponseCache). Diagram prompts are hashed with the repository's
+    name and links replaced by placeholders (Prompt.cache_key), and the
+    answer is stored the same way and filled in for whoever asks: a fork
+    or a renamed repository with the same files and README gets the
+    upstream's diagram, pointing at its own URLs. Empty
+    and truncated completions are not cached, and callers forget() answers
+    they reject, so a bad answer isn't replayed to every later request.
+    """
+
     def __init__(self):
         self.base_url = os.getenv("LLM_BASE_URL", "https://api.openai.com/v1")
         self.api_key = os.getenv("LLM_API_KEY") or "dummy-key"  # Handle empty string
         self.model = os.getenv("LLM_MODEL_NAME", "gpt-3.5-turbo")
-        
-        logger.info(f"LLMService initialized with URL: {self.base_url}, Model: {self.model}")
-        
-        self.client = OpenAI(
-            base_url=self.base_url,
-            api_key=self.api_key
-        )
-
-    def generate_diagram(self, system_prompt: str, user_content: str) -> str:
+        # Upper bound for the response; callers lower it to fit the context window
+        self.max_tokens = int(os.getenv("LLM_MAX_TOKENS", 8000))
+        self.temperature = float(os.getenv("LLM_TEMPERATURE", 0.2))
+        # Per attempt (for streams: longest silence between chunks) and per call, retries included
+        self.timeout = float(os.getenv("LLM_TIMEOUT", 120))
+        self.deadline = float(os.getenv("LLM_DEADLINE", 300))
+        self.max_retries = int(os.getenv("LLM_MAX_RETRIES", 2))
+        self.backoff = float(os.getenv("LLM_RETRY_BACKOFF", 1.0))
+        # How long a call may wait for a free slot before trying the next backend
+        self.queue_timeout = float(os.getenv("LLM_QUEUE_TIMEOUT", 30))
+
+        max_concurrency = int(os.getenv("LLM_MAX_CONCURRENCY", 4))
+        failures = int(os.getenv("LLM_CIRCUIT_FAILURES", 5))
+        reset = float(os.getenv("LLM_CIRCUIT_RESET", 30))
+        endpoints = [(self.base_url, self.model, self.api_key)]
+        endpoints += _parse_fallbacks(os.getenv("LLM_FALLBACKS", ""), self.api_key)
+        self.backends = [
+            LLMBackend(url, model, key, self.timeout, max_concurrency,
+                       CircuitBreaker(f"{model}@{url}", failures, reset))
+            for url, model, key in endpoints
+        ]
+        self.cache = LLMResponseCache()
+
+        logger.info(f"LLMService initialized with URL: {self.base_url}, Model: {self.model}"
+                    f"{f', fallbacks: {[b.name for b in self.backends[1:]]}' if len(self.backends) > 1 else ''}")
+
+    def generate_diagram(self, system_prompt: str, user_content: str, max_tokens: Optional[int] = None,
+                         use_cache: bool = True, cache_key: Optional[str] = None,
+                         aliases: Sequence[Tuple[str, str]] = ()) -> str:
         """
-        Generates a response from the LLM.
+        Generates a response from the LLM. Raises LLMError when every backend failed.
+        With use_cache=False the cache is not read (but still updated). A
+        `cache_key` (e.g. a git tree SHA) identifies the answer in the cache
+        in place of `user_content`. `aliases` are (name, placeholder) pairs
+        swapped in the answer as it's stored and back as it's replayed.
         """
-        try:
-            logger.info(f"Sending request to LLM. Prompt length: {len(user_content)} chars")
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_content}
-                ],
-                temperature=0.2,
-                max_tokens=8000, 
+        max_tokens = max_tokens or self.max_tokens
+        identity = cache_key or user_content
+        if use_cache:
+            cached = self._cached(system_prompt, identity, max_tokens)
+            if cached is not None:
+                return specialize(cached, aliases)
+
+        logger.info(f"Sending request to LLM. Prompt length: {len(user_content)} chars")
+        messages = self._messages(system_prompt, user_content)
+
+        def complete(backend: LLMBackend, timeout: float) -> Tuple[str, Any]:
+            response = backend.client.chat.completions.create(
+                model=backend.model,
+                messages=messages,
+                temperature=self.temperature,
+                max_tokens=max_tokens,
+                timeout=timeout,
             )
-            content = response.choices[0].message.content or ""
-            logger.info(f"Received LLM response. Length: {len(content)} chars")
-            return content
+            choice = response.choices[0]
+            return choice.message.content or "", choice.finish_reason, response.usage
+
+        (content, finish_reason, usage), backend = self._run(complete, time.monotonic() + self.deadline)
+        backend.release()
+        logger.info(f"Received LLM response from {backend.name}. Length: {len(content)} chars")
+        self._record_tokens(system_prompt, user_content, content, usage)
+        self._store(backend, system_prompt, identity, max_tokens, generalize(content, aliases), finish_reason)
+        return content
+
+    def stream_diagram(self, system_prompt: str, user_content: str, max_tokens: Optional[int] = None,
+                       use_cache: bool = True, cache_key: Optional[str] = None,
+                       aliases: Sequence[Tuple[str, str]] = ()) -> Iterator[str]:
+        """
+        Same as generate_diagram, but yields the response text as it arrives
+        (a cached response in one piece). Retries and fallbacks happen before
+        the first token; a failure after that raises LLMError from the iterator.
+        """
+        max_tokens = max_tokens or self.max_tokens
+        identity = cache_key or user_content
+        if use_cache:
+            cached = self._cached(system_prompt, identity, max_tokens)
+            if cached is not None:
+                yield specialize(cached, aliases)
+                return
+
+        logger.info(f"Streaming request to LLM. Prompt length: {len(user_content)} chars")
+        messages = self._messages(system_prompt, user_content)
+        deadline = time.monotonic() + self.deadline
+
+        def open_stream(backend: LLMBackend, timeout: float):
+            stream = backend.client.chat.completions.create(
+                model=backend.model,
+                messages=messages,
+                temperature=self.temperature,
+                max_tokens=max_tokens,
+                stream=True,
+                timeout=timeout,
+            )
+            # Wait for the first text here, where a failure can still fall back
+            chunks = iter(stream)
+            try:
+                for chunk in chunks:
+                    text = chunk.choices[0].delta.content if chunk.choices else None
+                    if text:
+                        return stream, chunks, text
+            except BaseException:
+                stream.close()
+                raise
+            return stream, chunks, ""
+
+        (stream, chunks, first), backend = self._run(open_stream, deadline)
+        parts = [first]
+        finish_reason = None
+        try:
+            if first:
+                yield first
+            for chunk in chunks:
+                if time.monotonic() > deadline:
+                    raise LLMTimeoutError(f"LLM stream from {backend.name} exceeded {self.deadline:.0f}s")
+                if not chunk.choices:
+                    continue
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+                text = chunk.choices[0].delta.content
+                if text:
+                    parts.append(text)
+                    yield text
+            content = "".join(parts)
+            logger.info(f"Finished LLM stream from {backend.name}. Length: {len(content)} chars")
+            self._record_tokens(system_prompt, user_content, content, None)
+            self._store(backend, system_prompt, identity, max_tokens, generalize(content, aliases), finish_reason)
         except Exception as e:
-            import traceback
-            import sys
-            error_msg = f"LLM Error: {e}"
-            logger.error(error_msg)
-            # Still write to stderr for immediate visibility in case logger fails
-            sys.stderr.write(f"{error_msg}\n")
-            sys.stderr.write(traceback.format_exc())
-            sys.stderr.flush()
-            return f"Error generating diagram (URL: {self.base_url}): {str(e)}"
+            error = self._classify(e, backend)
+            if error.retryable:
+                backend.failures += 1
+                backend.breaker.failure()
+            raise error from e
+        finally:
+            stream.close()
+            backend.release()
+
+    def _cached(self, system_prompt: str, user_content: str, max_tokens: int) -> Optional[str]:
+        """A stored response to this prompt from any configured backend, preferring the primary one."""
+        content = self.cache.get([self._key(backend.model, system_prompt, user_content, max_tokens)
+                                  for backend in self.backends])
+        if content is not None:
+            logger.info(f"LLM cache HIT. Length: {len(content)} chars")
+        return content
+
+    def forget(self, system_prompt: str, user_content: str, max_tokens: Optional[int] = None,
+               cache_key: Optional[str] = None):
+        """Drops the cached response to this prompt (from every backend), e.g. a diagram that failed validation."""
+        max_tokens = max_tokens or self.max_tokens
+        identity = cache_key or user_content
+        if self.cache.delete([self._key(backend.model, system_prompt, identity, max_tokens)
+                              for backend in self.backends]):
+            logger.info("Dropped a rejected response from the LLM cache")
+
+    def _store(self, backend: LLMBackend, system_prompt: str, user_content: str, max_tokens: int,
+               content: str, finish_reason: Optional[str]):
+        # A cut-off or empty answer is an accident of this call, not the answer to the prompt
+        if finish_reason == "length" or not content.strip():
+            logger.warning(f"Not caching {'truncated' if content.strip() else 'empty'} response from {backend.name}")
+            return
+        self.cache.put(self._key(backend.model, system_prompt, user_content, max_tokens), backend.model, content)
+
+    @staticmethod
+    def _record_tokens(system_prompt: str, user_content: str, content: str, usage):
+        """Token histograms from the API's usage report, or estimated from lengths (e.g. streams)."""
+        if usage is not None and getattr(usage, "prompt_tokens", None) is not None:
+            prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens or 0
+        else:
+            prompt_tokens = (len(system_prompt) + len(user_content)) // CHARS_PER_TOKEN
+            completion_tokens = len(content) // CHARS_PER_TOKEN
+        LLM_TOKENS.observe(prompt_tokens, kind="prompt")
+        LLM_TOKENS.observe(completion_tokens, kind="completion")
+
+    def _key(self, model: str, system_prompt: str, user_content: str, max_tokens: int) -> str:
+        return prompt_key(model, system_prompt, user_content, self.temperature, max_tokens)
+
+    def _run(self, fn: Callable[[LLMBackend, float], Any], deadline: float) -> Tuple[Any, LLMBackend]:
+        """
+        Calls fn(backend, timeout) on each backend in turn until one succeeds.
+        Returns (result, backend) with the backend's slot still held; the
+        caller must release it.
+        """
+        errors = []
+        for backend in self.backends:
+            if time.monotonic() >= deadline:
+                break
+            if backend.breaker.state == CircuitBreaker.OPEN:
+                errors.append(LLMUnavailableError(f"{backend.name}: circuit open"))
+                continue
+            try:
+                return self._attempt(backend, fn, deadline), backend
+            except LLMError as e:
+                errors.append(e)
+                if backend is not self.backends[-1]:
+                    logger.warning(f"LLM backend {backend.name} failed ({e}), falling back")
+
+        if not errors:
+            raise LLMTimeoutError(f"LLM deadline of {self.deadline:.0f}s exceeded")
+        # Report the most telling failure: a real error beats "circuit open"
+        error = next((e for e in errors if not isinstance(e, LLMUnavailableError)), errors[0])
+        logger.error(f"LLM Error: {error}")
+        raise error
+
+    def _attempt(self, backend: LLMBackend, fn: Callable[[LLMBackend, float], Any], deadline: float) -> Any:
+        """fn on one backend with retries and backoff. Returns holding the backend's slot."""
+        for attempt in range(self.max_retries + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise LLMTimeoutError(f"LLM deadline of {self.deadline:.0f}s exceeded")
+            if not backend.acquire(min(self.queue_timeout, remaining)):
+                raise LLMUnavailableError(f"{backend.name}: all {backend.max_concurrency} slots busy")
+            if not backend.breaker.allow():
+                backend.release()
+                raise LLMUnavailableError(f"{backend.name}: circuit open")
+
+            try:
+                result = fn(backend, min(self.timeout, deadline - time.monotonic()))
+            except Exception as e:
+                backend.release()
+                error = self._classify(e, backend)
+                if not error.retryable:
+                    # The backend answered; the request itself was refused
+                    backend.breaker.success()
+                    raise error from e
+                backend.failures += 1
+                backend.breaker.failure()
+                delay = self._backoff(attempt, e)
+                if attempt == self.max_retries or time.monotonic() + delay >= deadline:
+                    raise error from e
+                backend.retries += 1
+                logger.warning(f"LLM call to {backend.name} failed ({error}), retrying in {delay:.1f}s "
+                               f"({attempt + 1}/{self.max_retries})")
+                time.sleep(delay)
+                continue
+            backend.breaker.success()
+            return result
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        # Honour the server's Retry-After on 429/503
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return self.backoff * (2 ** attempt) * random.uniform(0.5, 1.0)
+
+    @staticmethod
+    def _classify(e: Exception, backend: LLMBackend) -> LLMError:
+        if isinstance(e, LLMError):
+            return e
+        import openai
+        if isinstance(e, openai.APITimeoutError):
+            return LLMTimeoutError(f"{backend.name} timed out")
+        if isinstance(e, openai.APIConnectionError):
+            return LLMError(f"Connection error reaching {backend.name}: {e}")
+        if isinstance(e, openai.APIStatusError):
+            retryable = e.status_code in (408, 409, 429) or e.status_code >= 500
+            return LLMError(f"{backend.name} returned {e.status_code}: {e.message}", retryable=retryable)
+        return LLMError(f"{backend.name} failed: {e}", retryable=False)
+
+    @staticmethod
+    def _messages(system_prompt: str, user_content: str) -> list:
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_content}
+        ]
+
+    def idle_slots(self) -> int:
+        """Free slots on the backend a call would go to now (0 when every circuit is open)."""
+        for backend in self.backends:
+            if backend.breaker.state != CircuitBreaker.OPEN:
+                return backend.max_concurrency - backend.inflight
+        return 0
+
+    def stats(self) -> dict:
+        return {"backends": [backend.stats() for backend in self.backends], "cache": self.cache.stats()}
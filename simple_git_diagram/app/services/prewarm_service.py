@@ -0,0 +1,219 @@
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple
+
+from .diagram_service import DIAGRAM_TYPES, DiagramRequest, DiagramService, parse_repo_url
+from .llm_service import LLMError
+from .token_pool import RateLimitError
+from app.utils.tracing import bind_request_id, new_request_id
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+Target = Tuple[str, str]  # (canonical_key, diagram_type)
+
+
+class RequestCounter:
+    """
+    Request frequency per (repo, diagram type) as an exponentially decaying
+    count with a half-life of `half_life` seconds, so yesterday's spike
+    fades. Keeps at most `max_keys` targets, dropping the least popular.
+    """
+
+    def __init__(self, half_life: float, max_keys: int):
+        self.half_life = half_life
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._scores: Dict[Target, Tuple[float, float]] = {}
+
+    def record(self, target: Target):
+        now = time.time()
+        with self._lock:
+            self._scores[target] = (self._score(target, now) + 1.0, now)
+            if len(self._scores) > self.max_keys:
+                # Amortised: drop the bottom tenth at once rather than one entry per request
+                ranked = sorted(self._scores, key=lambda t: self._score(t, now))
+                for victim in ranked[:max(1, self.max_keys // 10)]:
+                    del self._scores[victim]
+
+    def forget(self, canonical_key: str):
+        with self._lock:
+            for target in [t for t in self._scores if t[0] == canonical_key]:
+                del self._scores[target]
+
+    def top(self, n: int, min_score: float) -> List[Tuple[Target, float]]:
+        now = time.time()
+        with self._lock:
+            scored = [(t, self._score(t, now)) for t in self._scores]
+        # Rounded so two requests a moment apart still count as two
+        scored = [(t, s) for t, s in scored if round(s, 2) >= min_score]
+        return sorted(scored, key=lambda item: item[1], reverse=True)[:n]
+
+    def _score(self, target: Target, now: float) -> float:
+        score, updated_at = self._scores.get(target, (0.0, now))
+        return score * math.pow(0.5, (now - updated_at) / self.half_life)
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+
+class Prewarmer:
+    """
+    Keeps popular diagrams warm so visitors arriving through a README badge
+    or a shared link don't wait for a cold generation.
+
+    Every PREWARM_INTERVAL seconds the watchlist (PREWARM_REPOS, generated
+    as PREWARM_TYPES) and the PREWARM_TOP_N most requested (repo, type)
+    pairs are refreshed with force_refresh: a conditional HEAD check, which
+    costs no GitHub quota when the repo is unchanged, and a regeneration
+    only when the commit moved. At most PREWARM_CONCURRENCY refreshes run at
+    once, and one only starts while the LLM has a free slot, so user
+    requests always come first.
+
+    Off unless PREWARM_ENABLED=true. Request counts are per process; with
+    several server processes enable it in one of them.
+    """
+
+    def __init__(self, diagram_service: DiagramService):
+        self.diagram_service = diagram_service
+        self.enabled = os.getenv("PREWARM_ENABLED", "false").lower() == "true"
+        self.interval = float(os.getenv("PREWARM_INTERVAL", 900))
+        self.top_n = int(os.getenv("PREWARM_TOP_N", 20))
+        # Decayed request count a pair needs before it is kept warm
+        self.min_requests = float(os.getenv("PREWARM_MIN_REQUESTS", 2))
+        self.concurrency = max(1, int(os.getenv("PREWARM_CONCURRENCY", 1)))
+        self.watchlist = self._parse_watchlist(os.getenv("PREWARM_REPOS", ""), os.getenv("PREWARM_TYPES", "flowchart"))
+        self.counter = RequestCounter(half_life=float(os.getenv("PREWARM_HALF_LIFE", 24 * 3600)),
+                                      max_keys=int(os.getenv("PREWARM_TRACKED_KEYS", 10000)))
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.cycles = 0
+        self.checked = 0
+        self.regenerated = 0
+        self.failed = 0
+        self.last_run: Optional[float] = None
+        self.last_duration: Optional[float] = None
+
+    @staticmethod
+    def _parse_watchlist(repos: str, types: str) -> List[Target]:
+        diagram_types = [t.strip() for t in types.split(",") if t.strip() in DIAGRAM_TYPES] or ['flowchart']
+        targets = []
+        for entry in repos.split(","):
+            if not entry.strip():
+                continue
+            try:
+                username, repo = parse_repo_url(entry.strip())
+            except IndexError:
+                logger.warning(f"Ignoring malformed PREWARM_REPOS entry: {entry.strip()}")
+                continue
+            targets += [(f"{username}/{repo}".lower(), t) for t in diagram_types]
+        return list(dict.fromkeys(targets))
+
+    def record(self, req: DiagramRequest):
+        """Counts a user request. Requests with their own PAT may be for private repos and are skipped."""
+        if req.pat:
+            return
+        for diagram_type in req.diagram_types or (req.diagram_type,):
+            self.counter.record((req.canonical_key, diagram_type))
+
+    def start(self, app):
+        if not self.enabled or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, args=(app,), name="prewarm", daemon=True)
+        self._thread.start()
+        logger.info(f"Pre-warming every {self.interval:.0f}s: {len(self.watchlist)} watched, "
+                    f"top {self.top_n} popular, {self.concurrency} at a time")
+
+    def stop(self):
+        self._stop.set()
+
+    def targets(self) -> List[Target]:
+        """Watchlist first, then the most requested pairs."""
+        popular = [target for target, _ in self.counter.top(self.top_n, self.min_requests)]
+        return list(dict.fromkeys(self.watchlist + popular))
+
+    def _loop(self, app):
+        while not self._stop.is_set():
+            try:
+                self.run_once(app)
+            except Exception as e:
+                logger.error(f"Pre-warm cycle failed: {e}", exc_info=True)
+            self._stop.wait(self.interval)
+
+    def run_once(self, app) -> int:
+        """One refresh of every target. Returns the number of diagrams regenerated."""
+        targets = self.targets()
+        if not targets:
+            return 0
+        started = time.monotonic()
+        regenerated = self.regenerated
+        rate_limited = threading.Event()
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="prewarm") as pool:
+            wait([pool.submit(self._refresh, app, target, rate_limited) for target in targets])
+        self.cycles += 1
+        self.last_run = time.time()
+        self.last_duration = time.monotonic() - started
+        regenerated = self.regenerated - regenerated
+        logger.info(f"Pre-warm cycle checked {len(targets)} diagrams, regenerated {regenerated} "
+                    f"in {self.last_duration:.1f}s")
+        return regenerated
+
+    def _refresh(self, app, target: Target, rate_limited: threading.Event):
+        if self._stop.is_set() or rate_limited.is_set() or not self._wait_for_llm():
+            return
+        canonical_key, diagram_type = target
+        username, repo = canonical_key.split("/", 1)
+        req = DiagramRequest(username=username, repo=repo, diagram_type=diagram_type, force_refresh=True,
+                             background=True)
+        try:
+            with bind_request_id(f"prewarm-{new_request_id()}"), app.app_context():
+                result = self.diagram_service.generate(req)
+        except RateLimitError as e:
+            # Leave the remaining quota to users until the next cycle
+            rate_limited.set()
+            logger.warning(f"Pre-warm paused, GitHub quota exhausted: {e}")
+            return
+        except ValueError as e:
+            self.failed += 1
+            self.counter.forget(canonical_key)
+            logger.warning(f"Pre-warm of {canonical_key} failed, no longer tracked: {e}")
+            return
+        except LLMError as e:
+            self.failed += 1
+            logger.warning(f"Pre-warm of {canonical_key} ({diagram_type}) failed: {e}")
+            return
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Pre-warm of {canonical_key} ({diagram_type}) failed: {e}", exc_info=True)
+            return
+        self.checked += 1
+        if not result.get("cached"):
+            self.regenerated += 1
+            logger.info(f"Pre-warmed {canonical_key} ({diagram_type})")
+
+    def _wait_for_llm(self) -> bool:
+        """Blocks until the LLM has a slot no user request is using; False when stopping."""
+        while self.diagram_service.llm_service.idle_slots() <= 0:
+            if self._stop.wait(1.0):
+                return False
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "running": self._thread is not None and self._thread.is_alive(),
+            "watchlist": len(self.watchlist),
+            "tracked": len(self.counter),
+            "popular": [{"repo": key, "diagram_type": t, "score": round(score, 2)}
+                        for (key, t), score in self.counter.top(self.top_n, self.min_requests)],
+            "cycles": self.cycles,
+            "checked": self.checked,
+            "regenerated": self.regenerated,
+            "failed": self.failed,
+            "last_run": self.last_run,
+            "last_duration": round(self.last_duration, 1) if self.last_duration is not None else None,
+        }
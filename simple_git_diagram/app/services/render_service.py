@@ -0,0 +1,106 @@
+import hashlib
+import os
+import re
+import shlex
+import subprocess
+import tempfile
+import threading
+from typing import Optional
+
+from app.utils.lru_cache import LRUCache
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+RENDER_FORMATS = ("svg", "png")
+MIMETYPES = {"svg": "image/svg+xml", "png": "image/png"}
+
+# mermaid-cli reports grammar problems as "Parse error on line N" / "Syntax error ..."
+_SYNTAX_ERROR = re.compile(r"(?:Parse|Syntax|Lexical) error.*", re.I | re.S)
+
+
+class MermaidRenderError(Exception):
+    """The renderer failed for a reason other than the diagram (missing binary, timeout, crash)."""
+
+
+class MermaidSyntaxError(ValueError):
+    """The renderer rejected the diagram itself; the message is the parser's error."""
+
+
+def content_hash(diagram: str) -> str:
+    return hashlib.sha256(diagram.encode("utf-8")).hexdigest()
+
+
+class MermaidRenderer:
+    """
+    Renders diagrams to SVG/PNG by running MERMAID_RENDER_CMD, e.g.
+    "mmdc -i {input} -o {output} -c mermaid.config.json -b transparent"
+    (mermaid-cli). {input} is a .mmd file and {output} a path ending in .svg
+    or .png. Without the setting, server-side rendering is disabled.
+
+    Renders are cached in memory by content hash, and at most
+    MERMAID_RENDER_CONCURRENCY run at once since each one starts a headless
+    browser.
+    """
+
+    def __init__(self):
+        self.command = os.getenv("MERMAID_RENDER_CMD", "").strip()
+        self.timeout = int(os.getenv("MERMAID_RENDER_TIMEOUT", 30))
+        self._slots = threading.Semaphore(int(os.getenv("MERMAID_RENDER_CONCURRENCY", 2)))
+        self.rendered = LRUCache(int(os.getenv("MERMAID_RENDER_CACHE_SIZE", 64)),
+                                 ttl=600, max_bytes=32 * 1024 * 1024, sizeof=len)
+        self.renders = 0
+        self.failures = 0
+        if self.command:
+            logger.info(f"Server-side Mermaid rendering enabled: {self.command}")
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.command)
+
+    def render(self, diagram: str, fmt: str = "svg") -> bytes:
+        """
+        Returns the rendered diagram. Raises MermaidSyntaxError when the
+        renderer rejects the diagram and MermaidRenderError for any other failure.
+        """
+        if fmt not in RENDER_FORMATS:
+            raise ValueError(f"Unsupported format: {fmt}")
+        if not self.enabled:
+            raise MermaidRenderError("Server-side rendering is not configured (MERMAID_RENDER_CMD)")
+
+        key = (content_hash(diagram), fmt)
+        data = self.rendered.get(key)
+        if data is not None:
+            return data
+
+        with self._slots, tempfile.TemporaryDirectory(prefix="mermaid-") as tmp:
+            source = os.path.join(tmp, "diagram.mmd")
+            target = os.path.join(tmp, f"diagram.{fmt}")
+            with open(source, "w", encoding="utf-8") as f:
+                f.write(diagram)
+            args = [arg.format(input=source, output=target) for arg in shlex.split(self.command)]
+            try:
+                proc = subprocess.run(args, capture_output=True, timeout=self.timeout)
+            except (OSError, subprocess.TimeoutExpired) as e:
+                self.failures += 1
+                raise MermaidRenderError(f"Renderer failed: {e}") from e
+
+            output = (proc.stderr or b"").decode("utf-8", "replace") + (proc.stdout or b"").decode("utf-8", "replace")
+            if proc.returncode != 0 or not os.path.exists(target):
+                self.failures += 1
+                syntax = _SYNTAX_ERROR.search(output)
+                if syntax:
+                    raise MermaidSyntaxError(syntax.group(0).strip()[:1000])
+                raise MermaidRenderError(f"Renderer exited with {proc.returncode}: {output.strip()[-500:]}")
+            with open(target, "rb") as f:
+                data = f.read()
+
+        self.renders += 1
+        self.rendered.put(key, data)
+        logger.info(f"Rendered {fmt} ({len(data)} bytes)")
+        return data
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, "renders": self.renders, "failures": self.failures,
+                "cache": self.rendered.stats()}
@@ -0,0 +1,237 @@
+import hashlib
+import os
+import threading
+import time
+from typing import List, Mapping, Optional
+
+from app.utils.lru_cache import LRUCache
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Hourly quotas GitHub grants before the first response tells us otherwise
+AUTHENTICATED_LIMIT = 5000
+ANONYMOUS_LIMIT = 60
+# Seconds past X-RateLimit-Reset before a window is assumed to have rolled over (clock skew)
+RESET_SKEW = 1.0
+
+
+class RateLimitError(Exception):
+    """Every usable token is out of quota for longer than we are willing to wait."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenState:
+    """Last known quota of one token, updated from every response's X-RateLimit-* headers."""
+
+    def __init__(self, token: Optional[str], label: str):
+        self.token = token
+        self.label = label
+        self.limit = AUTHENTICATED_LIMIT if token else ANONYMOUS_LIMIT
+        self.remaining = self.limit
+        # Epoch seconds when `remaining` goes back to `limit` (0 until a response says)
+        self.reset_at = 0.0
+        # Secondary rate limit (Retry-After); nothing is sent before this
+        self.blocked_until = 0.0
+        # Requests sent whose response hasn't been seen yet
+        self.inflight = 0
+        self.requests = 0
+        self.throttled = 0
+
+    def known(self) -> bool:
+        return self.reset_at > 0
+
+    def rolled_over(self, now: float) -> bool:
+        return self.known() and now >= self.reset_at + RESET_SKEW
+
+    def available_at(self, reserve: int, now: float) -> Optional[float]:
+        """
+        When this token may be used next (<= now means right away), or None
+        while its quota is unknown and the request that will tell is in flight.
+        """
+        if self.blocked_until > now:
+            return self.blocked_until
+        if not self.known():
+            return now if self.inflight == 0 else None
+        if self.remaining > reserve or self.rolled_over(now):
+            return now
+        return self.reset_at + RESET_SKEW
+
+    def stats(self, now: float) -> dict:
+        return {
+            "token": self.label,
+            "limit": self.limit,
+            "remaining": self.remaining,
+            "reset_in": max(0, round(self.reset_at - now)),
+            "blocked_for": max(0, round(self.blocked_until - now)),
+            "requests": self.requests,
+            "throttled": self.throttled,
+        }
+
+
+def _label(token: Optional[str], index: int) -> str:
+    if not token:
+        return "anonymous"
+    return f"token-{index} (...{token[-4:]})"
+
+
+class TokenPool:
+    """
+    Spreads GitHub requests over the configured tokens (GITHUB_PATS, comma
+    separated, plus GITHUB_PAT), always using the one with the most quota
+    left. Quotas come from the X-RateLimit-* headers of every response.
+
+    A token is skipped once it is down to GITHUB_QUOTA_RESERVE requests or
+    is under a secondary rate limit. When no token is usable, callers wait
+    for the earliest reset if that is at most GITHUB_RATE_LIMIT_MAX_WAIT
+    seconds away. Otherwise RateLimitError is raised so the request can be
+    answered with 429 and Retry-After instead of failing hard.
+
+    A PAT passed with the request is used on its own (it may be the only one
+    that can see a private repo), but its quota is tracked the same way.
+    """
+
+    def __init__(self, tokens: Optional[List[Optional[str]]] = None):
+        if tokens is None:
+            tokens = [t.strip() for t in os.getenv("GITHUB_PATS", "").split(",") if t.strip()]
+            single = os.getenv("GITHUB_PAT")
+            if single and single not in tokens:
+                tokens.append(single)
+        tokens = list(dict.fromkeys(tokens)) or [None]
+        self.states = [TokenState(token, _label(token, i)) for i, token in enumerate(tokens, start=1)]
+        self.reserve = int(os.getenv("GITHUB_QUOTA_RESERVE", 10))
+        self.max_wait = float(os.getenv("GITHUB_RATE_LIMIT_MAX_WAIT", 30))
+        # Quota of per-request PATs, keyed by hash so tokens never show up in keys or stats
+        self.user_states = LRUCache(1024, ttl=3600)
+        self._cond = threading.Condition()
+        self.waits = 0
+        self.rejected = 0
+        logger.info(f"GitHub token pool with {len(self.states)} token(s)"
+                    f"{'' if self.states[0].token else ' (anonymous: 60 requests/hour)'}")
+
+    def acquire(self, pat: Optional[str] = None) -> TokenState:
+        """
+        Reserves one request on the best token, waiting for a reset if needed.
+        Raises RateLimitError when the wait would exceed the limit.
+        """
+        candidates = [self._user_state(pat)] if pat else self.states
+        deadline = time.time() + self.max_wait
+        waited = False
+        with self._cond:
+            while True:
+                now = time.time()
+                times = [(s, s.available_at(self.reserve, now)) for s in candidates]
+                ready = [s for s, at in times if at is not None and at <= now]
+                if ready:
+                    state = max(ready, key=lambda s: s.limit if s.rolled_over(now) else s.remaining)
+                    if state.rolled_over(now):
+                        # Unknown again until the next response: one probe at a time
+                        state.remaining = state.limit
+                        state.reset_at = 0.0
+                    state.remaining -= 1
+                    state.inflight += 1
+                    state.requests += 1
+                    return state
+
+                # A token whose probe is in flight will know its quota within a request's time
+                probing = any(at is None for _, at in times)
+                pending = [at for _, at in times if at is not None]
+                next_at = now + 1.0 if probing or not pending else min(pending)
+                if next_at > deadline or (probing and now >= deadline):
+                    self.rejected += 1
+                    retry_after = max(1, int(next_at - now + 1))
+                    logger.warning(f"GitHub quota exhausted on {len(candidates)} token(s), "
+                                   f"next available in {retry_after}s")
+                    raise RateLimitError(f"GitHub rate limit reached. Retry in {retry_after} seconds.",
+                                         retry_after)
+                if not waited and pending:
+                    waited = True
+                    self.waits += 1
+                    logger.info(f"GitHub quota exhausted, waiting {next_at - now:.1f}s for a token")
+                # Woken early whenever a response reports a quota
+                self._cond.wait(timeout=min(next_at, deadline) - now)
+
+    def update(self, state: TokenState, status_code: int, headers: Mapping[str, str]) -> bool:
+        """
+        Records the quota reported by a response. Returns True if the request
+        was rate limited and should be retried (possibly on another token).
+        """
+        now = time.time()
+        limited = False
+        with self._cond:
+            state.inflight = max(0, state.inflight - 1)
+            resource = headers.get("X-RateLimit-Resource", "core")
+            if "X-RateLimit-Remaining" in headers and resource == "core":
+                try:
+                    limit = int(headers.get("X-RateLimit-Limit", state.limit))
+                    remaining = int(headers["X-RateLimit-Remaining"])
+                    reset_at = float(headers.get("X-RateLimit-Reset", state.reset_at))
+                except ValueError:
+                    pass
+                else:
+                    state.limit = limit
+                    if reset_at > state.reset_at:
+                        # New window: the server's count, less what is still in flight
+                        state.reset_at = reset_at
+                        state.remaining = remaining - state.inflight
+                    elif status_code == 304:
+                        # A 304 costs no quota: the slot acquire() took comes back (unless this
+                        # response is older than the count already known)
+                        state.remaining = min(state.remaining + 1, remaining - state.inflight)
+                    else:
+                        # Responses arrive out of order; the local count already includes in-flight requests
+                        state.remaining = min(state.remaining, remaining)
+
+            if status_code in (403, 429):
+                retry_after = headers.get("Retry-After")
+                if retry_after is not None:
+                    # Secondary (abuse) rate limit
+                    try:
+                        state.blocked_until = now + float(retry_after)
+                    except ValueError:
+                        state.blocked_until = now + 60
+                    limited = True
+                elif headers.get("X-RateLimit-Remaining") == "0":
+                    limited = True
+                if limited:
+                    state.throttled += 1
+                    logger.warning(f"GitHub rate limited {state.label} "
+                                   f"(remaining {state.remaining}, reset in {state.reset_at - now:.0f}s)")
+            self._cond.notify_all()
+        return limited
+
+    def _user_state(self, pat: str) -> TokenState:
+        key = hashlib.sha256(pat.encode("utf-8")).hexdigest()
+        state = self.user_states.get(key)
+        if state is None:
+            state = TokenState(pat, "request token")
+            self.user_states.put(key, state)
+        return state
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._cond:
+            return {
+                "tokens": [s.stats(now) for s in self.states],
+                "remaining": sum(s.limit if s.rolled_over(now) else s.remaining for s in self.states),
+                "request_tokens": self.user_states.stats()["size"],
+                "waits": self.waits,
+                "rejected": self.rejected,
+            }
+
+
+_pool: Optional[TokenPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_token_pool() -> TokenPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = TokenPool()
+    return _pool
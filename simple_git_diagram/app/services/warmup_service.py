@@ -0,0 +1,111 @@
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .. import db, pending_schema_changes
+from .diagram_service import DiagramService
+from .github_service import get_session
+from .token_pool import get_token_pool
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Warmup:
+    """
+    Brings a new worker process up to speed in the background, so it takes
+    connections as soon as the app is built: a pooled database connection
+    and a schema check, the LLM clients (importing openai is the slowest
+    part of a cold start), the tokenizer, the GitHub session and the page
+    template. GET /ready answers 503 until every step has succeeded.
+
+    A failed step, e.g. an unreachable database or a schema behind the code
+    because migrate.py hasn't run yet, is retried every WARMUP_RETRY_SECONDS.
+    Requests arriving before the worker is ready are served all the same and
+    initialize what they need themselves. The command-line tools, which
+    never serve /ready, turn it off with WARMUP_ENABLED=false.
+    """
+
+    def __init__(self, diagram_service: DiagramService):
+        self.diagram_service = diagram_service
+        self.enabled = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+        self.retry_seconds = float(os.getenv("WARMUP_RETRY_SECONDS", 5))
+        self.steps: Dict[str, dict] = {}
+        self.started_at: Optional[float] = None
+        self.ready_at: Optional[float] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def ready(self) -> bool:
+        # Turned off, there is nothing to wait for
+        return not self.enabled or self.ready_at is not None
+
+    def start(self, app):
+        if not self.enabled or self._thread is not None:
+            return
+        self.started_at = time.monotonic()
+        self._thread = threading.Thread(target=self.run, args=(app,), name="warmup", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self, app) -> bool:
+        """Runs the steps until all of them succeeded (True) or stop() was called (False)."""
+        steps = self._steps(app)
+        self.steps = {name: {"done": False} for name, _ in steps}
+        while True:
+            for name, step in steps:
+                if self.steps[name]["done"]:
+                    continue
+                started = time.perf_counter()
+                try:
+                    step()
+                except Exception as e:
+                    self.steps[name] = {"done": False, "error": str(e)}
+                    logger.warning(f"Warm-up step {name} failed, retrying in {self.retry_seconds:g}s: {e}")
+                    continue
+                self.steps[name] = {"done": True, "seconds": round(time.perf_counter() - started, 3)}
+            if all(step["done"] for step in self.steps.values()):
+                self.ready_at = time.monotonic()
+                logger.info(f"Worker ready {self.ready_at - (self.started_at or self.ready_at):.3f}s after start")
+                return True
+            if self._stop.wait(self.retry_seconds):
+                return False
+
+    def _steps(self, app) -> List[Tuple[str, Callable[[], None]]]:
+        def database():
+            with app.app_context():
+                db.session.execute(db.text("SELECT 1"))
+                pending = pending_schema_changes()
+            if pending:
+                raise RuntimeError(f"schema out of date ({', '.join(pending)}), run migrate.py")
+
+        def llm():
+            for backend in self.diagram_service.llm_service.backends:
+                backend.client
+
+        def tokenizer():
+            self.diagram_service.prompt_builder.counter.encoding
+
+        def github():
+            get_session()
+            get_token_pool()
+
+        def templates():
+            app.jinja_env.get_template("index.html")
+
+        return [("database", database), ("llm", llm), ("tokenizer", tokenizer),
+                ("github", github), ("templates", templates)]
+
+    def status(self) -> dict:
+        now = time.monotonic()
+        end = self.ready_at or now
+        return {
+            "ready": self.ready,
+            "seconds": round(end - self.started_at, 3) if self.started_at is not None else None,
+            "steps": dict(self.steps),
+        }
@@ -17,8 +17,19 @@ const mermaid = window.mermaid;
 // @ts-ignore - svgPanZoom is loaded externally
 const svgPanZoom = window.svgPanZoom;
 
+const JOB_POLL_INTERVAL_MS = 1500;
+const DEFAULT_LOADING_TEXT = "Analyzing repository... this may take a minute.";
+/** @type {Object<string, string>} */
+const STAGE_LABELS = {
+    cache: "Checking cache...",
+    fetch: "Fetching repository from GitHub...",
+    llm: "Waiting for the LLM...",
+    validate: "Checking diagram syntax..."
+};
+
 document.addEventListener('DOMContentLoaded', () => {
     let latestDiagramCode = ""; // Store raw code for export
+    let lastRenderFailed = false; // Bypass the SHA-validated cache when retrying a broken diagram
 
     mermaid.initialize({
         startOnLoad: false,
@@ -78,6 +89,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const patInput = /** @type {HTMLInputElement} */ (document.getElementById('githubPat'));
     const errorMsg = /** @type {HTMLDivElement} */ (document.getElementById('errorMsg'));
     const loading = /** @type {HTMLDivElement} */ (document.getElementById('loading'));
+    const loadingText = /** @type {HTMLParagraphElement} */ (document.getElementById('loadingText'));
     const diagramContainer = /** @type {HTMLDivElement} */ (document.getElementById('diagramContainer'));
     const mermaidDiv = /** @type {HTMLDivElement} */ (document.querySelector('.mermaid'));
     const exportButtons = /** @type {HTMLDivElement} */ (document.getElementById('exportButtons'));
@@ -87,7 +99,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const diagramTypeSelect = /** @type {HTMLSelectElement} */ (document.getElementById('diagramType'));
 
     if (!generateBtn || !regenerateBtn || !repoInput || !patInput || !errorMsg ||
-        !loading || !diagramContainer || !mermaidDiv || !exportButtons ||
+        !loading || !loadingText || !diagramContainer || !mermaidDiv || !exportButtons ||
         !exportSvgBtn || !exportPngBtn || !exportDrawioBtn || !diagramTypeSelect) {
         console.error('Required DOM elements not found');
         return;
@@ -116,27 +128,17 @@ document.addEventListener('DOMContentLoaded', () => {
         exportButtons.classList.add('hidden');
         generateBtn.disabled = true;
         mermaidDiv.innerHTML = ""; // Clear previous
+        loadingText.textContent = DEFAULT_LOADING_TEXT;
 
         try {
-            const response = await fetch('/generate', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({
-                    repo_url: repoUrl,
-                    pat: pat || null, // Ensure valid JSON null if empty
-                    force_refresh: forceRefresh,
-                    diagram_type: diagramType
-                })
+            const data = await streamGeneration({
+                repo_url: repoUrl,
+                pat: pat || null, // Ensure valid JSON null if empty
+                force_refresh: forceRefresh,
+                ignore_cache: forceRefresh && lastRenderFailed,
+                diagram_type: diagramType
             });
 
-            const data = await response.json();
-
-            if (!response.ok) {
-                throw new Error(data.error || "Failed to generate diagram");
-            }
-
             // Success
             loading.classList.add('hidden');
             diagramContainer.classList.remove('hidden');
@@ -145,11 +147,16 @@ document.addEventListener('DOMContentLoaded', () => {
             mermaidDiv.removeAttribute('data-processed');
             latestDiagramCode = data.diagram; // Store for export
             mermaidDiv.innerHTML = data.diagram;
+            lastRenderFailed = false;
 
             try {
-                await mermaid.run({
-                    nodes: [mermaidDiv]
-                });
+                // Server-rendered SVG skips parsing and layout in the browser
+                const prerendered = data.svg_url ? await loadPrerenderedSvg(data.svg_url) : false;
+                if (!prerendered) {
+                    await mermaid.run({
+                        nodes: [mermaidDiv]
+                    });
+                }
 
                 // Initialize SVG Pan Zoom
                 const svgElement = mermaidDiv.querySelector('svg');
@@ -180,6 +187,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
             } catch (err) {
                 console.error("Mermaid Render Error", err);
+                lastRenderFailed = true;
                 showError("Generated diagram has syntax errors. Try regenerating.");
                 mermaidDiv.innerHTML = `<pre class="bg-gray-100 p-4 rounded overflow-auto text-xs">${data.diagram}</pre>`; // Fallback to raw code
                 exportButtons.classList.add('hidden');
@@ -196,6 +204,132 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    /**
+     * Replaces the diagram source with the SVG rendered on the server.
+     * @param {string} svgUrl - GET /diagram/...?format=svg
+     * @returns {Promise<boolean>} false if it couldn't be loaded (render in the browser instead)
+     */
+    async function loadPrerenderedSvg(svgUrl) {
+        try {
+            const response = await fetch(svgUrl);
+            if (!response.ok) {
+                return false;
+            }
+            const svgText = await response.text();
+            if (!svgText.includes('<svg')) {
+                return false;
+            }
+            mermaidDiv.innerHTML = svgText;
+            mermaidDiv.setAttribute('data-processed', 'true');
+            return true;
+        } catch (err) {
+            console.warn("Pre-rendered SVG unavailable, rendering in the browser", err);
+            return false;
+        }
+    }
+
+    /**
+     * Streams a generation over Server-Sent Events, showing progress as the
+     * LLM writes. Falls back to job polling if the response can't be streamed.
+     * @param {Object} payload - Request body for POST /generate/stream
+     * @returns {Promise<{diagram: string, cached: boolean, svg_url?: string}>}
+     */
+    async function streamGeneration(payload) {
+        const response = await fetch('/generate/stream', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify(payload)
+        });
+
+        if (!response.ok) {
+            const data = await response.json();
+            throw new Error(data.error || "Failed to generate diagram");
+        }
+        if (!response.body) {
+            return runGenerationJob(payload);
+        }
+
+        const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+        let buffer = "";
+        let received = 0;
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) {
+                break;
+            }
+            buffer += value;
+
+            // Events are separated by a blank line
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+
+                let event = 'message';
+                let data = '';
+                for (const line of rawEvent.split('\n')) {
+                    if (line.startsWith('event: ')) {
+                        event = line.slice(7);
+                    } else if (line.startsWith('data: ')) {
+                        data += line.slice(6);
+                    }
+                }
+                const payloadData = data ? JSON.parse(data) : {};
+
+                if (event === 'status') {
+                    loadingText.textContent = STAGE_LABELS[payloadData.stage] || DEFAULT_LOADING_TEXT;
+                } else if (event === 'token') {
+                    received += payloadData.text.length;
+                    loadingText.textContent = `Generating diagram... ${received} characters received`;
+                } else if (event === 'done') {
+                    reader.cancel();
+                    return payloadData;
+                } else if (event === 'error') {
+                    reader.cancel();
+                    throw new Error(payloadData.error || "Failed to generate diagram");
+                }
+            }
+        }
+        throw new Error("Connection closed before the diagram was finished");
+    }
+
+    /**
+     * Queues a generation job and polls it until it finishes.
+     * @param {Object} payload - Request body for POST /jobs
+     * @returns {Promise<{diagram: string, cached: boolean, svg_url?: string}>}
+     */
+    async function runGenerationJob(payload) {
+        const response = await fetch('/jobs', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify(payload)
+        });
+
+        let job = await response.json();
+        if (!response.ok) {
+            throw new Error(job.error || "Failed to generate diagram");
+        }
+
+        while (job.status === 'queued' || job.status === 'running') {
+            await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+            const pollResponse = await fetch(job.status_url);
+            job = await pollResponse.json();
+            if (!pollResponse.ok) {
+                throw new Error(job.error || "Lost track of the generation job");
+            }
+        }
+
+        if (job.status === 'failed') {
+            throw new Error(job.error || "Failed to generate diagram");
+        }
+        return job.result;
+    }
+
     /**
      * @param {string} msg - Error message to display
      */
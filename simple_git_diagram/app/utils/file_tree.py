@@ -0,0 +1,329 @@
+import codecs
+import heapq
+import json
+import math
+import re
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Directory names whose contents never reach the prompt (matched per path segment)
+EXCLUDED_DIRS = frozenset({
+    "node_modules", "vendor", "venv", ".venv", "__pycache__", ".git",
+    "test", "tests", "spec", "docs", "examples",  # non-essential folders
+})
+
+# File suffixes that are skipped (matched against every compound suffix, so
+# "app.min.js" is checked as ".min.js" and ".js")
+EXCLUDED_SUFFIXES = frozenset({
+    ".jpg", ".png", ".gif", ".ico", ".svg", ".lock", ".min.js", ".map",
+    ".css", ".scss", ".less", ".json", ".xml", ".yaml", ".yml",  # detailed configs
+})
+
+# Build manifests say more about a project than any other file; they are kept
+# even when their suffix is excluded
+MANIFESTS = frozenset({
+    "package.json", "pyproject.toml", "setup.py", "setup.cfg", "requirements.txt", "pipfile",
+    "cargo.toml", "go.mod", "pom.xml", "build.gradle", "build.gradle.kts", "settings.gradle",
+    "gemfile", "composer.json", "mix.exs", "cmakelists.txt", "makefile", "dockerfile",
+    "docker-compose.yml", "docker-compose.yaml", "tsconfig.json",
+})
+
+ENTRY_POINT_STEMS = frozenset({
+    "main", "app", "index", "server", "cli", "run", "manage", "wsgi", "asgi",
+    "__main__", "program", "lib", "mod", "api", "routes", "urls",
+})
+
+# Monorepo layouts: each child of these top-level directories is a package of its own
+PACKAGE_CONTAINERS = frozenset({
+    "packages", "apps", "libs", "services", "modules", "crates", "plugins", "projects",
+    "components", "extensions", "tools", "cmd", "internal",
+})
+
+SOURCE_DIRS = frozenset({"src", "lib", "app", "cmd", "pkg", "internal", "server", "api", "core", "services"})
+
+# Roughly four characters per token for file paths
+CHARS_PER_TOKEN = 4
+# Most files listed from a single directory before the rest is summarized
+MAX_FILES_PER_DIR = 10
+# Hidden files are summarized at most this many directories deep
+SUMMARY_DEPTH = 3
+# Share of the budget reserved for directory summaries
+SUMMARY_BUDGET_SHARE = 0.25
+
+_TREE_START = re.compile(r'"tree"\s*:\s*\[')
+_TRUNCATED = re.compile(r'"truncated"\s*:\s*true')
+
+
+def _suffixes(name: str) -> Iterator[str]:
+    dot = name.find(".", 1)
+    while dot != -1:
+        yield name[dot:]
+        dot = name.find(".", dot + 1)
+
+
+def should_include(path: str) -> bool:
+    parts = path.lower().split("/")
+    name = parts[-1]
+    if any(part in EXCLUDED_DIRS for part in parts[:-1]):
+        return False
+    if name in MANIFESTS:
+        return True
+    return not any(suffix in EXCLUDED_SUFFIXES for suffix in _suffixes(name))
+
+
+def score_path(path: str) -> float:
+    """Importance of a file on its own; directory fan-out is applied when rendering."""
+    parts = path.lower().split("/")
+    name = parts[-1]
+    score = 10.0 - 1.5 * (len(parts) - 1)  # shallow files first
+    if name in MANIFESTS:
+        score += 8
+    if name.split(".", 1)[0] in ENTRY_POINT_STEMS:
+        score += 6
+    if any(part in SOURCE_DIRS for part in parts[:-1]):
+        score += 1
+    if name.startswith("readme"):
+        score += 1
+    return score
+
+
+class TreeStreamParser:
+    """
+    Incrementally extracts the entries of a GitHub git/trees response without
+    holding the whole document in memory. Only the current partial entry is
+    buffered. `truncated` is set once GitHub's flag has been seen.
+    """
+
+    def __init__(self):
+        self.truncated = False
+
+    def entries(self, chunks: Iterable[bytes]) -> Iterator[dict]:
+        text_decoder = codecs.getincrementaldecoder("utf-8")()
+        json_decoder = json.JSONDecoder()
+        buf, pos = "", 0
+        in_tree = done = False
+
+        for chunk in chunks:
+            buf = buf[pos:] + text_decoder.decode(chunk)
+            pos = 0
+            if done:
+                self._check_truncated(buf)
+                buf = buf[-64:]
+                continue
+            if not in_tree:
+                match = _TREE_START.search(buf)
+                if not match:
+                    continue
+                self._check_truncated(buf[:match.start()])
+                in_tree, pos = True, match.end()
+
+            length = len(buf)
+            while True:
+                # Skip separators between entries
+                while pos < length and buf[pos] in " \t\r\n,":
+                    pos += 1
+                if pos >= length:
+                    break
+                if buf[pos] == "]":
+                    done = True
+                    self._check_truncated(buf[pos:])
+                    buf, pos = buf[-64:], 0
+                    break
+                try:
+                    entry, pos = json_decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    break  # partial entry, wait for the next chunk
+                yield entry
+
+    def _check_truncated(self, text: str):
+        if not self.truncated and _TRUNCATED.search(text):
+            self.truncated = True
+
+
+class FileTreeBuilder:
+    """
+    Picks a representative subset of a repository's files for the prompt.
+
+    Every file is counted per directory, but only the MAX_FILES_PER_DIR best
+    scoring paths of each directory are kept, so memory is bounded by the
+    number of directories rather than the number of files. render() fills a
+    token budget with the best candidates (penalizing crowded directories)
+    and collapses whatever was left out into per-directory summary lines.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.included = 0
+        self._dir_counts: Counter = Counter()
+        self._dir_exts: Dict[str, Counter] = defaultdict(Counter)
+        self._candidates: Dict[str, List[Tuple[float, int, str]]] = defaultdict(list)
+
+    def add(self, path: str):
+        self.total += 1
+        if not should_include(path):
+            return
+        self.included += 1
+        directory, _, name = path.rpartition("/")
+        self._dir_counts[directory] += 1
+        dot = name.rfind(".")
+        self._dir_exts[directory][name[dot:].lower() if dot > 0 else "(none)"] += 1
+
+        # Ties go to the path seen first (API order is alphabetical)
+        item = (score_path(path), -self.included, path)
+        heap = self._candidates[directory]
+        if len(heap) < MAX_FILES_PER_DIR:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    def render(self, max_tokens: int, log: bool = True) -> str:
+        budget = max_tokens * CHARS_PER_TOKEN
+        file_budget = int(budget * (1 - SUMMARY_BUDGET_SHARE))
+
+        ranked = []
+        for directory, heap in self._candidates.items():
+            penalty = math.log2(self._dir_counts[directory])
+            ranked.extend((score - penalty, order, path) for score, order, path in heap)
+        ranked.sort(reverse=True)
+
+        shown: Counter = Counter()
+        selected = []
+        used = 0
+        for _, _, path in ranked:
+            if used + len(path) + 1 > file_budget:
+                continue
+            selected.append(path)
+            shown[path.rpartition("/")[0]] += 1
+            used += len(path) + 1
+
+        summaries = self._summaries(shown, budget - used)
+        tree = "\n".join(sorted(selected + summaries))
+        if log:
+            logger.info(f"File tree: {len(selected)} of {self.included} files listed, {len(summaries)} "
+                        f"summary lines ({self.total} entries, ~{len(tree) // CHARS_PER_TOKEN} tokens)")
+        return tree
+
+    def _summaries(self, shown: Counter, budget: int) -> List[str]:
+        """One line per directory (cut at SUMMARY_DEPTH) for files that were left out."""
+        hidden: Counter = Counter()
+        hidden_exts: Dict[str, Counter] = defaultdict(Counter)
+        for directory, count in self._dir_counts.items():
+            missing = count - shown[directory]
+            if missing <= 0:
+                continue
+            key = "/".join(directory.split("/")[:SUMMARY_DEPTH]) if directory else ""
+            hidden[key] += missing
+            hidden_exts[key].update(self._dir_exts[directory])
+
+        lines = []
+        used = 0
+        for key, count in hidden.most_common():
+            exts = ", ".join(ext for ext, _ in hidden_exts[key].most_common(3))
+            line = f"{key + '/' if key else ''}... (+{count} more files, mostly {exts})"
+            if used + len(line) + 1 > budget:
+                break
+            lines.append(line)
+            used += len(line) + 1
+        return lines
+
+
+def package_of(path: str) -> Optional[str]:
+    """The package a file belongs to: its top-level directory, or one level deeper in PACKAGE_CONTAINERS."""
+    parts = path.split("/")
+    if len(parts) < 2:
+        return None
+    if parts[0].lower() in PACKAGE_CONTAINERS and len(parts) > 2:
+        return f"{parts[0]}/{parts[1]}"
+    return parts[0]
+
+
+@dataclass
+class Package:
+    path: str
+    # Git tree object of the directory: unchanged SHA, unchanged contents
+    tree_sha: Optional[str]
+    # Files that passed the exclusion rules
+    files: int
+    # File listing relative to `path`
+    listing: str
+
+
+class PackageIndex:
+    """
+    Splits a repository into packages (see package_of) while its tree is
+    streamed, with a FileTreeBuilder per package, so a repository too large
+    for one prompt can be summarized package by package. Files at the root
+    belong to no package.
+    """
+
+    def __init__(self):
+        self.files = 0
+        self._builders: Dict[str, FileTreeBuilder] = {}
+        self._tree_shas: Dict[str, str] = {}
+
+    def add(self, path: str):
+        package = package_of(path)
+        if package is None or not should_include(path):
+            return
+        self.files += 1
+        builder = self._builders.get(package)
+        if builder is None:
+            builder = self._builders[package] = FileTreeBuilder()
+        builder.add(path[len(package) + 1:])
+
+    def add_tree(self, path: str, sha: str):
+        """Records the tree SHA of a directory, kept when the directory is a package."""
+        if package_of(f"{path}/_") == path:
+            self._tree_shas[path] = sha
+
+    def __len__(self) -> int:
+        return len(self._builders)
+
+    def packages(self, limit: int, max_tokens: int) -> Tuple[List[Package], List[Tuple[str, int]]]:
+        """
+        The `limit` largest packages, each with a listing of at most
+        `max_tokens`, and (path, files) for the remaining ones.
+        """
+        ranked = sorted(self._builders.items(), key=lambda item: (-item[1].included, item[0]))
+        selected = [Package(path, self._tree_shas.get(path), builder.included, builder.render(max_tokens, log=False))
+                    for path, builder in ranked[:limit]]
+        rest = [(path, builder.included) for path, builder in ranked[limit:]]
+        return selected, rest
+
+
+def build_file_tree(chunks: Iterable[bytes], max_tokens: int,
+                    packages: Optional[PackageIndex] = None) -> Tuple[str, int]:
+    """
+    Streams a git/trees?recursive=1 response body and returns (rendered tree,
+    number of files that passed the exclusion rules). Also fills `packages`.
+    """
+    parser = TreeStreamParser()
+
+    def paths() -> Iterator[str]:
+        for entry in parser.entries(chunks):
+            if entry.get("type") == "blob":
+                yield entry["path"]
+            elif entry.get("type") == "tree" and packages is not None:
+                packages.add_tree(entry["path"], entry.get("sha"))
+
+    tree, included = build_file_tree_from_paths(paths(), max_tokens, packages)
+    if parser.truncated:
+        logger.warning("GitHub truncated the tree listing")
+        tree += "\n(GitHub truncated this listing; very large repository)"
+    return tree, included
+
+
+def build_file_tree_from_paths(paths: Iterable[str], max_tokens: int,
+                               packages: Optional[PackageIndex] = None) -> Tuple[str, int]:
+    """Same as build_file_tree for file paths from any other source (e.g. git ls-tree)."""
+    builder = FileTreeBuilder()
+    for path in paths:
+        builder.add(path)
+        if packages is not None:
+            packages.add(path)
+    return builder.render(max_tokens), builder.included
@@ -0,0 +1,141 @@
+import gzip
+import hashlib
+import os
+import re
+from typing import Dict, Optional, Tuple
+
+from flask import Flask, Response, request
+
+from app.utils.lru_cache import LRUCache
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+COMPRESSIBLE_TYPES = frozenset({
+    "text/html", "text/css", "text/plain", "text/javascript", "application/javascript",
+    "application/json", "image/svg+xml", "text/vnd.mermaid",
+})
+# Bodies smaller than this aren't worth the CPU or the header bytes
+MIN_COMPRESS_BYTES = 512
+# Fingerprinted static URLs never change content, so clients may keep them for a year
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# Suffix appended to the ETag of each encoded representation, as strong
+# validators must differ between gzip and identity bodies
+_ENCODING_SUFFIXES = {"br": "-br", "gzip": "-gzip"}
+_SUFFIXED_TAG = re.compile(r'-(?:br|gzip)"')
+
+_fingerprints: Dict[Tuple[str, float], str] = {}
+
+
+def content_etag(body: bytes) -> str:
+    """Strong validator derived from the representation's bytes."""
+    return hashlib.sha256(body).hexdigest()[:32]
+
+
+def static_fingerprint(static_folder: str, filename: str) -> Optional[str]:
+    """Short content hash of a static file, cached until the file's mtime changes."""
+    path = os.path.join(static_folder, filename)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    key = (path, mtime)
+    fingerprint = _fingerprints.get(key)
+    if fingerprint is None:
+        with open(path, "rb") as f:
+            fingerprint = hashlib.sha256(f.read()).hexdigest()[:12]
+        _fingerprints[key] = fingerprint
+    return fingerprint
+
+
+def _choose_encoding(accept_encoding: str) -> Optional[str]:
+    offered = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        offered[name.strip()] = q
+    if brotli is not None and offered.get("br", 0) > 0:
+        return "br"
+    if offered.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+def _compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+
+def init_http_cache(app: Flask):
+    """
+    Fingerprints static URLs (?v=<content hash>) and serves them as immutable,
+    compresses text responses with brotli or gzip, and keeps conditional
+    requests working for compressed representations.
+    """
+    # Compressed static files (and other responses with validators) by ETag
+    compressed_cache = LRUCache(256, max_bytes=8 * 1024 * 1024, sizeof=len)
+
+    @app.url_defaults
+    def fingerprint_static(endpoint, values):
+        if endpoint == "static" and "filename" in values and "v" not in values:
+            fingerprint = static_fingerprint(app.static_folder, values["filename"])
+            if fingerprint:
+                values["v"] = fingerprint
+
+    @app.before_request
+    def strip_encoding_from_validators():
+        # "abc-gzip" from a previous compressed response validates "abc"
+        if_none_match = request.environ.get("HTTP_IF_NONE_MATCH")
+        if if_none_match and _SUFFIXED_TAG.search(if_none_match):
+            request.environ["HTTP_IF_NONE_MATCH"] = _SUFFIXED_TAG.sub('"', if_none_match)
+
+    @app.after_request
+    def cache_and_compress(response: Response) -> Response:
+        if request.endpoint == "static":
+            if request.args.get("v"):
+                response.cache_control.no_cache = None
+                response.cache_control.public = True
+                response.cache_control.max_age = IMMUTABLE_MAX_AGE
+                response.cache_control.immutable = True
+
+        # Static files are streamed from disk but small enough to buffer; other
+        # streamed responses (SSE) must reach the client unbuffered
+        streamed = response.is_streamed and request.endpoint != "static"
+        if (response.status_code != 200 or streamed or "Content-Encoding" in response.headers
+                or response.mimetype not in COMPRESSIBLE_TYPES):
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = _choose_encoding(request.headers.get("Accept-Encoding", ""))
+        if encoding is None:
+            return response
+
+        etag, _ = response.get_etag()
+        cache_key = (etag, encoding) if etag else None
+        body = compressed_cache.get(cache_key) if cache_key else None
+        if body is None:
+            response.direct_passthrough = False
+            raw = response.get_data()
+            if len(raw) < MIN_COMPRESS_BYTES:
+                return response
+            body = _compress(raw, encoding)
+            if cache_key:
+                compressed_cache.put(cache_key, body)
+
+        response.set_data(body)
+        response.headers["Content-Encoding"] = encoding
+        if etag:
+            response.set_etag(etag + _ENCODING_SUFFIXES[encoding])
+        return response
@@ -1,148 +1,258 @@
 import re
 import logging
+from typing import NamedTuple, Optional, Pattern, Tuple, Union, Callable
 
 logger = logging.getLogger(__name__)
 
+I = re.IGNORECASE
+M = re.MULTILINE
+
+
+class _Rule(NamedTuple):
+    """
+    One rewrite applied to the whole diagram. `gate` lists literals of which at
+    least one must occur for the pattern to possibly match (checked against
+    the lower-cased code when `icase` is set), so most rules cost a substring
+    scan instead of a regex pass. `fast(code, lower)` is an equivalent
+    implementation for ASCII input that returns (new_code, count).
+
+    Gates and fast paths are only used for ASCII input: there str.lower()
+    agrees exactly with IGNORECASE matching, which is not true for characters
+    such as the long s or the Kelvin sign.
+    """
+    pattern: Pattern
+    repl: Union[str, Callable]
+    gate: Tuple[str, ...]
+    icase: bool
+    fast: Optional[Callable[[str, str], Tuple[str, int]]]
+
+
+def _rule(pattern: str, repl, gate: Tuple[str, ...], flags: int = 0, fast=None) -> _Rule:
+    return _Rule(re.compile(pattern, flags), repl, gate, bool(flags & I), fast)
+
+
+def _insert_before_group(pattern: str, group: int, text: str):
+    """
+    Fast path for IGNORECASE rules that only insert `text` before a group:
+    `pattern` is the same rule spelled in lower case and is matched
+    case-sensitively against the lower-cased code, which is much cheaper.
+    """
+    compiled = re.compile(pattern)
+
+    def apply(code: str, lower: str) -> Tuple[str, int]:
+        out, last = [], 0
+        for match in compiled.finditer(lower):
+            pos = match.start(group)
+            out.append(code[last:pos])
+            out.append(text)
+            last = pos
+        if not out:
+            return code, 0
+        out.append(code[last:])
+        return "".join(out), len(out) // 2
+    return apply
+
+
+_STYLE_KEYS = ("fill", "stroke", "color")
+_ASCII_LETTERS = frozenset("abcdefghijklmnopqrstuvwxyz")
+
+
+def _space_before_style(code: str, lower: str) -> Tuple[str, int]:
+    """ASCII fast path for "frontendfill:#" -> "frontend fill:#" (see _CLASSDEF_RULES)."""
+    out, last = [], 0
+    pos = lower.find(":#")
+    while pos != -1:
+        for key in _STYLE_KEYS:
+            start = pos - len(key)
+            if start >= 1 and lower.startswith(key, start) and lower[start - 1] in _ASCII_LETTERS:
+                out.append(code[last:start])
+                out.append(" ")
+                last = start
+                break
+        pos = lower.find(":#", pos + 2)
+    if not out:
+        return code, 0
+    out.append(code[last:])
+    return "".join(out), len(out) // 2
+
+
+# "endsubgraph"/"endclick"/"endclassDef" never overlap and their replacements
+# can't create one another, so they are fixed in a single pass via this table.
+_END_CONCAT_FIXES = {
+    "endsubgraph": "end\nsubgraph",
+    "endclick": "end\nclick",
+    "endclassdef": "end\nclassDef",
+}
+
+_HEADER = re.compile(r'^\s*(?:%%.*\n)*\s*(flowchart|graph|classDiagram|stateDiagram|stateDiagram-v2|C4Context)', M)
+
+# The rules below run in order: several of them feed each other (e.g. the
+# keyword split turns "subgraph" into "sub\ngraph", which the next rule joins
+# back), so they can't be collapsed into a single pass without changing output.
+# A leading \bword is written as word(?<=\bword) so the regex engine can scan
+# for the literal instead of trying every position.
+
+# 1.1 - 1.4: keywords glued to the previous token or split across lines
+_KEYWORD_RULES = (
+    _rule(r'([a-z0-9])(classDef|class|click|subgraph|state|graph|flowchart)\b', r'\1\n\2',
+          ("class", "click", "graph", "state", "flowchart"), I,
+          fast=_insert_before_group(r'[a-z0-9](classdef|class|click|subgraph|state|graph|flowchart)\b', 1, "\n")),
+    _rule(r'sub(?<=\bsub)\s*\n\s*graph\b', 'subgraph', ("sub",), I),
+    _rule(r'end(?<=\bend)\s*\n\s*subgraph\b', 'end\nsubgraph', ("subgraph",), I),
+    _rule(r'class(?<=\bclass)\s*\n\s*Def\b', 'classDef', ("def",), I),
+    _rule(r'([\]\)])end\b', r'\1\nend', ("]end", ")end"), I),
+)
+
+_HEADER_NEWLINE = _rule(
+    r'^(\s*)(flowchart\s+\w+|graph\s+\w+|classDiagram|stateDiagram|stateDiagram-v2|C4Context)[^\S\r\n]+',
+    r'\1\2\n', (), M)
+
+# 2: incomplete lines and broken classDef statements
+_CLASSDEF_RULES = (
+    _rule(r':::\s*$', '', (":::",), M),
+    # classDef split across lines: "classDef name\nfill:#..." -> one line
+    _rule(r'(classDef\s+\w+)\s*\n\s*(fill:#|stroke:#|color:#)', r'\1 \2', ("classdef",), I),
+    # classDef name glued to fill:/stroke:/color: ("classDef frontendfill:#")
+    _rule(r'([a-zA-Z]+)(fill:#|stroke:#|color:#)', r'\1 \2', ("fill:#", "stroke:#", "color:#"), I,
+          fast=_space_before_style),
+    # Bare classDef, then classDef with a name but no style
+    _rule(r'^\s*classDef\s*$', '', ("classDef",), M),
+    _rule(r'^\s*classDef\s+\w+\s*$', '', ("classDef",), M),
+    # Trailing commas in classDef
+    _rule(r'(classDef.*),\s*$', r'\1', ("classDef",), M),
+)
+
+# 3: 'end' glued to neighbouring tokens
+_END_RULES = (
+    # ]endsubgraph_name or )endsubgraph_name -> ]\nend
+    _rule(r'(\]|\))endsubgraph_\w*', r'\1\nend', ("endsubgraph_",), I),
+    # Hallucinated "named" end tags standalone (endsubgraph_frontend -> end)
+    _rule(r'endsubgraph_\w+', '\nend', ("endsubgraph_",), I),
+    _rule(r'\]end\b', ']\nend', ("]end",), I),
+    # 'end' on its own line after a node
+    _rule(r'(\]|\))\s*end\s*$', r'\1\nend', ("end",), M | I),
+    _rule(r'endsubgraph|endclick|endclassdef', lambda m: _END_CONCAT_FIXES[m.group(0).lower()],
+          tuple(_END_CONCAT_FIXES), I),
+    _rule(r'_blankend', '_blank\nend', ("_blankend",), I),
+)
+
+# click directives: add missing href and _blank, split keywords glued to a closing quote
+_CLICK_RULES = (
+    _rule(r'click\s+([\w\-]+)\s+"(http[^"]+)"', r'click \1 href "\2"', ("click",), I),
+    _rule(r'(click\s+[\w\-]+\s+href\s+"[^"]+"(?:\s+"[^"]+")?)\s*$', r'\1 _blank', ("href",), M),
+    # Done AFTER href injection to catch patterns created by it
+    _rule(r'(")(classDef|class|click|subgraph|state|graph|flowchart)', r'\1\n\2', ('"',), I),
+)
+
+# State diagrams' strict parser rejects tooltips/_blank: keep only click ID href "URL"
+_STATE_CLICK = _rule(r'(click\s+[\w\-]+\s+href\s+"[^"]+")(?:.*)$', r'\1', ("href",), M)
+
+# 'end' followed by a word goes on its own line (\b keeps 'frontend' intact)
+_END_NEWLINE = _rule(r'end(?<=\bend)\s+([a-zA-Z])', r'end\n\1', ("end",))
+
+
+class _Normalizer:
+    """Applies rules to a diagram, keeping a lower-cased copy for the gates up to date."""
+
+    def __init__(self, code: str):
+        self.code = code
+        self._lower: Optional[str] = None
+        # Rules only ever add ASCII text, so this holds for the whole run
+        self.ascii = code.isascii()
+
+    def apply(self, rule: _Rule) -> int:
+        if self.ascii:
+            if rule.gate:
+                haystack = self.lower if rule.icase else self.code
+                if not any(literal in haystack for literal in rule.gate):
+                    return 0
+            if rule.fast:
+                self.code, count = rule.fast(self.code, self.lower)
+            else:
+                self.code, count = rule.pattern.subn(rule.repl, self.code)
+        else:
+            self.code, count = rule.pattern.subn(rule.repl, self.code)
+        if count:
+            self._lower = None
+        return count
+
+    def apply_all(self, rules) -> int:
+        return sum(self.apply(rule) for rule in rules)
+
+    def set(self, code: str):
+        self.code = code
+        self._lower = None
+        self.ascii = code.isascii()
+
+    @property
+    def lower(self) -> str:
+        if self._lower is None:
+            self._lower = self.code.lower()
+        return self._lower
+
+
+def _extract_code(raw_code: str) -> str:
+    """
+    1. Extract from code blocks: the body of the first ```mermaid block, else
+    of the first plain ``` block, else the whole text. Equivalent to matching
+    ```mermaid\s*(.*?)\s*``` (then ```\s*(.*?)\s*```) with DOTALL; the caller
+    strips the result.
+    """
+    start = raw_code.find("```mermaid")
+    if start != -1:
+        end = raw_code.find("```", start + 10)
+        if end != -1:
+            return raw_code[start + 10:end]
+    # Fallback for plain blocks or just content
+    start = raw_code.find("```")
+    if start != -1:
+        end = raw_code.find("```", start + 3)
+        if end != -1:
+            return raw_code[start + 3:end]
+    return raw_code
+
+
 def clean_mermaid_code(raw_code: str, diagram_type: str = 'flowchart') -> str:
-    # 1. Extract from code blocks
-    match = re.search(r"```mermaid\s*(.*?)\s*```", raw_code, re.DOTALL)
-    if match:
-        code = match.group(1)
-    else:
-        # Fallback regex for plain blocks or just content
-        match_plain = re.search(r"```\s*(.*?)\s*```", raw_code, re.DOTALL)
-        code = match_plain.group(1) if match_plain else raw_code
-
-    code = code.strip()
-
-    # 1.1 Fix concatenated keywords
-    # Log matches for debugging
-    concatenated_matches = re.findall(r'([a-z0-9])(classDef|class|click|subgraph|state|graph|flowchart)\b', code, flags=re.IGNORECASE)
-    if concatenated_matches:
-        logger.info(f"Found concatenated keywords: {concatenated_matches}")
-        
-    code = re.sub(r'([a-z0-9])(classDef|class|click|subgraph|state|graph|flowchart)\b', r'\1\n\2', code, flags=re.IGNORECASE)
-    
-
-    if concatenated_matches:
-        logger.info(f"Code after split fix: {code[0:200]}...")
-
-    # 1.3 Fix keywords split across lines (e.g., "sub\ngraph" -> "subgraph")
-    code = re.sub(r'\bsub\s*\n\s*graph\b', 'subgraph', code, flags=re.IGNORECASE)
-    code = re.sub(r'\bend\s*\n\s*subgraph\b', 'end\nsubgraph', code, flags=re.IGNORECASE)
-    code = re.sub(r'\bclass\s*\n\s*Def\b', 'classDef', code, flags=re.IGNORECASE)
-    
-    # 1.4 Fix ]end or )end patterns (missing newline before 'end')
-    code = re.sub(r'([\]\)])end\b', r'\1\nend', code, flags=re.IGNORECASE)
+    debug = logger.isEnabledFor(logging.DEBUG)
+    norm = _Normalizer(_extract_code(raw_code).strip())
+
+    # 1.1 - 1.4 Fix concatenated / split keywords
+    if norm.apply_all(_KEYWORD_RULES) and debug:
+        logger.debug(f"Code after keyword fixes: {norm.code[0:200]}...")
 
     # 1.5 Enforce Diagram Header
     # Check if a valid header already exists (ignoring comments)
-    header_pattern = r'^\s*(?:%%.*\n)*\s*(flowchart|graph|classDiagram|stateDiagram|stateDiagram-v2|C4Context)'
-    match = re.search(header_pattern, code, flags=re.MULTILINE)
-    
-    if not match:
+    if not _HEADER.search(norm.code):
         # No header found, prepend based on type
         if diagram_type == 'class':
-            code = "classDiagram\n" + code
+            norm.set("classDiagram\n" + norm.code)
         elif diagram_type == 'state':
-            code = "stateDiagram-v2\n" + code
+            norm.set("stateDiagram-v2\n" + norm.code)
         else:
             # Default to flowchart TD for c4/flowchart
-            code = "flowchart TD\n" + code
-            
+            norm.set("flowchart TD\n" + norm.code)
+
     # Ensure newline after header if it was on same line as content
-    logger.info(f"BEFORE header newline fix (first 200 chars): {code[:200]}")
-    code = re.sub(r'^(\s*)(flowchart\s+\w+|graph\s+\w+|classDiagram|stateDiagram|stateDiagram-v2|C4Context)[^\S\r\n]+', r'\1\2\n', code, flags=re.MULTILINE)
-    logger.info(f"AFTER header newline fix (first 200 chars): {code[:200]}")
-    
-    # 2. Remove "syntax error" causing artifacts (incomplete lines)
-    # Remove incomplete class definitions (:::)
-    code = re.sub(r':::\s*$', '', code, flags=re.MULTILINE)
-    
-    # Debug: Log lines containing classDef before fix
-    classdef_lines_before = [l for l in code.split('\n') if 'classdef' in l.lower()]
-    logger.debug(f"CLASSDEF lines BEFORE fix: {classdef_lines_before}")
-    
-    # Also log lines that START WITH fill/stroke/color (these might be split from classDef)
-    fillstroke_lines = [l for l in code.split('\n') if l.strip().startswith(('fill:', 'fill:#', 'stroke:', 'stroke:#', 'color:', 'color:#'))]
-    logger.debug(f"FILL/STROKE lines (might be split from classDef): {fillstroke_lines}")
-    
-    # Fix classDef split across lines: join "classDef name\nfill:..." into one line
-    # The LLM sometimes puts fill: on the next line WITHOUT leading whitespace
-    # Using \n\s* to match newline + zero or more spaces
-    code = re.sub(r'(classDef\s+\w+)\s*\n\s*(fill:#)', r'\1 \2', code, flags=re.IGNORECASE)
-    code = re.sub(r'(classDef\s+\w+)\s*\n\s*(stroke:#)', r'\1 \2', code, flags=re.IGNORECASE)
-    code = re.sub(r'(classDef\s+\w+)\s*\n\s*(color:#)', r'\1 \2', code, flags=re.IGNORECASE)
-    
-    # Fix classDef name concatenated with fill:/stroke:/color: (missing space)
-    # e.g., "classDef frontendfill:#" -> "classDef frontend fill:#"
-    # Uses backtracking: match word chars, then force match of fill/stroke/color + :#  
-    # The regex engine will backtrack to find where 'fill' starts within the word
-    code = re.sub(r'([a-zA-Z]+)(fill:#)', r'\1 \2', code, flags=re.IGNORECASE)
-    code = re.sub(r'([a-zA-Z]+)(stroke:#)', r'\1 \2', code, flags=re.IGNORECASE)
-    code = re.sub(r'([a-zA-Z]+)(color:#)', r'\1 \2', code, flags=re.IGNORECASE)
-    
-    # Debug: Log lines containing classDef after join fix
-    classdef_lines_after = [l for l in code.split('\n') if 'classdef' in l.lower()]
-    logger.debug(f"CLASSDEF lines AFTER join fix (should now have fill:#): {classdef_lines_after}")
-    
-    # Remove bare classDef
-    code = re.sub(r'^\s*classDef\s*$', '', code, flags=re.MULTILINE)
-    # Remove incomplete classDef lines
-    code = re.sub(r'^\s*classDef\s+\w+\s*$', '', code, flags=re.MULTILINE)
-    # Remove trailing commas in classDef
-    code = re.sub(r'(classDef.*),\s*$', r'\1', code, flags=re.MULTILINE)
+    norm.apply(_HEADER_NEWLINE)
+    if debug:
+        logger.debug(f"AFTER header newline fix (first 200 chars): {norm.code[:200]}")
 
+    # 2. Remove "syntax error" causing artifacts and repair classDef lines
+    norm.apply_all(_CLASSDEF_RULES)
+    if debug:
+        classdef_lines = [l for l in norm.code.split('\n') if 'classdef' in l.lower()]
+        logger.debug(f"CLASSDEF lines after fixes: {classdef_lines}")
 
     # 3. Fix common newline issues (Concatenated keywords)
-    # Log first 500 chars to see where issues might be
-    logger.debug(f"BEFORE fixes (first 500): {code[:500] if len(code) > 500 else code}")
-    
-    # Fix ]endsubgraph_name or )endsubgraph_name -> ]\nend or )\nend
-    code = re.sub(r'(\]|\))endsubgraph_\w*', r'\1\nend', code, flags=re.IGNORECASE)
-    
-    # Fix hallucinated "named" end tags standalone (e.g., endsubgraph_frontend -> end)
-    code = re.sub(r'endsubgraph_\w+', '\nend', code, flags=re.IGNORECASE)
-    
-    # Also catch case where ] is directly followed by end (no space)
-    code = re.sub(r'\]end\b', ']\nend', code, flags=re.IGNORECASE)
-    
-    logger.debug(f"AFTER endsubgraph fix (first 500): {code[:500] if len(code) > 500 else code}")
-    
-    # Ensure 'end' is always on its own line (preceded by newline)
-    # Match: any non-whitespace followed by optional whitespace and 'end' at end of line
-    code = re.sub(r'(\]|\))\s*end\s*$', r'\1\nend', code, flags=re.MULTILINE | re.IGNORECASE)
-    
-    # Fix "endsubgraph" -> "end\nsubgraph" (concatenation without underscore)
-    code = re.sub(r'endsubgraph', 'end\nsubgraph', code, flags=re.IGNORECASE)
-    # Fix "endclick" -> "end\nclick"
-    code = re.sub(r'endclick', 'end\nclick', code, flags=re.IGNORECASE)
-    # Fix "endclassDef" -> "end\nclassDef"
-    code = re.sub(r'endclassDef', 'end\nclassDef', code, flags=re.IGNORECASE)
-    
-    # Fix potentially concatenated "_blankend" -> "_blank\nend"
-    code = re.sub(r'_blankend', '_blank\nend', code, flags=re.IGNORECASE)
-    
-    # Fix missing href keyword (required for some diagram types)
-    # click ID "URL" -> click ID href "URL"
-    code = re.sub(r'click\s+([\w\-]+)\s+"(http[^"]+)"', r'click \1 href "\2"', code, flags=re.IGNORECASE)
-
-    # Force add _blank to click directives if missing
-    # Matches: click NodeID href "URL" [ "Tooltip" ]
-    code = re.sub(r'(click\s+[\w\-]+\s+href\s+"[^"]+"(?:\s+"[^"]+")?)\s*$', r'\1 _blank', code, flags=re.MULTILINE)
-    
-    # Fix quote-keyword concatenation (e.g., "...url"click) - done AFTER href injection
-    # to catch any new patterns created by the href transformation
-    code = re.sub(r'(")(classDef|class|click|subgraph|state|graph|flowchart)', r'\1\n\2', code, flags=re.IGNORECASE)
-    
+    norm.apply_all(_END_RULES)
+    norm.apply_all(_CLICK_RULES)
+
     # SPECIAL HANDLE: State Diagrams often don't support tooltips/_blank in strict parser
     if diagram_type == 'state':
-        # Strip everything after the URL (Tooltip, _blank) for state diagrams
-        # Keep: click ID href "URL"
-        code = re.sub(r'(click\s+[\w\-]+\s+href\s+"[^"]+")(?:.*)$', r'\1', code, flags=re.MULTILINE)
-    
-    # Ensure 'end' is usually followed by newline if followed by a word
-    # IMPORTANT: Use word boundary \b to avoid matching 'end' inside words like 'frontend'
-    code = re.sub(r'\bend\s+([a-zA-Z])', r'end\n\1', code)
-
-    return code
+        norm.apply(_STATE_CLICK)
+
+    norm.apply(_END_NEWLINE)
+    if debug:
+        logger.debug(f"Cleaned diagram (first 500): {norm.code[:500]}")
+
+    return norm.code
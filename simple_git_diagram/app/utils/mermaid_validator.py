@@ -0,0 +1,177 @@
+import re
+from typing import List
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# First statement of every diagram kind the prompts can produce
+_HEADER = re.compile(r'^(flowchart|graph)\b(?:\s+(TB|TD|BT|RL|LR))?\s*;?\s*$'
+                     r'|^(classDiagram|stateDiagram|stateDiagram-v2|C4Context|C4Container|C4Component|C4Dynamic)\s*$')
+
+_SUBGRAPH = re.compile(r'^subgraph\b')
+_END = re.compile(r'^end\s*;?\s*$')
+_CLASSDEF = re.compile(r'^classDef\s+[\w,-]+\s+\S')
+_CLICK = re.compile(r'^click\s+[\w-]+\s+(?:href\s+)?("[^"]*"|\w+)')
+# Lines whose syntax the checker doesn't model (styling, directives, prose)
+_SKIPPED = re.compile(r'^(?:%%|style\s|linkStyle\s|class\s+[\w,-]+\s+\w+\s*;?$|direction\s|accTitle|accDescr|title\s|note\s)')
+# State diagram note spanning lines up to "end note" (free text, not checked)
+_NOTE_BLOCK = re.compile(r'^note\s+(?:left|right)\s+of\s+[^:"]+$')
+_END_NOTE = re.compile(r'^end\s+note\s*$')
+# Flowchart asymmetric node shape: id>label]
+_ASYMMETRIC = re.compile(r'\w>[^\]]*\]')
+# "A[Load (cached)]": Mermaid reads the parenthesis as a shape and fails; such labels need quotes.
+# [( [[ [/ and [\ open shapes of their own.
+_PAREN_IN_LABEL = re.compile(r'\[(?![(\[/\\])[^\]]*[()][^\]]*\]')
+
+_PAIRS = {"(": ")", "[": "]", "{": "}"}
+_CLOSERS = {v: k for k, v in _PAIRS.items()}
+
+# Messages are capped so a badly broken diagram still gives a short repair prompt
+MAX_ERRORS = 10
+
+
+def validate_mermaid(code: str, diagram_type: str = 'flowchart') -> List[str]:
+    """
+    Structural check of a cleaned diagram without a browser: a known header
+    (after optional YAML front matter), balanced subgraph/end and brace
+    blocks, balanced brackets and quotes on each line, complete classDef and
+    click statements. Comments and multi-line state notes aren't checked.
+    It doesn't replace Mermaid's parser but catches what LLMs typically get
+    wrong. Returns "line N: ..." messages; an empty list means no problems
+    were found.
+    """
+    lines = code.split("\n")
+    errors: List[str] = []
+
+    header_at = None
+    front_matter = False
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        if front_matter:
+            front_matter = stripped != "---"
+        elif stripped == "---" and header_at is None and not any(l.strip() for l in lines[:i]):
+            # ---\ntitle: ...\n--- configures the diagram; the header follows it
+            front_matter = True
+        elif stripped and not stripped.startswith("%%"):
+            header_at = i
+            break
+    if front_matter:
+        return ["front matter is never closed with '---'"]
+    if header_at is None:
+        return ["diagram is empty"]
+    header = lines[header_at].strip()
+    match = _HEADER.match(header)
+    if not match:
+        return [f"line {header_at + 1}: expected a diagram header, got '{header[:60]}'"]
+    kind = match.group(1) or match.group(3)
+    flowchart = kind in ("flowchart", "graph")
+
+    subgraphs: List[int] = []
+    blocks: List[int] = []
+    note_at = None
+    statements = 0
+    for number, line in enumerate(lines[header_at + 1:], start=header_at + 2):
+        stripped = _strip_comment(line).strip()
+        if note_at is not None:
+            if _END_NOTE.match(stripped):
+                note_at = None
+            continue
+        if not flowchart and _NOTE_BLOCK.match(stripped):
+            note_at = number
+            statements += 1
+            continue
+        if not stripped or _SKIPPED.match(stripped):
+            continue
+        statements += 1
+
+        if flowchart and _SUBGRAPH.match(stripped):
+            subgraphs.append(number)
+        elif flowchart and _END.match(stripped):
+            if subgraphs:
+                subgraphs.pop()
+            else:
+                errors.append(f"line {number}: 'end' without an open subgraph")
+            continue
+        elif stripped.startswith("classDef"):
+            if not _CLASSDEF.match(stripped):
+                errors.append(f"line {number}: classDef needs a name and a style")
+            continue
+        elif stripped.startswith("click"):
+            if not _CLICK.match(stripped):
+                errors.append(f"line {number}: malformed click directive")
+            continue
+
+        problem = _check_line(stripped, flowchart)
+        if problem:
+            errors.append(f"line {number}: {problem}")
+
+        if not flowchart:
+            # class bodies, composite states and C4 boundaries are brace blocks
+            for char in _outside_quotes(stripped):
+                if char == "{":
+                    blocks.append(number)
+                elif char == "}":
+                    if blocks:
+                        blocks.pop()
+                    else:
+                        errors.append(f"line {number}: '}}' without a matching '{{'")
+
+        if len(errors) >= MAX_ERRORS:
+            break
+
+    for number in subgraphs:
+        errors.append(f"line {number}: subgraph is never closed with 'end'")
+    for number in blocks:
+        errors.append(f"line {number}: '{{' is never closed")
+    if note_at is not None:
+        errors.append(f"line {note_at}: note is never closed with 'end note'")
+    if statements == 0:
+        errors.append(f"line {header_at + 1}: diagram has a header but no content")
+    return errors[:MAX_ERRORS]
+
+
+def _strip_comment(line: str) -> str:
+    """The line without a trailing %% comment (a whole-line comment or directive is kept for _SKIPPED)."""
+    if line.lstrip().startswith("%%"):
+        return line
+    quoted = 0
+    for i, char in enumerate(line):
+        if char == '"':
+            quoted ^= 1
+        elif not quoted and line.startswith("%%", i):
+            return line[:i]
+    return line
+
+
+def _outside_quotes(line: str) -> str:
+    """The line with double-quoted strings removed."""
+    return re.sub(r'"[^"]*"', '""', line)
+
+
+def _check_line(line: str, flowchart: bool) -> str:
+    if line.count('"') % 2:
+        return "unterminated string"
+    # Edge labels (-->|text|) and member/label text may contain anything but quotes
+    text = _outside_quotes(line)
+    if flowchart:
+        text = re.sub(r'\|[^|]*\|', '', text)
+        if _PAREN_IN_LABEL.search(text):
+            return "parentheses in an unquoted label (wrap the label in double quotes)"
+    else:
+        # Brace blocks span lines and are tracked by the caller
+        text = text.replace("{", "").replace("}", "")
+    stack = []
+    for char in text:
+        if char in _PAIRS:
+            stack.append(char)
+        elif char in _CLOSERS:
+            if stack and stack[-1] == _CLOSERS[char]:
+                stack.pop()
+            elif char == "]" and flowchart and _ASYMMETRIC.search(text):
+                continue
+            else:
+                return f"unexpected '{char}'"
+    if stack:
+        return f"unclosed '{stack[-1]}'"
+    return ""
@@ -0,0 +1,449 @@
+import importlib.util
+import os
+import re
+import threading
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from app.utils.file_tree import CHARS_PER_TOKEN
+from app.utils.prompts import MERMAID_UPDATE_PROMPT
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Optional: counts fall back to a characters-per-token estimate. Imported on first use
+HAVE_TIKTOKEN = importlib.util.find_spec("tiktoken") is not None
+
+# Stand-ins for the repository's identity in LLM cache keys and cached answers
+REPO_PLACEHOLDER = "{{gitdiagram:repo}}"
+BRANCH_PLACEHOLDER = "{{gitdiagram:branch}}"
+BASE_URL_PLACEHOLDER = "{{gitdiagram:base_url}}"
+
+# Context windows by model family, matched as a substring of the model name
+# with "-", "_" and spaces removed (local servers report names such as
+# "Meta-Llama-3.1-8B-Instruct"). More specific entries come first.
+MODEL_CONTEXT_WINDOWS = (
+    ("gpt4.1", 1047576),
+    ("gpt4o", 128000),
+    ("gpt4turbo", 128000),
+    ("gpt432k", 32768),
+    ("gpt4", 8192),
+    ("gpt3.5turbo", 16385),
+    ("o1", 200000),
+    ("o3", 200000),
+    ("o4", 200000),
+    ("llama3.1", 131072),
+    ("llama3.2", 131072),
+    ("llama3.3", 131072),
+    ("llama3", 8192),
+    ("llama2", 4096),
+    ("codellama", 16384),
+    ("mixtral", 32768),
+    ("mistral", 32768),
+    ("qwen2.5", 32768),
+    ("qwen", 32768),
+    ("deepseek", 65536),
+    ("gemma", 8192),
+    ("phi3", 4096),
+)
+DEFAULT_CONTEXT_WINDOW = 8192
+
+# Tokens kept free for chat formatting and counting error
+SAFETY_MARGIN = 64
+# Share of the budget the file tree may claim when both parts don't fit
+TREE_SHARE = 0.5
+# A README section is cut short rather than dropped if at least this much room is left
+MIN_SECTION_TOKENS = 64
+# Share of a hierarchical prompt's budget for the package summaries, and the least a summary gets
+PACKAGES_SHARE = 0.65
+MIN_SUMMARY_TOKENS = 64
+
+# README headings by priority (lower goes in first). Sections that match
+# nothing get DEFAULT_SECTION_PRIORITY; SKIP_SECTION never reaches the prompt.
+SKIP_SECTION = None
+DEFAULT_SECTION_PRIORITY = 2
+SECTION_PRIORITIES = (
+    (re.compile(r"architect|design|overview|structure|how it works|components|internals|concepts|modules"), 0),
+    (re.compile(r"install|setup|set up|getting started|quick ?start|usage|build|deploy|configur"), 1),
+    (re.compile(r"licen[cs]e|contribut|changelog|release notes|acknowledg|sponsor|backers|code of conduct"
+                r"|citation|authors|contact|star history"), SKIP_SECTION),
+)
+
+_HEADING = re.compile(r"^(#{1,6})\s+(.*?)[\s#]*$")
+# Badge rows and logos carry no information for the diagram
+_BADGE_LINE = re.compile(r"^\s*(?:\[!\[|!\[|<img\b|<a\b[^>]*>\s*<img\b|<p align|</?p>\s*$|<br\s*/?>\s*$)", re.I)
+
+
+def context_window(model: str) -> int:
+    """Context window of `model`; LLM_CONTEXT_TOKENS overrides the lookup."""
+    override = os.getenv("LLM_CONTEXT_TOKENS")
+    if override:
+        return int(override)
+    name = re.sub(r"[-_ ]", "", (model or "").lower())
+    for family, tokens in MODEL_CONTEXT_WINDOWS:
+        if family in name:
+            return tokens
+    return DEFAULT_CONTEXT_WINDOW
+
+
+class TokenCounter:
+    """
+    Counts tokens with tiktoken when it is installed, otherwise estimates
+    them. The encoding is loaded by the first count (or by the start-up
+    warm-up), since it can take a download on a fresh machine.
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+        self._encoding = None
+        self._loaded = not HAVE_TIKTOKEN
+        self._lock = threading.Lock()
+
+    @property
+    def encoding(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    import tiktoken
+                    try:
+                        self._encoding = tiktoken.encoding_for_model(self.model)
+                    except KeyError:
+                        self._encoding = tiktoken.get_encoding("cl100k_base")
+                    self._loaded = True
+        return self._encoding
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        if self.encoding is not None:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def _context(username: str, repo: str, branch: str) -> Tuple[str, str, Tuple[Tuple[str, str], ...]]:
+    """
+    The <CONTEXT> block naming the repository, the same block with
+    placeholders (for the cache key) and the (name, placeholder) pairs that
+    turn an answer for this repository into one for any other.
+    """
+    # Base URL for links: https://github.com/user/repo/blob/branch/
+    base_url = f"https://github.com/{username}/{repo}/blob/{branch}/"
+    template = "<CONTEXT>\nRepo: {repo}\nBranch: {branch}\nBase URL: {base_url}\n</CONTEXT>"
+    context = template.format(repo=f"{username}/{repo}", branch=branch, base_url=base_url)
+    generic = template.format(repo=REPO_PLACEHOLDER, branch=BRANCH_PLACEHOLDER, base_url=BASE_URL_PLACEHOLDER)
+    # Longest first: the base URL contains owner/repo
+    return context, generic, ((base_url, BASE_URL_PLACEHOLDER), (f"{username}/{repo}", REPO_PLACEHOLDER))
+
+
+@dataclass
+class Prompt:
+    text: str
+    # System prompt plus user content
+    prompt_tokens: int
+    tree_tokens: int
+    readme_tokens: int
+    budget: int
+    # What the response may use without overflowing the context window
+    max_output_tokens: int
+    # Updates a previous diagram from a list of changed files (tree_tokens counts the list)
+    incremental: bool = False
+    # `text` with the repository's identity replaced by placeholders, so forks and renamed
+    # repos share cached answers; `aliases` maps the real names in an answer to those placeholders
+    cache_key: Optional[str] = None
+    aliases: Tuple[Tuple[str, str], ...] = ()
+
+
+@dataclass
+class _Section:
+    index: int
+    title: str
+    priority: Optional[int]
+    text: str
+    tokens: int
+
+
+class PromptBuilder:
+    """
+    Assembles the user prompt within the model's context window.
+
+    The prompt (system prompt included) gets the context window minus the
+    reserved output, capped by PROMPT_MAX_TOKENS. The file tree and
+    README share it: when both don't fit, the tree gets at least TREE_SHARE
+    of it and the README is filled section by section, architecture and
+    install notes first, instead of keeping a prefix.
+    """
+
+    def __init__(self, model: str, max_output_tokens: int):
+        self.model = model
+        self.context_window = context_window(model)
+        # Small models still need room for the question
+        self.output_reserve = min(max_output_tokens, self.context_window // 2)
+        self.max_output_tokens = max_output_tokens
+        self.max_prompt_tokens = int(os.getenv("PROMPT_MAX_TOKENS", 6000))
+        self.counter = TokenCounter(model)
+
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.total_tokens = 0
+        self.largest = 0
+        logger.info(f"PromptBuilder for {model}: context {self.context_window} tokens, "
+                    f"output reserve {self.output_reserve}, prompt cap {self.max_prompt_tokens} "
+                    f"({'tiktoken' if HAVE_TIKTOKEN else 'estimated'} counts)")
+
+    def build(self, username: str, repo: str, branch: str, file_tree: str, readme: str,
+              diagram_type: str, system_prompt: str) -> Prompt:
+        context, generic, aliases = _context(username, repo, branch)
+        header = context + """
+
+<FILE_TREE>
+"""
+        middle = """
+</FILE_TREE>
+
+<README>
+"""
+        footer = f"""
+</README>
+IMPORTANT: Generate a {diagram_type} diagram."""
+
+        system_tokens = self.counter.count(system_prompt)
+        frame_tokens = self.counter.count(header + middle + footer)
+        limit = min(self.max_prompt_tokens, self.context_window - self.output_reserve)
+        budget = max(0, limit - system_tokens - frame_tokens - SAFETY_MARGIN)
+
+        tree_full = self.counter.count(file_tree)
+        readme_full = self.counter.count(readme)
+        # When everything fits the tree keeps all of it; otherwise at least TREE_SHARE
+        tree_cap = min(tree_full, max(int(budget * TREE_SHARE), budget - readme_full))
+        readme_text, readme_tokens = self._fit_readme(readme, budget - tree_cap)
+        # Whatever the README left over goes back to the tree
+        tree_text, tree_tokens = self._fit_tree(file_tree, budget - readme_tokens)
+
+        text = header + tree_text + middle + readme_text + footer
+        prompt_tokens = system_tokens + self.counter.count(text)
+        max_output = max(0, min(self.max_output_tokens, self.context_window - prompt_tokens - SAFETY_MARGIN))
+        self._record(prompt_tokens)
+        return Prompt(text, prompt_tokens, tree_tokens, readme_tokens, budget, max_output,
+                      cache_key=generic + text[len(context):], aliases=aliases)
+
+    def build_hierarchical(self, username: str, repo: str, branch: str, file_tree: str, readme: str,
+                           summaries: List[Tuple[str, int, str]], others: List[Tuple[str, int]],
+                           diagram_type: str, system_prompt: str) -> Prompt:
+        """
+        Prompt for a repository summarized package by package: (path, files,
+        summary) per package, largest first, which get PACKAGES_SHARE of the
+        budget. Packages that don't fit join `others`, listed by name only.
+        The file tree sample and README share the rest.
+        """
+        context, generic, aliases = _context(username, repo, branch)
+        header = context + """
+
+<PACKAGES>
+"""
+        tree_start = """
+</PACKAGES>
+
+<FILE_TREE>
+"""
+        middle = """
+</FILE_TREE>
+
+<README>
+"""
+        footer = f"""
+</README>
+IMPORTANT: Generate a {diagram_type} diagram. The repository is too large to list in full: <PACKAGES> summarizes
+its largest packages and <FILE_TREE> is only a sample. Draw one subgraph per package, connect the packages
+the way they depend on each other, and build click links from the Base URL, the package path and the file path."""
+
+        system_tokens = self.counter.count(system_prompt)
+        frame_tokens = self.counter.count(header + tree_start + middle + footer)
+        limit = min(self.max_prompt_tokens, self.context_window - self.output_reserve)
+        budget = max(0, limit - system_tokens - frame_tokens - SAFETY_MARGIN)
+
+        share = int(budget * PACKAGES_SHARE)
+        sections, used = [], 0
+        for index, (path, files, summary) in enumerate(summaries):
+            section = f"### {path} ({files} files)\n{summary.strip()}\n"
+            cost = self.counter.count(section)
+            if used + cost > share:
+                others = [(p, f) for p, f, _ in summaries[index:]] + list(others)
+                break
+            sections.append(section)
+            used += cost
+        summarized = len(sections)
+        if others:
+            listed = []
+            for path, files in others:
+                entry = f"{path} ({files} files)"
+                cost = self.counter.count(entry + ", ")
+                if used + cost > share + MIN_SECTION_TOKENS:
+                    listed.append(f"... (+{len(others) - len(listed)} more)")
+                    break
+                listed.append(entry)
+                used += cost
+            sections.append("Other packages: " + ", ".join(listed))
+        packages_text = "\n".join(sections)
+        packages_tokens = self.counter.count(packages_text)
+
+        rest = budget - packages_tokens
+        tree_full = self.counter.count(file_tree)
+        tree_cap = min(tree_full, max(rest // 2, rest - self.counter.count(readme)))
+        readme_text, readme_tokens = self._fit_readme(readme, rest - tree_cap)
+        tree_text, tree_tokens = self._fit_tree(file_tree, rest - readme_tokens)
+
+        text = header + packages_text + tree_start + tree_text + middle + readme_text + footer
+        prompt_tokens = system_tokens + self.counter.count(text)
+        max_output = max(0, min(self.max_output_tokens, self.context_window - prompt_tokens - SAFETY_MARGIN))
+        self._record(prompt_tokens)
+        logger.info(f"Hierarchical prompt for {username}/{repo}: {summarized} package summaries "
+                    f"({packages_tokens} tokens), {len(others)} more packages by name")
+        return Prompt(text, prompt_tokens, tree_tokens + packages_tokens, readme_tokens, budget, max_output,
+                      cache_key=generic + text[len(context):], aliases=aliases)
+
+    def summary_tokens(self, packages: int, cap: int) -> int:
+        """Output tokens per package summary so that `packages` of them fill a hierarchical prompt."""
+        limit = min(self.max_prompt_tokens, self.context_window - self.output_reserve)
+        share = int(limit * PACKAGES_SHARE / max(1, packages))
+        return max(MIN_SUMMARY_TOKENS, min(cap, share))
+
+    def build_update(self, username: str, repo: str, diagram: str, changes: List[str],
+                     diagram_type: str, system_prompt: str) -> Optional[Prompt]:
+        """
+        Prompt asking to update `diagram` for the changed files in `changes`.
+        None when it doesn't fit, or leaves too little output room for the
+        updated diagram; the caller then regenerates from scratch.
+        """
+        # Click links keep pointing where the previous diagram's did
+        match = re.search(rf"https://github\.com/{re.escape(username)}/{re.escape(repo)}/blob/[^/\s\"]+/",
+                          diagram, re.I)
+        base_url = match.group(0) if match else f"https://github.com/{username}/{repo}/blob/HEAD/"
+        change_list = "\n".join(changes)
+        text = MERMAID_UPDATE_PROMPT.format(repo=f"{username}/{repo}", base_url=base_url, diagram_type=diagram_type,
+                                            diagram=diagram, changes=change_list)
+
+        limit = min(self.max_prompt_tokens, self.context_window - self.output_reserve)
+        prompt_tokens = self.counter.count(system_prompt) + self.counter.count(text)
+        max_output = max(0, min(self.max_output_tokens, self.context_window - prompt_tokens - SAFETY_MARGIN))
+        # The updated diagram needs room to grow past the previous one
+        needed = self.counter.count(diagram) * 5 // 4
+        if prompt_tokens > limit or max_output < needed:
+            logger.info(f"Update prompt for {username}/{repo} ({diagram_type}) does not fit: {prompt_tokens} "
+                        f"prompt tokens (limit {limit}), {max_output} output tokens for a ~{needed} token diagram")
+            return None
+        self._record(prompt_tokens)
+        return Prompt(text, prompt_tokens, self.counter.count(change_list), 0, limit, max_output, incremental=True)
+
+    def _fit_tree(self, tree: str, budget: int) -> Tuple[str, int]:
+        """Drops the deepest paths first; directory summary lines are kept longest."""
+        tokens = self.counter.count(tree)
+        if tokens <= budget:
+            return tree, tokens
+
+        lines = tree.split("\n")
+        order = sorted(range(len(lines)),
+                       key=lambda i: ("..." not in lines[i], lines[i].count("/"), i))
+        note = "... (listing shortened)"
+        used = self.counter.count(note)
+        keep = set()
+        for i in order:
+            cost = self.counter.count(lines[i] + "\n")
+            if used + cost > budget:
+                continue
+            keep.add(i)
+            used += cost
+        text = "\n".join([line for i, line in enumerate(lines) if i in keep] + [note])
+        fitted = self.counter.count(text)
+        logger.info(f"File tree shortened from {tokens} to {fitted} tokens ({len(keep)}/{len(lines)} lines)")
+        return text, fitted
+
+    def _fit_readme(self, readme: str, budget: int) -> Tuple[str, int]:
+        sections = self._split_sections(readme)
+        chosen = {}
+        omitted = []
+        used = 0
+        for section in sorted(sections, key=lambda s: (s.priority is SKIP_SECTION, s.priority or 0, s.index)):
+            if section.priority is SKIP_SECTION:
+                omitted.append(section.title)
+                continue
+            if used + section.tokens <= budget:
+                chosen[section.index] = section.text
+                used += section.tokens
+            elif budget - used >= MIN_SECTION_TOKENS:
+                text = self._truncate(section.text, budget - used - MIN_SECTION_TOKENS // 2)
+                chosen[section.index] = text + "\n... (truncated) ..."
+                used = budget
+                omitted.append(section.title + " (partly)")
+            else:
+                omitted.append(section.title)
+
+        text = "\n".join(chosen[i] for i in sorted(chosen))
+        if omitted:
+            text += f"\n... (omitted sections: {', '.join(t for t in omitted if t)})"
+        tokens = self.counter.count(text)
+        if omitted:
+            logger.info(f"README fitted to {tokens} tokens: {len(chosen)} of {len(sections)} sections kept")
+        return text, tokens
+
+    def _split_sections(self, readme: str) -> List[_Section]:
+        """Splits on markdown headings (outside code fences); sub-sections inherit their parent's priority."""
+        sections: List[_Section] = []
+        title, lines, priority = "Introduction", [], 0
+        parents: List[Tuple[int, Optional[int]]] = []
+        in_code = False
+
+        def flush():
+            text = "\n".join(lines).strip("\n")
+            if text.strip():
+                sections.append(_Section(len(sections), title, priority, text, self.counter.count(text) + 1))
+
+        for line in readme.split("\n"):
+            if line.lstrip().startswith("```"):
+                in_code = not in_code
+            heading = None if in_code else _HEADING.match(line)
+            if heading:
+                flush()
+                level = len(heading.group(1))
+                title, lines = heading.group(2).strip(), [line]
+                while parents and parents[-1][0] >= level:
+                    parents.pop()
+                priority = self._priority(title, parents[-1][1] if parents else DEFAULT_SECTION_PRIORITY)
+                parents.append((level, priority))
+            elif in_code or not _BADGE_LINE.match(line):
+                lines.append(line)
+        flush()
+        return sections
+
+    @staticmethod
+    def _priority(title: str, inherited: Optional[int]) -> Optional[int]:
+        lowered = title.lower()
+        for pattern, priority in SECTION_PRIORITIES:
+            if pattern.search(lowered):
+                return priority
+        return inherited
+
+    def _truncate(self, text: str, budget: int) -> str:
+        out, used = [], 0
+        for line in text.split("\n"):
+            cost = self.counter.count(line + "\n")
+            if used + cost > budget:
+                break
+            out.append(line)
+            used += cost
+        return "\n".join(out)
+
+    def _record(self, prompt_tokens: int):
+        with self._lock:
+            self.requests += 1
+            self.total_tokens += prompt_tokens
+            self.largest = max(self.largest, prompt_tokens)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "avg_prompt_tokens": round(self.total_tokens / self.requests) if self.requests else 0,
+                "max_prompt_tokens": self.largest,
+                "context_window": self.context_window,
+            }
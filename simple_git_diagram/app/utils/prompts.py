@@ -128,3 +128,56 @@ ADD LOCATIONS:
 
 Output ONLY the Mermaid code. Start with 'flowchart TD'. No markdown code blocks.
 """
+
+MERMAID_REPAIR_PROMPT = """
+The Mermaid {diagram_type} diagram below fails to parse.
+
+Errors:
+{errors}
+
+<DIAGRAM>
+{diagram}
+</DIAGRAM>
+
+Fix ONLY the syntax errors. Keep every node, edge, subgraph, style and click directive that is valid.
+Wrap labels containing parentheses or other special characters in double quotes.
+Output ONLY the corrected Mermaid code. No explanations, no markdown code blocks.
+"""
+
+MERMAID_UPDATE_PROMPT = """
+<CONTEXT>
+Repo: {repo}
+Base URL: {base_url}
+</CONTEXT>
+
+The Mermaid {diagram_type} diagram below was generated from an earlier commit of this repository.
+
+<DIAGRAM>
+{diagram}
+</DIAGRAM>
+
+Since then these files changed (A = added, D = deleted, M = modified, R = renamed):
+
+<CHANGES>
+{changes}
+</CHANGES>
+
+Update the diagram to match the repository as it is now:
+- Add nodes for new components and remove nodes whose files were deleted.
+- Follow renames in node labels and `click` links.
+- Keep everything the changes don't affect exactly as it is: node IDs, labels, edges, subgraphs, styles and click directives.
+Output ONLY the complete updated Mermaid code. No explanations, no markdown code blocks.
+"""
+
+SYSTEM_PACKAGE_SUMMARY_PROMPT = """
+You are a Principal Software Architect. You are given the file listing of ONE package (directory) of a
+repository too large to diagram in one pass. Your summary will be combined with the summaries of the
+other packages to draw an architecture diagram of the whole repository.
+
+In at most {words} words of plain text, describe:
+- What the package is for (service, library, CLI, frontend, infrastructure, ...).
+- Its main components, each with the path of its key file (relative to the package).
+- Its entry points, and which other packages or external systems (databases, queues, APIs) it likely talks to.
+
+Do not speculate beyond what the file names suggest. No Mermaid code, no markdown headings.
+"""
@@ -0,0 +1,120 @@
+import contextvars
+import re
+import time
+import uuid
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional
+
+from flask import Flask, g, request
+
+from .metrics import HTTP_SECONDS, STAGE_SECONDS
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Set per request (or job / background task) and copied into worker threads
+_request_id: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+# Stage -> seconds for the current request, summed when a stage runs more than once
+_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar("timings", default=None)
+
+# Incoming X-Request-ID values are reused only when they look like an id
+_VALID_ID = re.compile(r'^[\w.:-]{1,64}$')
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def current_request_id() -> str:
+    return _request_id.get()
+
+
+class RequestIdFilter(logging.Filter):
+    """Adds %(request_id)s to every record, "-" outside a request."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = _request_id.get()
+        return True
+
+
+def stage_summary() -> str:
+    """The stage timings of the current request as " (fetch=0.120s llm=8.000s ...)", or "" when no stage ran."""
+    timings = _timings.get() or {}
+    stages = " ".join(f"{stage}={seconds:.3f}s" for stage, seconds in timings.items())
+    return f" ({stages})" if stages else ""
+
+
+def submit_traced(pool: Executor, fn: Callable, *args, **kwargs) -> Future:
+    """pool.submit() that keeps the caller's request id and stage timings in the worker thread."""
+    return pool.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+@contextmanager
+def bind_request_id(request_id: Optional[str] = None) -> Iterator[str]:
+    """Tags log lines and stage timings in this block with `request_id` (a new one by default)."""
+    request_id = request_id or new_request_id()
+    id_token = _request_id.set(request_id)
+    timings_token = _timings.set({})
+    try:
+        yield request_id
+    finally:
+        _timings.reset(timings_token)
+        _request_id.reset(id_token)
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Records how long the block took in the stage histogram and the current request's timings."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        timings = _timings.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+def init_tracing(app: Flask):
+    """
+    Gives every request an id (the client's X-Request-ID when it sends a
+    sane one), echoes it in the response and logs one line per request with
+    its status, total time and time per pipeline stage. Streamed responses
+    are measured until their last event.
+    """
+
+    @app.before_request
+    def start_request():
+        incoming = request.headers.get("X-Request-ID", "")
+        g.request_id = incoming if _VALID_ID.match(incoming) else new_request_id()
+        g.trace_tokens = (_request_id.set(g.request_id), _timings.set({}))
+        g.started = time.perf_counter()
+
+    @app.after_request
+    def tag_response(response):
+        if "request_id" in g:
+            response.headers["X-Request-ID"] = g.request_id
+            g.status = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_request(error=None):
+        if "trace_tokens" not in g:
+            return
+        elapsed = time.perf_counter() - g.started
+        status = 500 if error is not None else g.get("status", 500)
+        endpoint = request.endpoint or "unknown"
+        HTTP_SECONDS.observe(elapsed, method=request.method, endpoint=endpoint, status=status)
+        # Static files and readiness probes would drown out the rest
+        if endpoint not in ("static", "main.ready"):
+            logger.info(f"{request.method} {request.path} {status} in {elapsed:.3f}s{stage_summary()}")
+        id_token, timings_token = g.pop("trace_tokens")
+        try:
+            _timings.reset(timings_token)
+            _request_id.reset(id_token)
+        except ValueError:
+            # Torn down in another context than the one it started in (nothing to undo there)
+            pass
@@ -0,0 +1,111 @@
+"""
+Generates diagrams for many repositories at once, straight into the cache.
+
+    python batch.py owner/repo other/repo              # listed repositories
+    python batch.py --file repos.txt --types all       # one owner/repo or URL per line
+    python batch.py --org my-org --types flowchart,c4  # every repository of an organization
+    python batch.py --org my-org --fetch-workers 16 --llm-workers 8 --batch-size 50
+
+Diagrams already at the repository's HEAD are skipped, so a rerun only
+regenerates what changed. Progress goes to the --checkpoint file: after an
+interruption (Ctrl-C, SIGTERM, a crash) the same command resumes where it
+stopped and retries failed repositories. The checkpoint is removed once a
+run finishes without failures. Uses the same settings (.env) as the server.
+"""
+import argparse
+import os
+import signal
+import sys
+
+from dotenv import load_dotenv
+
+
+def main(argv=None) -> int:
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("repos", nargs="*", help="owner/repo or GitHub URLs")
+    parser.add_argument("--file", action="append", default=[], help="file with one repository per line ('-': stdin)")
+    parser.add_argument("--org", action="append", default=[], help="every repository of this organization or user")
+    parser.add_argument("--include-forks", action="store_true", help="with --org, forks too")
+    parser.add_argument("--include-archived", action="store_true", help="with --org, archived repositories too")
+    parser.add_argument("--types", default="flowchart", help="comma separated diagram types or 'all' (default: %(default)s)")
+    parser.add_argument("--fetch-workers", type=int, default=8, help="repositories fetched at a time")
+    parser.add_argument("--llm-workers", type=int, default=int(os.getenv("LLM_MAX_CONCURRENCY", 4)),
+                        help="LLM calls at a time (default: LLM_MAX_CONCURRENCY)")
+    parser.add_argument("--batch-size", type=int, default=20, help="repositories per database transaction")
+    parser.add_argument("--checkpoint", default="batch_checkpoint.jsonl", help="progress file (default: %(default)s)")
+    parser.add_argument("--restart", action="store_true", help="ignore the progress in --checkpoint")
+    parser.add_argument("--force", action="store_true", help="regenerate even diagrams already at HEAD")
+    parser.add_argument("--pat", help="GitHub token for private repositories (default: the configured pool)")
+    args = parser.parse_args(argv)
+
+    # The LLM stage is bounded by the service's own slots, and each fetch runs four GitHub requests
+    os.environ["LLM_MAX_CONCURRENCY"] = str(max(1, args.llm_workers))
+    os.environ.setdefault("LLM_QUEUE_TIMEOUT", os.getenv("LLM_DEADLINE", "300"))
+    for name in ("GITHUB_FETCH_WORKERS", "GITHUB_POOL_SIZE"):
+        os.environ[name] = str(max(int(os.getenv(name, 16)), 4 * args.fetch_workers))
+    os.environ["PREWARM_ENABLED"] = "false"
+    os.environ["WARMUP_ENABLED"] = "false"
+
+    # Imported only now: the services read their settings at import time
+    from app import create_app, pending_schema_changes
+    from app.routes import diagram_service
+    from app.services.batch_service import BatchRunner, Checkpoint
+    from app.services.diagram_service import DIAGRAM_TYPES, parse_repo_url
+    from app.services.github_service import GitHubService
+
+    if args.types == "all":
+        types = DIAGRAM_TYPES
+    else:
+        types = tuple(t.strip() for t in args.types.split(",") if t.strip())
+        unknown = [t for t in types if t not in DIAGRAM_TYPES]
+        if unknown or not types:
+            parser.error(f"--types must be 'all' or a list of: {', '.join(DIAGRAM_TYPES)}")
+
+    app = create_app()
+    with app.app_context():
+        pending = pending_schema_changes()
+    if pending:
+        print(f"The database schema is out of date ({', '.join(pending)}); run migrate.py first.", file=sys.stderr)
+        return 1
+    repos = []
+    entries = list(args.repos)
+    for path in args.file:
+        with (sys.stdin if path == "-" else open(path, encoding="utf-8")) as f:
+            entries += [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+    for entry in entries:
+        try:
+            repos.append(parse_repo_url(entry))
+        except IndexError:
+            print(f"Ignoring malformed repository: {entry}", file=sys.stderr)
+    for org in args.org:
+        names = GitHubService(pat=args.pat).list_repos(org, args.include_forks, args.include_archived)
+        repos += [(org, name) for name in names]
+    if not repos:
+        parser.error("no repositories given")
+
+    checkpoint = Checkpoint(args.checkpoint)
+    if args.restart:
+        checkpoint.reset()
+    runner = BatchRunner(diagram_service, types, fetch_workers=args.fetch_workers, llm_workers=args.llm_workers,
+                         batch_size=args.batch_size, checkpoint=checkpoint, force=args.force, pat=args.pat)
+    # SIGTERM finishes what is running and commits it; Ctrl-C commits what has finished
+    signal.signal(signal.SIGTERM, lambda signum, frame: runner.stop())
+    try:
+        counts = runner.run(app, repos)
+    except KeyboardInterrupt:
+        print(f"\nInterrupted. Run the same command again to resume from {args.checkpoint}.", file=sys.stderr)
+        return 130
+
+    print(f"{counts['repositories']} repositories in {counts['seconds']}s: {counts['done']} generated "
+          f"({counts['stored']} diagrams stored), {counts['unchanged']} unchanged, {counts['missing']} missing, "
+          f"{counts['failed']} failed, {counts['resumed']} done in an earlier run")
+    if counts["failed"] or runner.interrupted:
+        print(f"Run the same command again to retry, progress is in {args.checkpoint}.", file=sys.stderr)
+        return 1
+    checkpoint.reset()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,192 @@
+"""
+Golden-file check and benchmark for clean_mermaid_code.
+
+Runs the cleaner over the raw LLM outputs in mermaid_corpus/<diagram_type>/,
+compares each result with its .golden.mmd file and reports latency
+percentiles, throughput and tracemalloc memory per diagram type.
+
+    python benchmarks/bench_mermaid.py                  # check + benchmark
+    python benchmarks/bench_mermaid.py --check-only     # golden check only
+    python benchmarks/bench_mermaid.py --update-golden  # rewrite golden files
+    python benchmarks/bench_mermaid.py --impl some.module:clean_fn
+
+Exits with status 1 when any output differs from its golden file, so a
+rewrite of the cleaner can be shown to be equivalent before comparing speed.
+"""
+import argparse
+import difflib
+import importlib
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, NamedTuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mermaid_corpus")
+DIAGRAM_TYPES = ("flowchart", "class", "state", "c4")
+GOLDEN_SUFFIX = ".golden.mmd"
+
+
+class Sample(NamedTuple):
+    name: str
+    diagram_type: str
+    raw: str
+    golden_path: str
+
+
+def load_corpus(corpus_dir: str = CORPUS_DIR) -> List[Sample]:
+    samples = []
+    for diagram_type in DIAGRAM_TYPES:
+        type_dir = os.path.join(corpus_dir, diagram_type)
+        if not os.path.isdir(type_dir):
+            continue
+        for filename in sorted(os.listdir(type_dir)):
+            if not filename.endswith(".txt"):
+                continue
+            path = os.path.join(type_dir, filename)
+            with open(path, encoding="utf-8", newline="") as f:
+                raw = f.read()
+            golden_path = path[:-len(".txt")] + GOLDEN_SUFFIX
+            samples.append(Sample(f"{diagram_type}/{filename}", diagram_type, raw, golden_path))
+    return samples
+
+
+def load_impl(spec: str) -> Callable[[str, str], str]:
+    module_name, _, attr = spec.partition(":")
+    return getattr(importlib.import_module(module_name), attr or "clean_mermaid_code")
+
+
+def check_golden(clean: Callable, samples: List[Sample], update: bool = False) -> int:
+    """Returns the number of samples whose output differs from (or lacks) a golden file."""
+    failures = 0
+    for sample in samples:
+        output = clean(sample.raw, sample.diagram_type)
+        if update:
+            with open(sample.golden_path, "w", encoding="utf-8", newline="") as f:
+                f.write(output)
+            print(f"  wrote {os.path.relpath(sample.golden_path, CORPUS_DIR)}")
+            continue
+        if not os.path.exists(sample.golden_path):
+            print(f"  MISSING golden for {sample.name} (run with --update-golden)")
+            failures += 1
+            continue
+        with open(sample.golden_path, encoding="utf-8", newline="") as f:
+            expected = f.read()
+        if output != expected:
+            failures += 1
+            print(f"  MISMATCH {sample.name}")
+            diff = difflib.unified_diff(expected.splitlines(), output.splitlines(),
+                                        "golden", "output", lineterm="", n=1)
+            for line in list(diff)[:40]:
+                print(f"    {line}")
+    return failures
+
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def benchmark(clean: Callable, samples: List[Sample], iterations: int, warmup: int = 3) -> Dict[str, dict]:
+    """Per diagram type (plus "all"): latency percentiles in microseconds, MB/s and memory."""
+    groups: Dict[str, List[Sample]] = {}
+    for sample in samples:
+        groups.setdefault(sample.diagram_type, []).append(sample)
+    groups["all"] = list(samples)
+
+    results = {}
+    for group, group_samples in groups.items():
+        latencies = []
+        total_bytes = 0
+        for sample in group_samples:
+            for _ in range(warmup):
+                clean(sample.raw, sample.diagram_type)
+            size = len(sample.raw.encode("utf-8"))
+            for _ in range(iterations):
+                start = time.perf_counter_ns()
+                clean(sample.raw, sample.diagram_type)
+                latencies.append((time.perf_counter_ns() - start) / 1000)
+                total_bytes += size
+
+        # Memory is measured separately since tracing distorts timings
+        peaks, blocks = [], []
+        for sample in group_samples:
+            tracemalloc.start()
+            before = tracemalloc.take_snapshot()
+            tracemalloc.reset_peak()
+            clean(sample.raw, sample.diagram_type)
+            _, peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            peaks.append(peak)
+            blocks.append(sum(max(stat.count_diff, 0) for stat in after.compare_to(before, "lineno")))
+
+        latencies.sort()
+        total_seconds = sum(latencies) / 1e6
+        results[group] = {
+            "samples": len(group_samples),
+            "calls": len(latencies),
+            "p50_us": round(_percentile(latencies, 50), 1),
+            "p99_us": round(_percentile(latencies, 99), 1),
+            "mean_us": round(statistics.fmean(latencies), 1),
+            "throughput_mb_s": round(total_bytes / 1e6 / total_seconds, 2) if total_seconds else 0.0,
+            "peak_kib_max": round(max(peaks) / 1024, 1),
+            "retained_blocks_max": max(blocks),
+        }
+    return results
+
+
+def print_report(results: Dict[str, dict]):
+    header = f"{'type':<10}{'files':>6}{'calls':>8}{'p50 us':>10}{'p99 us':>10}{'MB/s':>9}{'peak KiB':>10}{'blocks':>8}"
+    print(header)
+    print("-" * len(header))
+    for group, r in results.items():
+        print(f"{group:<10}{r['samples']:>6}{r['calls']:>8}{r['p50_us']:>10}{r['p99_us']:>10}"
+              f"{r['throughput_mb_s']:>9}{r['peak_kib_max']:>10}{r['retained_blocks_max']:>8}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--impl", default="app.utils.mermaid_utils:clean_mermaid_code",
+                        help="module:function to benchmark (default: %(default)s)")
+    parser.add_argument("--iterations", type=int, default=200, help="timed calls per sample")
+    parser.add_argument("--check-only", action="store_true", help="only compare against golden files")
+    parser.add_argument("--update-golden", action="store_true", help="rewrite golden files from --impl")
+    parser.add_argument("--json", metavar="PATH", help="also write the benchmark results as JSON")
+    args = parser.parse_args(argv)
+
+    # The cleaner logs at DEBUG only; keep handlers out of the measurement
+    logging.disable(logging.INFO)
+
+    clean = load_impl(args.impl)
+    samples = load_corpus()
+    if not samples:
+        print(f"No corpus found in {CORPUS_DIR}")
+        return 1
+
+    print(f"Golden check ({len(samples)} samples, {args.impl}):")
+    failures = check_golden(clean, samples, update=args.update_golden)
+    if args.update_golden:
+        return 0
+    print(f"  {len(samples) - failures} passed, {failures} failed")
+    if failures:
+        return 1
+    if args.check_only:
+        return 0
+
+    print(f"\nBenchmark ({args.iterations} iterations per sample):")
+    results = benchmark(clean, samples, args.iterations)
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"impl": args.impl, "results": results}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
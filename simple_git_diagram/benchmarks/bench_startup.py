@@ -0,0 +1,166 @@
+"""
+Cold-start benchmark with a time budget.
+
+Starts fresh interpreters against a throwaway, already migrated database
+holding one cached diagram, and measures in each:
+
+    import      `from app import create_app`
+    create_app  building the app with the deployment's defaults
+    first       the first request, a cache hit on GET /diagram/...
+    ready       until GET /ready answers 200 (background warm-up)
+
+    python benchmarks/bench_startup.py                  # check the budget
+    python benchmarks/bench_startup.py --runs 10 --top 15
+    python benchmarks/bench_startup.py --boot-budget-ms 400 --first-budget-ms 20
+
+Exits with status 1 when the median import + create_app time or the
+median first request exceeds its budget, or when a module that should
+load lazily (openai, tiktoken) is imported while booting.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Loaded by the first LLM call or the warm-up, never while booting
+LAZY_MODULES = ("openai", "tiktoken")
+REPO, DIAGRAM_TYPE = "bench/startup", "flowchart"
+
+SEED = f"""
+from datetime import datetime
+from app import create_app, db, migrate_schema
+from app.models import DiagramCache
+app = create_app()
+with app.app_context():
+    migrate_schema()
+    now = datetime.utcnow()
+    db.session.add(DiagramCache(repo_url={REPO!r}, diagram_type={DIAGRAM_TYPE!r}, diagram_content="flowchart TD\\n  A --> B",
+                                commit_sha="0" * 40, validated_at=now, last_accessed_at=now))
+    db.session.commit()
+"""
+
+MEASURE = f"""
+import json, sys, time
+started = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+lazy = [name for name in {LAZY_MODULES!r} if name in sys.modules]
+client = app.test_client()
+status = client.get("/diagram/{REPO}/{DIAGRAM_TYPE}?format=mmd").status_code
+first = time.perf_counter()
+while client.get("/ready").status_code != 200 and time.perf_counter() - created < 60:
+    time.sleep(0.002)
+ready = time.perf_counter()
+print(json.dumps({{"import_ms": (imported - started) * 1000, "create_app_ms": (created - imported) * 1000,
+                  "first_ms": (first - created) * 1000, "ready_ms": (ready - created) * 1000,
+                  "status": status, "lazy_loaded": lazy}}))
+"""
+
+
+def _run(code: str, env: Dict[str, str], *flags: str) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, *flags, "-c", code], cwd=ROOT, env=env,
+                          capture_output=True, text=True, timeout=120)
+
+
+def measure(runs: int, env: Dict[str, str]) -> List[dict]:
+    samples = []
+    for _ in range(runs):
+        proc = _run(MEASURE, env)
+        if proc.returncode != 0:
+            raise RuntimeError(f"Measurement failed:\n{proc.stderr[-2000:]}")
+        samples.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+    return samples
+
+
+def slowest_imports(env: Dict[str, str], top: int) -> List[tuple]:
+    """(cumulative ms, module) of the slowest imports while booting, from -X importtime."""
+    proc = _run("from app import create_app; create_app()", env, "-X", "importtime")
+    timings = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            timings.append((int(cumulative) / 1000, module.strip()))
+    return sorted(timings, reverse=True)[:top]
+
+
+def summarize(samples: List[dict]) -> Dict[str, dict]:
+    results = {}
+    for key in ("import_ms", "create_app_ms", "first_ms", "ready_ms"):
+        values = sorted(s[key] for s in samples)
+        results[key[:-3]] = {"median_ms": round(statistics.median(values), 1), "max_ms": round(values[-1], 1)}
+    boot = sorted(s["import_ms"] + s["create_app_ms"] for s in samples)
+    results["boot"] = {"median_ms": round(statistics.median(boot), 1), "max_ms": round(boot[-1], 1)}
+    return results
+
+
+def print_report(results: Dict[str, dict]):
+    header = f"{'stage':<12}{'median ms':>11}{'max ms':>10}"
+    print(header)
+    print("-" * len(header))
+    for stage, r in results.items():
+        print(f"{stage:<12}{r['median_ms']:>11}{r['max_ms']:>10}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters to measure")
+    parser.add_argument("--boot-budget-ms", type=float, default=750, help="median import + create_app budget")
+    parser.add_argument("--first-budget-ms", type=float, default=50, help="median first request budget")
+    parser.add_argument("--top", type=int, default=0, help="also list the N slowest imports while booting")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="gitdiagram-startup-") as workdir:
+        env = dict(os.environ,
+                   DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'startup.db')}",
+                   LLM_CACHE_PATH=os.path.join(workdir, "llm_cache.db"),
+                   PREWARM_ENABLED="false", LOG_LEVEL="WARNING")
+        # Measured as deployed; the schema step is migrate.py's, not boot's
+        env.pop("DB_AUTO_MIGRATE", None)
+        seed = _run(SEED, env)
+        if seed.returncode != 0:
+            print(f"Seeding the database failed:\n{seed.stderr[-2000:]}")
+            return 1
+
+        print(f"Startup ({args.runs} runs):")
+        samples = measure(args.runs, env)
+        results = summarize(samples)
+        print_report(results)
+        if args.top:
+            print(f"\nSlowest imports while booting (cumulative):")
+            for ms, module in slowest_imports(env, args.top):
+                print(f"  {ms:>8.1f} ms  {module}")
+
+    failures = []
+    if any(s["status"] != 200 for s in samples):
+        failures.append(f"first request answered {sorted({s['status'] for s in samples})}, expected 200")
+    lazy = sorted({name for s in samples for name in s["lazy_loaded"]})
+    if lazy:
+        failures.append(f"imported while booting: {', '.join(lazy)}")
+    if results["boot"]["median_ms"] > args.boot_budget_ms:
+        failures.append(f"boot {results['boot']['median_ms']} ms > budget {args.boot_budget_ms:g} ms")
+    if results["first"]["median_ms"] > args.first_budget_ms:
+        failures.append(f"first request {results['first']['median_ms']} ms > budget {args.first_budget_ms:g} ms")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"runs": args.runs, "results": results, "failures": failures}, f, indent=2)
+    for failure in failures:
+        print(f"FAIL {failure}")
+    if not failures:
+        print(f"\nWithin budget (boot {args.boot_budget_ms:g} ms, first request {args.first_budget_ms:g} ms)")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
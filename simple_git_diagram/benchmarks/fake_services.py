@@ -0,0 +1,393 @@
+"""
+Local stand-ins for the GitHub REST API and an OpenAI-compatible LLM, so the
+whole service can be exercised without network access or API keys.
+
+FakeGitHub answers the endpoints GitHubService uses with generated
+repositories: trees of a configurable size, HEAD ETags (304s cost no
+quota, as on GitHub), a per-token quota with X-RateLimit-* headers and
+optional 429s with Retry-After. FakeLLM answers /v1/chat/completions,
+streamed or not, with a valid Mermaid flowchart of a given length,
+produced at a given token rate after a given time to first token.
+
+load_test.py starts both in-process. To put them in front of a separately
+started server (e.g. gunicorn), run them on their own and point the server
+at them with GITHUB_API_URL and LLM_BASE_URL:
+
+    python benchmarks/fake_services.py --github-port 9001 --llm-port 9002
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+# Characters per generated token, as estimated elsewhere in the app
+CHARS_PER_TOKEN = 4
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # Load tests open many connections at once
+    request_queue_size = 1024
+
+
+class _FakeService:
+    handler = BaseHTTPRequestHandler
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self._lock = threading.Lock()
+        self.counts: Dict[str, int] = {}
+        self.server = _Server((host, port), self.handler)
+        self.server.service = self
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "_FakeService":
+        self._thread = threading.Thread(target=self.server.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counts)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def send_body(self, status: int, body: bytes, content_type: str = "application/json",
+                  headers: Optional[Dict[str, str]] = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _GitHubHandler(_Handler):
+    def do_GET(self):
+        service: FakeGitHub = self.service
+        service.count("requests")
+        if service.latency:
+            time.sleep(service.latency)
+
+        parts = urlparse(self.path).path.strip("/").split("/")
+        if len(parts) < 3 or parts[0] != "repos":
+            service.count("not_found")
+            return self.send_body(404, b'{"message": "Not Found"}')
+        owner, repo, rest = parts[1], parts[2], parts[3:]
+
+        token = self.headers.get("Authorization") or self.client_address[0]
+        conditional = self.headers.get("If-None-Match")
+        head_sha = service.head_sha(owner, repo)
+        if rest[:2] == ["commits", "HEAD"] and conditional == f'"{head_sha}"':
+            # Not counted against the quota, like on GitHub
+            service.count("not_modified")
+            return self.send_body(304, b"", headers={"ETag": conditional, **service.quota_headers(token)})
+
+        if service.throttle_ratio and random.random() < service.throttle_ratio:
+            service.count("throttled")
+            return self.send_body(429, b'{"message": "You have exceeded a secondary rate limit."}',
+                                  headers={"Retry-After": "1"})
+        remaining = service.take_quota(token)
+        headers = service.quota_headers(token)
+        if remaining < 0:
+            service.count("rate_limited")
+            return self.send_body(403, b'{"message": "API rate limit exceeded"}', headers=headers)
+
+        if repo.startswith("missing"):
+            service.count("not_found")
+            return self.send_body(404, b'{"message": "Not Found"}', headers=headers)
+        if not rest:
+            body = json.dumps({"full_name": f"{owner}/{repo}", "default_branch": "main"}).encode()
+            return self.send_body(200, body, headers=headers)
+        if rest[:2] == ["commits", "HEAD"]:
+            return self.send_body(200, head_sha.encode(), "application/vnd.github.sha",
+                                  headers={"ETag": f'"{head_sha}"', **headers})
+        if rest[:2] == ["git", "trees"]:
+            service.count("trees")
+            return self.send_body(200, service.tree(owner, repo), headers=headers)
+        if rest == ["readme"]:
+            body = f"# {repo}\n\nA generated repository for load testing.\n\n## Architecture\n\n" \
+                   f"Modules under src/ talk to each other through services.\n".encode()
+            return self.send_body(200, body, "text/plain", headers=headers)
+        # The compare API is not faked: incremental updates fall back to full generations
+        service.count("not_found")
+        return self.send_body(404, b'{"message": "Not Found"}', headers=headers)
+
+
+class FakeGitHub(_FakeService):
+    """
+    Repositories exist for any owner/name except names starting with
+    "missing". Tree sizes are picked per repository from `tree_sizes`;
+    `quota` requests per token every `window` seconds, then 403s.
+    """
+    handler = _GitHubHandler
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, tree_sizes: Tuple[int, ...] = (200,),
+                 latency: float = 0.0, quota: int = 5000, window: float = 3600.0, throttle_ratio: float = 0.0):
+        super().__init__(host, port)
+        self.tree_sizes = tuple(tree_sizes) or (200,)
+        self.latency = latency
+        self.quota = quota
+        self.window = window
+        self.throttle_ratio = throttle_ratio
+        self._trees: Dict[int, bytes] = {}
+        self._quotas: Dict[str, Tuple[float, int]] = {}
+        # Bumped by push() to move a repository's HEAD
+        self._generations: Dict[str, int] = {}
+
+    @property
+    def api_url(self) -> str:
+        return self.base_url
+
+    def push(self, owner: str, repo: str):
+        """Moves the HEAD of owner/repo to a new commit."""
+        key = f"{owner}/{repo}".lower()
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+
+    def head_sha(self, owner: str, repo: str) -> str:
+        key = f"{owner}/{repo}".lower()
+        return hashlib.sha1(f"{key}:{self._generations.get(key, 0)}".encode()).hexdigest()
+
+    def tree_size(self, owner: str, repo: str) -> int:
+        digest = hashlib.md5(f"{owner}/{repo}".lower().encode()).digest()
+        return self.tree_sizes[digest[0] % len(self.tree_sizes)]
+
+    def tree(self, owner: str, repo: str) -> bytes:
+        size = self.tree_size(owner, repo)
+        body = self._trees.get(size)
+        if body is None:
+            body = self._trees[size] = json.dumps({
+                "sha": hashlib.sha1(str(size).encode()).hexdigest(),
+                "tree": _tree_entries(size),
+                "truncated": False,
+            }).encode()
+        return body
+
+    def take_quota(self, token: str) -> int:
+        """Spends one request of `token`'s quota; returns what is left (negative once exceeded)."""
+        now = time.time()
+        with self._lock:
+            reset_at, used = self._quotas.get(token, (now + self.window, 0))
+            if now >= reset_at:
+                reset_at, used = now + self.window, 0
+            used += 1
+            self._quotas[token] = (reset_at, used)
+            return self.quota - used
+
+    def quota_headers(self, token: str) -> Dict[str, str]:
+        with self._lock:
+            reset_at, used = self._quotas.get(token, (time.time() + self.window, 0))
+        return {
+            "X-RateLimit-Limit": str(self.quota),
+            "X-RateLimit-Remaining": str(max(0, self.quota - used)),
+            "X-RateLimit-Reset": str(int(reset_at)),
+            "X-RateLimit-Resource": "core",
+        }
+
+
+def _tree_entries(size: int) -> List[dict]:
+    """A plausible project layout with `size` files, some of them excluded from prompts."""
+    entries = [{"path": "README.md", "type": "blob"}, {"path": "pyproject.toml", "type": "blob"}]
+    for i in range(max(0, size - len(entries))):
+        package = f"src/pkg{i // 40}"
+        if i % 40 == 0:
+            entries.append({"path": package, "type": "tree", "sha": hashlib.sha1(package.encode()).hexdigest()})
+        kind = i % 10
+        if kind == 8:
+            path = f"tests/pkg{i // 40}/test_module{i}.py"
+        elif kind == 9:
+            path = f"{package}/assets/icon{i}.png"
+        else:
+            path = f"{package}/module{i}.py"
+        entries.append({"path": path, "type": "blob"})
+    return entries
+
+
+class _LLMHandler(_Handler):
+    def do_POST(self):
+        service: FakeLLM = self.service
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            return self.send_body(404, b'{"error": {"message": "Not Found"}}')
+        service.begin()
+        try:
+            if service.error_ratio and random.random() < service.error_ratio:
+                service.count("errors")
+                time.sleep(service.latency)
+                return self.send_body(500, b'{"error": {"message": "injected failure", "type": "server_error"}}')
+            prompt_chars = sum(len(m.get("content") or "") for m in request.get("messages", []))
+            tokens = min(service.output_tokens, int(request.get("max_tokens") or service.output_tokens))
+            text = service.diagram(tokens)
+            time.sleep(service.latency)
+            if request.get("stream"):
+                self._stream(service, request, text)
+            else:
+                # Generated at the configured rate, returned at once
+                if service.tokens_per_second:
+                    time.sleep(tokens / service.tokens_per_second)
+                body = json.dumps({
+                    "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()),
+                    "model": request.get("model", "fake"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                                 "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": prompt_chars // CHARS_PER_TOKEN, "completion_tokens": tokens,
+                              "total_tokens": prompt_chars // CHARS_PER_TOKEN + tokens},
+                }).encode()
+                self.send_body(200, body)
+            service.count("completion_tokens", tokens)
+            service.count("prompt_tokens", prompt_chars // CHARS_PER_TOKEN)
+        finally:
+            service.end()
+
+    def _stream(self, service: "FakeLLM", request: dict, text: str):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        piece_chars = CHARS_PER_TOKEN * 8
+        delay = 8 / service.tokens_per_second if service.tokens_per_second else 0
+        for start in range(0, len(text), piece_chars):
+            chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": request.get("model", "fake"),
+                     "choices": [{"index": 0, "delta": {"content": text[start:start + piece_chars]},
+                                  "finish_reason": None}]}
+            self._chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+            if delay:
+                time.sleep(delay)
+        self._chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+class FakeLLM(_FakeService):
+    """
+    Answers every completion with a valid flowchart of `output_tokens`
+    tokens (less if max_tokens says so), after `latency` seconds and at
+    `tokens_per_second` (0: instantly). `error_ratio` of calls fail with 500.
+    """
+    handler = _LLMHandler
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.5,
+                 tokens_per_second: float = 50.0, output_tokens: int = 400, error_ratio: float = 0.0):
+        super().__init__(host, port)
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.error_ratio = error_ratio
+        self.inflight = 0
+        self.max_inflight = 0
+        self._diagrams: Dict[int, str] = {}
+
+    @property
+    def api_url(self) -> str:
+        return f"{self.base_url}/v1"
+
+    def begin(self):
+        with self._lock:
+            self.counts["calls"] = self.counts.get("calls", 0) + 1
+            self.inflight += 1
+            self.max_inflight = max(self.max_inflight, self.inflight)
+
+    def end(self):
+        with self._lock:
+            self.inflight -= 1
+
+    def stats(self) -> Dict[str, int]:
+        stats = super().stats()
+        stats["max_inflight"] = self.max_inflight
+        return stats
+
+    def diagram(self, tokens: int) -> str:
+        text = self._diagrams.get(tokens)
+        if text is None:
+            lines = ["flowchart TD"]
+            node = 0
+            while sum(len(line) + 1 for line in lines) < tokens * CHARS_PER_TOKEN:
+                lines.append(f'    N{node}["Module {node}"] --> N{node + 1}["Module {node + 1}"]')
+                node += 1
+            text = self._diagrams[tokens] = "\n".join(lines)
+        return text
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--github-port", type=int, default=9001)
+    parser.add_argument("--llm-port", type=int, default=9002)
+    args = parser.parse_args(argv)
+
+    github = github_from_args(args, args.host, args.github_port).start()
+    llm = llm_from_args(args, args.host, args.llm_port).start()
+    print(f"GITHUB_API_URL={github.api_url}")
+    print(f"LLM_BASE_URL={llm.api_url}")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"github {github.stats()}  llm {llm.stats()}", flush=True)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Options shaping the fakes, shared with load_test.py."""
+    group = parser.add_argument_group("fake services")
+    group.add_argument("--tree-files", default="200",
+                       help="files per repository; a comma separated list mixes sizes (default: %(default)s)")
+    group.add_argument("--github-latency", type=float, default=0.02, help="seconds per GitHub response")
+    group.add_argument("--github-quota", type=int, default=5000, help="requests per token per window")
+    group.add_argument("--github-window", type=float, default=3600, help="quota window in seconds")
+    group.add_argument("--github-throttle-ratio", type=float, default=0.0,
+                       help="share of GitHub requests answered 429 with Retry-After")
+    group.add_argument("--llm-latency", type=float, default=0.5, help="seconds to the first token")
+    group.add_argument("--llm-tokens-per-sec", type=float, default=50.0, help="output rate (0: instant)")
+    group.add_argument("--llm-output-tokens", type=int, default=400, help="tokens per completion")
+    group.add_argument("--llm-error-ratio", type=float, default=0.0, help="share of LLM calls failing with 500")
+
+
+def github_from_args(args, host: str = "127.0.0.1", port: int = 0) -> FakeGitHub:
+    sizes = tuple(int(size) for size in str(args.tree_files).split(",") if size.strip())
+    return FakeGitHub(host, port, tree_sizes=sizes, latency=args.github_latency, quota=args.github_quota,
+                      window=args.github_window, throttle_ratio=args.github_throttle_ratio)
+
+
+def llm_from_args(args, host: str = "127.0.0.1", port: int = 0) -> FakeLLM:
+    return FakeLLM(host, port, latency=args.llm_latency, tokens_per_second=args.llm_tokens_per_sec,
+                   output_tokens=args.llm_output_tokens, error_ratio=args.llm_error_ratio)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,250 @@
+"""
+Offline end-to-end load test of POST /generate.
+
+Starts the fake GitHub API and fake LLM from fake_services.py, points the
+app at them through GITHUB_API_URL and LLM_BASE_URL (with a throwaway
+database and LLM cache), serves it in-process on a threaded WSGI server
+and drives /generate from --concurrency clients. A --hit-ratio share of
+requests asks for one of --warm-repos repositories generated before the
+measurement starts; the rest ask for repositories never seen before.
+
+    python benchmarks/load_test.py                                  # 200 requests, 8 clients, 80% hits
+    python benchmarks/load_test.py --duration 60 --concurrency 32 --hit-ratio 0.5
+    python benchmarks/load_test.py --tree-files 200,5000,50000 --llm-tokens-per-sec 30
+    python benchmarks/load_test.py --github-quota 100 --github-window 60   # run into rate limits
+    python benchmarks/load_test.py --url http://localhost:5000      # a server started separately
+
+Reports throughput, p50/p95/p99 latency for hits, misses and overall,
+errors by status and what the fake services saw. Settings of the app
+itself (LLM_MAX_CONCURRENCY, JOB_WORKERS, ...) are read from the
+environment as usual. The clients share the server's interpreter unless
+--url is given, so absolute numbers are pessimistic; compare runs with
+each other rather than with production.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_services import add_arguments, github_from_args, llm_from_args
+
+
+class Result(NamedTuple):
+    kind: str  # "hit" or "miss"
+    status: int  # 0 when the request itself failed
+    seconds: float
+
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def start_app(github_url: str, llm_url: str, workdir: str, port: int) -> str:
+    """Serves the app against the fakes on a threaded server; returns its base URL."""
+    os.environ.update({
+        "GITHUB_API_URL": github_url,
+        "LLM_BASE_URL": llm_url,
+        "LLM_API_KEY": "load-test",
+        "GITHUB_PAT": "load-test",
+        "REPO_SOURCE": "github",
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'load_test.db')}",
+        "LLM_CACHE_PATH": os.path.join(workdir, "llm_cache.db"),
+        "PREWARM_ENABLED": "false",
+    })
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    # Imported only now: the services read their settings at import time
+    from werkzeug.serving import make_server
+    from app import create_app, migrate_schema
+
+    app = create_app()
+    with app.app_context():
+        migrate_schema()
+    server = make_server("127.0.0.1", port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="app", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def generate(session: requests.Session, url: str, repo: str, diagram_type: str, timeout: float) -> int:
+    try:
+        response = session.post(f"{url}/generate", json={"repo_url": repo, "diagram_type": diagram_type},
+                                timeout=timeout)
+        return response.status_code
+    except requests.RequestException:
+        return 0
+
+
+def warm_up(url: str, repos: List[str], types: List[str], concurrency: int, timeout: float) -> int:
+    """Generates every (repo, type) pair once; returns how many failed."""
+    sessions = threading.local()
+
+    def one(target):
+        if not hasattr(sessions, "session"):
+            sessions.session = requests.Session()
+        return generate(sessions.session, url, *target, timeout)
+
+    targets = [(repo, diagram_type) for repo in repos for diagram_type in types]
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return sum(1 for status in pool.map(one, targets) if status != 200)
+
+
+def run_load(url: str, warm: List[str], types: List[str], args) -> (List[Result], float):
+    """Runs the measured phase; returns every request's result and the wall time."""
+    rng = random.Random(args.seed)
+    lock = threading.Lock()
+    issued = [0]
+    results: List[Result] = []
+    deadline = time.monotonic() + args.duration if args.duration else None
+    run_id = f"{int(time.time()):x}"
+
+    def next_target() -> Optional[tuple]:
+        with lock:
+            if deadline is None and issued[0] >= args.requests:
+                return None
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            issued[0] += 1
+            diagram_type = rng.choice(types)
+            if warm and rng.random() < args.hit_ratio:
+                return "hit", rng.choice(warm), diagram_type
+            return "miss", f"load/miss-{run_id}-{issued[0]}", diagram_type
+
+    def client():
+        session = requests.Session()
+        while True:
+            target = next_target()
+            if target is None:
+                return
+            kind, repo, diagram_type = target
+            started = time.perf_counter()
+            status = generate(session, url, repo, diagram_type, args.timeout)
+            result = Result(kind, status, time.perf_counter() - started)
+            with lock:
+                results.append(result)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, name=f"client-{i}") for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - started
+
+
+def summarize(results: List[Result], wall_seconds: float) -> Dict[str, dict]:
+    """Per kind (plus "all"): counts, throughput and latency percentiles in milliseconds."""
+    groups = {"all": results}
+    for kind in ("hit", "miss"):
+        groups[kind] = [r for r in results if r.kind == kind]
+
+    summary = {}
+    for group, group_results in groups.items():
+        if not group_results:
+            continue
+        latencies = sorted(r.seconds * 1000 for r in group_results)
+        errors: Dict[str, int] = {}
+        for r in group_results:
+            if r.status != 200:
+                errors[str(r.status)] = errors.get(str(r.status), 0) + 1
+        summary[group] = {
+            "requests": len(group_results),
+            "errors": errors,
+            "throughput_rps": round(len(group_results) / wall_seconds, 2) if wall_seconds else 0.0,
+            "p50_ms": round(_percentile(latencies, 50), 1),
+            "p95_ms": round(_percentile(latencies, 95), 1),
+            "p99_ms": round(_percentile(latencies, 99), 1),
+            "mean_ms": round(statistics.fmean(latencies), 1),
+            "max_ms": round(latencies[-1], 1),
+        }
+    return summary
+
+
+def print_report(summary: Dict[str, dict]):
+    header = f"{'kind':<6}{'reqs':>7}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}  errors"
+    print(header)
+    print("-" * len(header))
+    for group, r in summary.items():
+        errors = ", ".join(f"{status}: {count}" for status, count in sorted(r["errors"].items())) or "-"
+        print(f"{group:<6}{r['requests']:>7}{r['throughput_rps']:>9}{r['p50_ms']:>10}{r['p95_ms']:>10}"
+              f"{r['p99_ms']:>10}{r['max_ms']:>10}  {errors}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="drive an already running server instead of starting one with the fakes")
+    parser.add_argument("--port", type=int, default=0, help="port for the in-process server (default: any)")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--requests", type=int, default=200, help="measured requests")
+    parser.add_argument("--duration", type=float, help="measure for this many seconds instead of --requests")
+    parser.add_argument("--hit-ratio", type=float, default=0.8, help="share of requests for warm repositories")
+    parser.add_argument("--warm-repos", type=int, default=20, help="repositories generated before measuring")
+    parser.add_argument("--types", default="flowchart", help="comma separated diagram types to request")
+    parser.add_argument("--timeout", type=float, default=300, help="client timeout per request in seconds")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the hit/miss and type choices")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    types = [t.strip() for t in args.types.split(",") if t.strip()]
+    github = llm = None
+    workdir = tempfile.TemporaryDirectory(prefix="gitdiagram-load-")
+    if args.url:
+        url = args.url.rstrip("/")
+    else:
+        github = github_from_args(args).start()
+        llm = llm_from_args(args).start()
+        url = start_app(github.api_url, llm.api_url, workdir.name, args.port)
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    try:
+        warm = [f"load/warm-{i}" for i in range(args.warm_repos)]
+        if warm:
+            print(f"Warming {len(warm)} repositories x {len(types)} types...")
+            started = time.perf_counter()
+            failed = warm_up(url, warm, types, args.concurrency, args.timeout)
+            print(f"  done in {time.perf_counter() - started:.1f}s, {failed} failed")
+        baseline = {"github": github.stats(), "llm": llm.stats()} if github else {}
+
+        measured = f"{args.duration:g}s" if args.duration else f"{args.requests} requests"
+        print(f"\nLoad ({measured}, {args.concurrency} clients, hit ratio {args.hit_ratio:g}, {url}):")
+        results, wall_seconds = run_load(url, warm, types, args)
+        summary = summarize(results, wall_seconds)
+        print_report(summary)
+        print(f"\n{len(results)} requests in {wall_seconds:.1f}s")
+
+        fakes = {}
+        if github:
+            # Only what the measured phase cost
+            fakes = {name: {key: value - baseline[name].get(key, 0) if key != "max_inflight" else value
+                            for key, value in service.stats().items()}
+                     for name, service in (("github", github), ("llm", llm))}
+            for name, stats in fakes.items():
+                print(f"fake {name}: " + ", ".join(f"{key}={value}" for key, value in sorted(stats.items())))
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"url": url, "concurrency": args.concurrency, "hit_ratio": args.hit_ratio,
+                           "wall_seconds": round(wall_seconds, 2), "results": summary, "fakes": fakes}, f, indent=2)
+        errors = sum(1 for r in results if r.status != 200)
+        return 1 if results and errors == len(results) else 0
+    finally:
+        if github:
+            github.stop()
+            llm.stop()
+        workdir.cleanup()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,43 @@
+"""
+Creates the database tables and upgrades older schemas, then exits.
+
+    python migrate.py            # apply pending changes
+    python migrate.py --check    # list pending changes; exit status 1 if there are any
+
+Servers don't migrate at boot (unless DB_AUTO_MIGRATE=true), so run it
+before the first start and once per deploy (e.g. as a release step)
+before new workers come up. Their GET /ready stays at 503 while the
+schema is behind the code.
+"""
+import argparse
+import os
+import sys
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--check", action="store_true", help="only report pending changes")
+    args = parser.parse_args(argv)
+
+    # Only the schema step, whatever the deployment's settings
+    os.environ["DB_AUTO_MIGRATE"] = "false"
+    os.environ["PREWARM_ENABLED"] = "false"
+    os.environ["WARMUP_ENABLED"] = "false"
+    from app import create_app, db, migrate_schema, pending_schema_changes
+
+    app = create_app()
+    with app.app_context():
+        pending = pending_schema_changes()
+        for change in pending:
+            print(f"pending: {change}")
+        if args.check:
+            return 1 if pending else 0
+        if pending:
+            migrate_schema()
+        print(f"Schema of {db.engine.url.render_as_string(hide_password=True)} is up to date "
+              f"({len(pending)} changes applied)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
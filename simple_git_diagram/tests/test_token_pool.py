@@ -0,0 +1,62 @@
+import time
+import unittest
+
+from app.services.token_pool import RateLimitError, TokenPool
+
+
+def _headers(remaining: int, reset_at: float, limit: int = 60) -> dict:
+    return {"X-RateLimit-Limit": str(limit), "X-RateLimit-Remaining": str(remaining),
+            "X-RateLimit-Reset": str(int(reset_at))}
+
+
+class TokenPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = TokenPool([None])
+        self.reset_at = time.time() + 3600
+
+    def test_not_modified_responses_are_free(self):
+        state = self.pool.acquire()
+        self.pool.update(state, 200, _headers(59, self.reset_at))
+        try:
+            for _ in range(200):
+                state = self.pool.acquire()
+                self.pool.update(state, 304, _headers(59, self.reset_at))
+        except RateLimitError as e:
+            self.fail(f"304 responses used up the quota: {e}")
+        self.assertEqual(state.remaining, 59)
+
+    def test_not_modified_keeps_in_flight_requests_reserved(self):
+        state = self.pool.acquire()
+        self.pool.update(state, 200, _headers(59, self.reset_at))
+        first, second = self.pool.acquire(), self.pool.acquire()
+        self.pool.update(first, 304, _headers(59, self.reset_at))
+        self.assertEqual(state.remaining, 58)
+        self.pool.update(second, 200, _headers(58, self.reset_at))
+        self.assertEqual(state.remaining, 58)
+
+    def test_out_of_order_responses_keep_the_lower_count(self):
+        state = self.pool.acquire()
+        self.pool.update(state, 200, _headers(59, self.reset_at))
+        first, second = self.pool.acquire(), self.pool.acquire()
+        self.pool.update(second, 200, _headers(57, self.reset_at))
+        self.pool.update(first, 200, _headers(58, self.reset_at))
+        self.assertEqual(state.remaining, 57)
+
+    def test_late_not_modified_does_not_raise_the_count(self):
+        state = self.pool.acquire()
+        self.pool.update(state, 200, _headers(59, self.reset_at))
+        conditional, other = self.pool.acquire(), self.pool.acquire()
+        self.pool.update(other, 200, _headers(58, self.reset_at))
+        self.pool.update(conditional, 304, _headers(59, self.reset_at))
+        self.assertEqual(state.remaining, 58)
+
+    def test_exhausted_quota_raises(self):
+        self.pool.max_wait = 0
+        state = self.pool.acquire()
+        self.pool.update(state, 200, _headers(self.pool.reserve, self.reset_at))
+        with self.assertRaises(RateLimitError):
+            self.pool.acquire()
+
+
+if __name__ == "__main__":
+    unittest.main()